@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+"""
+Coregistration benchmark on synthetic DEM pairs with known dx/dy/dz and tilt.
+Times one pass through each stage of compute_offset (warp, slope/aspect, mask, outlier filter, fit), then
+runs dem_align.get_shift end to end on the pair written to GeoTIFF, with its Profiler stage timings,
+convergence history, iterations and error against the known shift.
+Timings are taken with tracemalloc off; with -trace_memory, a separate pass records peak traced
+allocations per stage. Results are written as JSON for tracking regressions locally; no network or
+real data needed.
+
+Usage: python benchmarks/bench_coreg.py -sizes 1000 2000 4000 -modes nuth ncc sad -out bench_coreg.json
+Compare Nuth and Kaab solvers with -nuth_solvers coreglib binned.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from pygeotools.lib import geolib
+from demcoreg import coreglib
+import coreg_engine
+import dem_align
+from convergence import convergence_choices
+import nuthlib
+import synthetic
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    #ru_maxrss is kB on Linux, bytes on macOS
+    scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+
+class StageTimer(object):
+    """Time a stage, and record peak traced (numpy/python) allocations if tracemalloc is running"""
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        s = self.stages.setdefault(self.name, {'time':0.0, 'calls':0})
+        s['time'] += dt
+        s['calls'] += 1
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]/1024.**2
+            s['peak_mb'] = max(s.get('peak_mb', 0.0), peak)
+        return False
+
+def bench_stages(ref_ds, src_ds, mode, max_offset, slope_lim, max_dz, nuth_solver='coreglib'):
+    """Time one pass through each stage of compute_offset"""
+    stages = {}
+    with StageTimer(stages, 'warp'):
+        engine = coreg_engine.WarpOnceEngine(ref_ds, src_ds)
+        ref_dem, src_dem, src_clip_ds = engine.clip()
+    diff = src_dem - ref_dem
+    with StageTimer(stages, 'slope_aspect'):
+        slope = dem_align.get_filtered_slope(src_clip_ds, slope_lim=slope_lim)
+        aspect = geolib.gdaldem_mem_ds(src_clip_ds, processing='aspect', returnma=True, computeEdges=False)
+    with StageTimer(stages, 'mask'):
+        static_mask = dem_align.get_mask(src_clip_ds, [], None)
+    diff = np.ma.array(diff, mask=static_mask)
+    with StageTimer(stages, 'outlier_filter'):
+        diff = dem_align.outlier_filter(diff, f=3, max_dz=max_dz)
+    diff = np.ma.array(diff, mask=np.ma.getmaskarray(slope))
+    res = geolib.get_res(src_clip_ds, square=True)[0]
+    pad = (int(max_offset/res + 1),)*2
+    with StageTimer(stages, 'fit'):
+        if mode == 'nuth' and nuth_solver == 'binned':
+            nuthlib.compute_offset_nuth(diff, slope, aspect, plot=False)
+        elif mode == 'nuth':
+            coreglib.compute_offset_nuth(diff, slope, aspect, plot=False)
+        else:
+            m = np.ma.getmaskarray(diff)
+            r = np.ma.array(ref_dem, mask=m)
+            s = np.ma.array(src_dem, mask=m)
+            if mode == 'ncc':
+                coreglib.compute_offset_ncc(r, s, pad=pad, prefilter=False, plot=False)
+            else:
+                coreglib.compute_offset_sad(r, s, pad=pad)
+    return stages
+
+def bench_get_shift(ref_fn, src_fn, outdir, mode, args, nuth_solver='coreglib'):
+    """Run get_shift end to end with profiling, return wall time, shift and the align stats json"""
+    t0 = time.perf_counter()
+    align_fn, shift = dem_align.get_shift(ref_fn, src_fn, outdir, mode=mode, res='max', mask_list=[], \
+            max_offset=args.max_offset, max_dz=args.max_dz, slope_lim=tuple(args.slope_lim), tol=args.tol, \
+            max_iter=args.max_iter, convergence=args.convergence, nuth_solver=nuth_solver, profile=True)
+    elapsed = time.perf_counter() - t0
+    with open(os.path.splitext(align_fn)[0] + '_stats.json') as f:
+        align_stats = json.load(f)
+    return elapsed, shift, align_stats
+
+def run_case(size, mode, args, tmpdir, nuth_solver='coreglib'):
+    shift = dict(zip(['dx', 'dy', 'dz'], args.shift))
+    ref_ds, src_ds, truth = synthetic.synth_pair(size, res=args.res, tilt=tuple(args.tilt), \
+            nodata_frac=args.nodata_frac, **shift)
+    result = {'size':size, 'mode':mode, 'truth':truth}
+    if mode == 'nuth':
+        result['nuth_solver'] = nuth_solver
+    #Timed without tracemalloc, which slows down every allocation
+    result['stages'] = bench_stages(ref_ds, src_ds, mode, args.max_offset, tuple(args.slope_lim), args.max_dz, \
+            nuth_solver)
+    if args.trace_memory:
+        tracemalloc.start()
+        mem_stages = bench_stages(ref_ds, src_ds, mode, args.max_offset, tuple(args.slope_lim), args.max_dz, \
+                nuth_solver)
+        tracemalloc.stop()
+        for name, s in mem_stages.items():
+            result['stages'][name]['peak_mb'] = s['peak_mb']
+    case = '%i_%s_%s' % (size, mode, nuth_solver)
+    ref_fn, src_fn = synthetic.write_pair(ref_ds, src_ds, os.path.join(tmpdir, case))
+    ref_ds = src_ds = None
+    elapsed, est, align_stats = bench_get_shift(ref_fn, src_fn, os.path.join(tmpdir, case, 'align'), mode, args, \
+            nuth_solver)
+    est = dict(zip(['dx', 'dy', 'dz'], est))
+    result['total_time'] = elapsed
+    result['profile'] = align_stats.get('profile')
+    result['convergence'] = align_stats.get('convergence')
+    result['iterations'] = sum(len(c['iterations']) for c in result['convergence'])
+    result['stop_reason'] = result['convergence'][-1]['stop_reason']
+    result['estimate'] = est
+    result['error'] = dict((k, est[k] - truth[k]) for k in ['dx', 'dy', 'dz'])
+    result['error']['dm_xy'] = float(np.hypot(result['error']['dx'], result['error']['dy']))
+    result['max_rss_mb'] = max_rss_mb()
+    return result
+
+def getparser():
+    parser = argparse.ArgumentParser(description="Benchmark DEM coregistration on synthetic pairs", \
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-sizes', type=int, nargs='+', default=[1000, 2000, 4000], \
+            help='DEM sizes in pixels (square), e.g. 1000 4000 16000')
+    parser.add_argument('-modes', type=str, nargs='+', default=['nuth'], help='compute_offset modes')
+    parser.add_argument('-nuth_solvers', type=str, nargs='+', default=['coreglib'], choices=nuthlib.nuth_solver_choices, \
+            help='Nuth and Kaab solvers to run for mode nuth')
+    parser.add_argument('-res', type=float, default=1.0, help='Pixel size (m)')
+    parser.add_argument('-shift', type=float, nargs=3, default=[1.3, -0.7, 0.25], help='Known dx dy dz (m)')
+    parser.add_argument('-tilt', type=float, nargs=2, default=[0.0, 0.0], help='Known tilt in x and y (m/m)')
+    parser.add_argument('-nodata_frac', type=float, default=0.05, help='Fraction of source blocks set to nodata')
+    parser.add_argument('-max_offset', type=float, default=5, help='Search range (m) for ncc and sad')
+    parser.add_argument('-max_dz', type=float, default=100, help='Outlier filter threshold (m)')
+    parser.add_argument('-slope_lim', type=float, nargs=2, default=(0.1, 40), help='Slope limits')
+    parser.add_argument('-tol', type=float, default=0.02, help='Convergence tolerance (m)')
+    parser.add_argument('-max_iter', type=int, default=30, help='Maximum number of iterations')
+    parser.add_argument('-convergence', type=str, default='tol', choices=convergence_choices, \
+            help='get_shift stop rule')
+    parser.add_argument('-trace_memory', action='store_true', \
+            help='Also record peak traced allocations per stage, in a separate untimed pass')
+    parser.add_argument('-out', type=str, default='bench_coreg.json', help='Output JSON filename')
+    return parser
+
+def main(argv=None):
+    args = getparser().parse_args(argv)
+    tmpdir = tempfile.mkdtemp(prefix='bench_coreg_')
+    results = []
+    try:
+        for size in args.sizes:
+            for mode in args.modes:
+                for nuth_solver in (args.nuth_solvers if mode == 'nuth' else ['coreglib']):
+                    print("\n=== size %i, mode %s ===" % (size, mode if mode != 'nuth' else 'nuth/' + nuth_solver))
+                    r = run_case(size, mode, args, tmpdir, nuth_solver)
+                    results.append(r)
+                    print("iterations: %i (%s), get_shift: %0.2f s, xy error: %0.3f m, z error: %0.3f m" % \
+                            (r['iterations'], r['stop_reason'], r['total_time'], r['error']['dm_xy'], r['error']['dz']))
+                    for name, s in r['stages'].items():
+                        print("  %-15s %8.3f s" % (name, s['time']) + \
+                                (" %8.1f MB" % s['peak_mb'] if 'peak_mb' in s else ''))
+                    for name, s in r['profile']['stages'].items():
+                        print("  get_shift %-15s %8.3f s (%i calls)" % (name, s['time'], s['calls']))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    out = {'config':vars(args), 'platform':platform.platform(), 'python':platform.python_version(), \
+            'numpy':np.__version__, 'results':results}
+    with open(args.out, 'w') as f:
+        json.dump(out, f, indent=1, default=float)
+    print("\nWrote %s" % args.out)
+
+if __name__ == "__main__":
+    main()
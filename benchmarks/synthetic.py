@@ -0,0 +1,90 @@
+"""
+Synthetic DEM pairs with known shift and tilt for benchmarks.
+Terrain is a sum of separable sinusoids, so every aspect is represented and the source can be
+evaluated analytically at shifted coordinates (no resampling error in the truth).
+"""
+import os
+import sys
+
+import numpy as np
+from osgeo import gdal, osr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+import coreg_engine
+
+#UTM 13N, units of meters
+synth_epsg = 32613
+synth_origin = (450000.0, 4400000.0)
+
+def synth_terrain(x, y, nterms=6, relief=40.0, seed=0):
+    """
+    Evaluate synthetic terrain on a grid defined by 1D x (columns) and y (rows) coordinate vectors.
+    Each term is an outer product of row and column vectors, so memory is one output array.
+    """
+    rng = np.random.RandomState(seed)
+    extent = max(np.ptp(x), np.ptp(y), 1.0)
+    z = np.zeros((y.size, x.size), dtype=np.float32)
+    for k in range(nterms):
+        #Wavelengths from extent/2 down to about 50 m, amplitude decreasing with wavenumber
+        wl = max(extent/(2.0*(k+1)), 50.0)
+        kx, ky = 2*np.pi/wl*rng.uniform(0.5, 1.5, 2)
+        px, py = rng.uniform(0, 2*np.pi, 2)
+        a = relief/(k+1)
+        z += a*np.outer(np.cos(ky*y + py), np.sin(kx*x + px)).astype(np.float32)
+    return z
+
+def synth_pair(size, res=1.0, dx=1.3, dy=-0.7, dz=0.25, tilt=(0.0, 0.0), seed=0, nodata_frac=0.0):
+    """
+    Return reference and source MEM datasets on the same grid.
+    The source surface is the reference terrain displaced by (dx, dy), raised by dz, plus an optional
+    planar tilt (m per m in x and y, about the grid center). The shift that get_shift should recover
+    is therefore (-dx, -dy, -dz).
+    Parameters:
+    - size (int): Number of pixels on a side.
+    - res (float): Pixel size (m).
+    - dx, dy, dz (float): Known displacement of the source (m).
+    - tilt (tuple): Planar tilt of the source (m/m) in x and y.
+    - seed (int): Random seed for terrain and nodata holes.
+    - nodata_frac (float): Fraction of source pixels to set as nodata in random blocks.
+    Returns:
+    - ref_ds, src_ds (gdal.Dataset): MEM datasets.
+    - truth (dict): Known shift to be recovered by coregistration.
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(synth_epsg)
+    proj = srs.ExportToWkt()
+    x = synth_origin[0] + (np.arange(size) + 0.5)*res
+    y = synth_origin[1] + size*res - (np.arange(size) + 0.5)*res
+    gt = (synth_origin[0], res, 0, synth_origin[1] + size*res, 0, -res)
+
+    ref = synth_terrain(x, y, seed=seed)
+    ref_ds = coreg_engine.mem_ds_like(np.ma.array(ref), gt, proj)
+    ref = None
+
+    src = synth_terrain(x - dx, y - dy, seed=seed)
+    src += dz
+    if tilt[0] or tilt[1]:
+        xc = (x - x.mean()).astype(np.float32)
+        yc = (y - y.mean()).astype(np.float32)
+        src += tilt[0]*xc[np.newaxis,:]
+        src += tilt[1]*yc[:,np.newaxis]
+    src = np.ma.array(src)
+    if nodata_frac > 0:
+        rng = np.random.RandomState(seed + 1)
+        bs = max(size//32, 1)
+        mask = rng.uniform(size=(size//bs + 1, size//bs + 1)) < nodata_frac
+        src[np.kron(mask, np.ones((bs, bs), dtype=bool))[:size,:size]] = np.ma.masked
+    src_ds = coreg_engine.mem_ds_like(src, gt, proj)
+    truth = {'dx':-dx, 'dy':-dy, 'dz':-dz, 'tilt':list(tilt)}
+    return ref_ds, src_ds, truth
+
+def write_pair(ref_ds, src_ds, outdir, prefix='synth'):
+    """Write synthetic pair to GeoTIFF for end-to-end runs, returns (ref_fn, src_fn)"""
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    ref_fn = os.path.join(outdir, prefix + '_ref.tif')
+    src_fn = os.path.join(outdir, prefix + '_src.tif')
+    drv = gdal.GetDriverByName('GTiff')
+    drv.CreateCopy(ref_fn, ref_ds, 0, options=['TILED=YES'])
+    drv.CreateCopy(src_fn, src_ds, 0, options=['TILED=YES'])
+    return ref_fn, src_fn
@@ -1,5 +1,4 @@
-from utilities.dem_align import get_shift
-from utilities.difflib import match_diff, shift_dem
+from utilities.pipeline import align_pipeline
 
 
 src_fn = r"Y:\ATD\Drone Data Processing\Exports\East_Troublesome\LPM\LPM_Intersection_PA3_RMSE_018 Exports\LPM_Intersection_PA3_RMSE_018____LPM_081222_PostError_PCFiltered_DEM.tif"
@@ -17,11 +16,13 @@ kwargs = {
 'slope_lim': (0.1, 40),
 'tiltcorr': False,
 'polyorder': 1,
-'res': 'max',
 'max_iter': 30,
 'tol': 0.02,
 }
 
-align_src_fn, shift = get_shift(LIDAR, src_fn, outdir, mode = mode, res = res, **kwargs)   
-shifted_src_fn = shift_dem(src_fn, outdir, shift)
-match_diff(shifted_src_fn, ref_fn, res, extent, outdir = outdir, align_stats_fn =None, orig_stats = False)
\ No newline at end of file
+#Products to write to outdir; choices = 'align', 'shifted', 'matched', 'dod'
+#Intermediate stages are passed in memory
+products = ['shifted', 'dod']
+
+result = align_pipeline(LIDAR, src_fn, outdir, mode = mode, res = res, extent = extent, diff_ref_fn = ref_fn, 
+                        products = products, **kwargs)
\ No newline at end of file
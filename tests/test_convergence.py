@@ -0,0 +1,81 @@
+"""
+Convergence monitor stop rules and extrapolation on synthetic shift sequences.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from convergence import ConvergenceMonitor, aitken
+
+limit = np.array([1.5, -0.8, 0.3])
+
+def run(monitor, steps, max_offset=None):
+    total = np.zeros(3)
+    for n, step in enumerate(steps, start=1):
+        total = total + step
+        reason = monitor.update(n, step, total)
+        if reason is not None:
+            return n, reason, np.array(monitor.final_shift(max_total=max_offset))
+    return n, None, total
+
+def geometric_steps(r=0.3, n=30):
+    #Totals converge to limit as 1 - r**k
+    return [limit*(1 - r)*r**k for k in range(n)]
+
+def oscillating_steps(n=30):
+    #Converged to limit, then bouncing by +/-1 cm
+    d = np.array([0.01, 0., 0.])
+    return [limit - d/2.] + [d*(-1)**k for k in range(n)]
+
+def test_aitken_geometric():
+    x = [1 - 0.5**k for k in range(1, 4)]
+    assert abs(aitken(*x) - 1) < 1E-12
+    assert aitken(1., 1., 1.) == 1.
+
+def test_tol_stops_on_step_only():
+    n, reason, total = run(ConvergenceMonitor(0.005, 30, method='tol'), geometric_steps())
+    assert reason == 'tol'
+    assert np.linalg.norm(geometric_steps()[n-1]) < 0.005
+
+def test_predicted_stop_is_earlier():
+    n_tol = run(ConvergenceMonitor(0.005, 30, method='tol'), geometric_steps())[0]
+    n, reason, total = run(ConvergenceMonitor(0.005, 30, method='predict'), geometric_steps())
+    assert reason == 'predicted'
+    assert n < n_tol
+    assert np.linalg.norm(total - limit) < 0.005
+
+def test_accel_extrapolates_to_limit():
+    monitor = ConvergenceMonitor(0.005, 30, method='accel')
+    n, reason, total = run(monitor, geometric_steps())
+    assert reason == 'predicted'
+    assert monitor.extrapolated is not None
+    assert np.linalg.norm(total - limit) < 1E-6
+
+def test_oscillation():
+    monitor = ConvergenceMonitor(0.005, 30, method='accel')
+    n, reason, total = run(monitor, oscillating_steps())
+    assert reason == 'oscillation'
+    assert n < 30
+    assert np.linalg.norm(total - limit) < 1E-9
+
+def test_tol_runs_through_oscillation():
+    n, reason, total = run(ConvergenceMonitor(0.005, 30, method='tol'), oscillating_steps())
+    assert reason == 'max_iter'
+    assert n == 30
+
+def test_extrapolation_bounded_by_max_offset():
+    monitor = ConvergenceMonitor(0.005, 30, method='accel')
+    n, reason, total = run(monitor, geometric_steps(), max_offset=1.)
+    assert monitor.extrapolated is None
+    assert np.allclose(total, monitor.totals[-1])
+
+def test_history():
+    monitor = ConvergenceMonitor(0.005, 30, method='predict')
+    n = run(monitor, geometric_steps())[0]
+    d = monitor.to_dict()
+    assert len(d['iterations']) == n
+    assert d['iterations'][-1]['reason'] == d['stop_reason']
+    assert all(i['reason'] == 'continue' for i in d['iterations'][:-1])
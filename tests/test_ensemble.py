@@ -0,0 +1,29 @@
+"""
+Robust combination of per-method offsets in the 'all' ensemble mode.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+for mod in ('osgeo', 'matplotlib', 'pygeotools', 'demcoreg', 'imview'):
+    pytest.importorskip(mod)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from dem_align import robust_mean_offset
+
+def test_agreeing_methods_equal_weight():
+    offsets = [(1.0, -2.0), (1.05, -1.95), (0.95, -2.05)]
+    (dx, dy), w = robust_mean_offset(offsets, res=1.0)
+    assert np.allclose(w, 1)
+    assert np.allclose((dx, dy), np.mean(offsets, axis=0))
+
+def test_outlier_method_downweighted():
+    offsets = [(1.0, 1.0), (1.02, 0.99), (0.98, 1.01), (5.0, 5.0)]
+    (dx, dy), w = robust_mean_offset(offsets, res=1.0)
+    assert np.allclose(w[:3], 1)
+    assert w[3] < 0.1
+    assert np.hypot(dx - 1, dy - 1) < 0.2
+    #Plain mean is pulled a full metre off
+    assert np.hypot(*(np.mean(offsets, axis=0) - 1)) > 1
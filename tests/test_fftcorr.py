@@ -0,0 +1,53 @@
+"""
+Masked FFT offset search on synthetic terrain with a known displacement.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+import fftcorr
+
+def terrain(rows, cols):
+    """
+    Smooth surface with structure in both directions, evaluated at (fractional) pixel coordinates.
+    Terms are separable in rows and columns, as assumed by the per-axis parabolic peak refinement.
+    """
+    return 20*np.sin(rows/23.)*np.cos(cols/31.) + 8*np.cos(rows/7.)*np.sin(cols/9.) + 0.05*rows
+
+def synthetic_pair(drow, dcol, shape=(256, 256), dz=3.0):
+    """ref and src with src[r + drow, c + dcol] == ref[r, c], plus a vertical offset and a masked hole"""
+    r, c = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float64)
+    ref = np.ma.array(terrain(r, c))
+    src = np.ma.array(terrain(r - drow, c - dcol) + dz)
+    src[100:130, 40:90] = np.ma.masked
+    return ref, src
+
+@pytest.mark.parametrize('method', ['ncc', 'ssd'])
+def test_integer_offset(method):
+    ref, src = synthetic_pair(3, -5)
+    score, int_offset, sp_offset, fig = fftcorr.compute_offset_fft(ref, src, pad=(9, 9), method=method)
+    assert tuple(int_offset) == (3, -5)
+    assert np.allclose(sp_offset, (3, -5), atol=0.1)
+
+@pytest.mark.parametrize('method', ['ncc', 'ssd'])
+def test_subpixel_offset(method):
+    ref, src = synthetic_pair(2.3, -1.6)
+    score, int_offset, sp_offset, fig = fftcorr.compute_offset_fft(ref, src, pad=(9, 9), method=method)
+    assert tuple(int_offset) == (2, -2)
+    assert np.allclose(sp_offset, (2.3, -1.6), atol=0.05)
+
+def test_large_offset_coarse_to_fine():
+    ref, src = synthetic_pair(-21, 17, shape=(512, 512))
+    score, int_offset, sp_offset, fig = fftcorr.compute_offset_fft(ref, src, pad=(40, 40))
+    assert tuple(int_offset) == (-21, 17)
+
+def test_masked_pixels_ignored():
+    ref, src = synthetic_pair(3, -5)
+    #Blunders under the mask must not move the peak
+    np.ma.getdata(src)[100:130, 40:90] = 1E4
+    assert tuple(fftcorr.compute_offset_fft(ref, src, pad=(9, 9))[1]) == (3, -5)
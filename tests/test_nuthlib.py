@@ -0,0 +1,53 @@
+"""
+Binned Nuth and Kaab solver on synthetic dh/slope/aspect with a known offset.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('matplotlib')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+import nuthlib
+
+#Offset magnitude (m), direction (degrees) and mean bias term, as in coreglib fit_param
+a, b, c = 1.5, 120.0, 0.3
+
+def synthetic(shape=(300, 300), noise=0.05, blunder_frac=0, seed=0):
+    """dh = (a*cos(b - aspect) + c)*tan(slope) + noise, the relation fit by Nuth and Kaab (2011)"""
+    rs = np.random.RandomState(seed)
+    aspect = rs.uniform(0, 360, shape)
+    slope = rs.uniform(5, 40, shape)
+    dh = (a*np.cos(np.deg2rad(b - aspect)) + c)*np.tan(np.deg2rad(slope)) + rs.normal(0, noise, shape)
+    if blunder_frac:
+        idx = rs.choice(dh.size, int(blunder_frac*dh.size), replace=False)
+        dh.flat[idx] = rs.uniform(-50, 50, idx.size)
+    mask = np.zeros(shape, dtype=bool)
+    mask[:20] = True
+    return np.ma.array(dh, mask=mask), np.ma.array(slope), np.ma.array(aspect)
+
+def check(fit_param, tol_a=0.05, tol_b=2.0, tol_c=0.05):
+    assert fit_param is not None
+    assert abs(fit_param[0] - a) < tol_a
+    assert abs((fit_param[1] - b + 180) % 360 - 180) < tol_b
+    assert abs(fit_param[2] - c) < tol_c
+
+@pytest.mark.parametrize('stat', nuthlib.nuth_stat_choices)
+def test_recovers_offset(stat):
+    fit_param, fig = nuthlib.compute_offset_nuth(*synthetic(), stat=stat, plot=False)
+    check(fit_param)
+
+def test_recovers_offset_with_stride():
+    fit_param, fig = nuthlib.compute_offset_nuth(*synthetic(), stride=2, plot=False)
+    check(fit_param)
+
+def test_robust_to_blunders():
+    fit_param, fig = nuthlib.compute_offset_nuth(*synthetic(blunder_frac=0.05), stat='median', plot=False)
+    check(fit_param, tol_a=0.1, tol_c=0.1)
+
+def test_too_few_samples():
+    diff, slope, aspect = synthetic(shape=(10, 10))
+    fit_param, fig = nuthlib.compute_offset_nuth(diff, slope, aspect, plot=False)
+    assert fit_param is None
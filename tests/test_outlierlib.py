@@ -0,0 +1,83 @@
+"""
+Streaming histogram outlier filter against the full-array filtlib filters, on synthetic differences.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+import outlierlib
+
+max_dz = 100
+bin_width = 0.001
+
+def synthetic_diff(shape=(600, 500), seed=0):
+    """Normal residuals with a few blunders, nodata-like values and a masked region"""
+    rs = np.random.RandomState(seed)
+    a = rs.normal(0.4, 0.3, shape).astype(np.float32)
+    idx = rs.choice(a.size, a.size//100, replace=False)
+    a.flat[idx] = rs.uniform(-20, 20, idx.size)
+    a.flat[idx[:10]] = -32768
+    a.flat[idx[10:20]] = 500
+    mask = np.zeros(shape, dtype=bool)
+    mask[:50, :50] = True
+    return np.ma.array(a, mask=mask)
+
+def abs_filtered(diff):
+    #Two-sided absolute filter, as applied by the histogram method
+    return np.ma.masked_outside(diff, -max_dz, max_dz)
+
+def check_masks(out, expected, lo, hi):
+    """Masks agree except for pixels within a bin of the kept range limits"""
+    differ = np.ma.getmaskarray(out) != np.ma.getmaskarray(expected)
+    d = np.ma.getdata(out)[differ]
+    near_limit = (np.abs(d - lo) <= 2*bin_width) | (np.abs(d - hi) <= 2*bin_width)
+    assert near_limit.all()
+
+def test_median_mad():
+    diff = abs_filtered(synthetic_diff())
+    h = outlierlib.DzHistogram(max_dz, bin_width)
+    h.update(diff.compressed())
+    med, mad = h.median_mad()
+    d = diff.compressed().astype(np.float64)
+    assert abs(med - np.median(d)) <= bin_width
+    assert abs(mad - np.median(np.abs(d - np.median(d)))) <= 2*bin_width
+
+def test_mad_filter_matches_filtlib():
+    filtlib = pytest.importorskip('pygeotools.lib.filtlib')
+    diff = synthetic_diff()
+    out, counts = outlierlib.outlier_filter(diff, f=3, max_dz=max_dz, bin_width=bin_width)
+    expected = filtlib.mad_fltr(abs_filtered(diff), 3)
+    check_masks(out, expected, *counts['range'])
+    assert abs(counts['final'] - expected.count()) <= 0.001*expected.count()
+
+def test_perc_filter_matches_filtlib():
+    filtlib = pytest.importorskip('pygeotools.lib.filtlib')
+    diff = synthetic_diff()
+    out, counts = outlierlib.outlier_filter(diff, perc=(12.5, 87.5), max_dz=max_dz, bin_width=bin_width)
+    expected = filtlib.perc_fltr(abs_filtered(diff), (12.5, 87.5))
+    check_masks(out, expected, *counts['range'])
+
+def test_counts():
+    diff = synthetic_diff()
+    out, counts = outlierlib.outlier_filter(diff, max_dz=max_dz)
+    assert counts['initial'] == diff.count()
+    assert counts['max_dz'] == abs_filtered(diff).count()
+    assert counts['final'] == out.count()
+    #Data is shared, not copied
+    assert np.may_share_memory(out.data, diff.data)
+
+def test_blocks_match_single_pass():
+    diff = synthetic_diff()
+    out, counts = outlierlib.outlier_filter(diff, max_dz=max_dz, block_px=diff.size)
+    out_blocks, counts_blocks = outlierlib.outlier_filter(diff, max_dz=max_dz, block_px=1000)
+    assert counts == counts_blocks
+    assert (np.ma.getmaskarray(out) == np.ma.getmaskarray(out_blocks)).all()
+
+def test_max_bins():
+    h = outlierlib.DzHistogram(max_dz=10000, bin_width=bin_width, max_bins=2**18)
+    assert h.nbins <= 2**18
+    assert h.bin_width > bin_width
@@ -0,0 +1,79 @@
+"""
+Alignment result cache keys, hits and LRU eviction.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+from result_cache import ResultCache, normalize_params
+
+params = {'mode':'nuth', 'res':'max', 'slope_lim':(0.1, 40), 'max_iter':30, 'tol':0.02, 'mask_list':[]}
+
+def write(fn, text='dem'):
+    with open(fn, 'w') as f:
+        f.write(text)
+    return fn
+
+def write_vrt(vrt_fn, tile_fn_list):
+    """Minimal mosaic VRT, only the source filenames matter for the key"""
+    sources = ''.join('<SimpleSource><SourceFilename relativeToVRT="0">%s</SourceFilename></SimpleSource>' % fn \
+            for fn in tile_fn_list)
+    return write(vrt_fn, '<VRTDataset><VRTRasterBand band="1">%s</VRTRasterBand></VRTDataset>' % sources)
+
+def set_mtime(fn, t):
+    os.utime(fn, (t, t))
+
+def test_hit_and_miss(tmp_path):
+    ref_fn = write(str(tmp_path / 'ref.tif'))
+    src_fn = write(str(tmp_path / 'src.tif'))
+    cache = ResultCache(str(tmp_path / 'cache'))
+    key = cache.make_key(ref_fn, src_fn, params)
+    assert cache.get(key) is None
+    cache.put(key, {'shift':[1., 2., 3.]})
+    assert cache.get(key) == {'shift':[1., 2., 3.]}
+    #Changed parameter or input content is a different key
+    assert cache.make_key(ref_fn, src_fn, dict(params, tol=0.01)) != key
+    write(src_fn, 'new dem')
+    assert cache.make_key(ref_fn, src_fn, params) != key
+
+def test_normalize_params():
+    a = normalize_params(dict(params, slope_lim=(0.1, 40), max_iter=30, outdir='a', plot=True))
+    b = normalize_params(dict(params, slope_lim=[0.1, 40.], max_iter=30., outdir='b'))
+    assert a == b
+    assert 'outdir' not in a
+    assert normalize_params(dict(params, tiltcorr=True))['tiltcorr'] is True
+
+def test_tiled_reference_keyed_on_tiles(tmp_path):
+    tile_fn_list = [write(str(tmp_path / ('tile%i.tif' % i))) for i in range(3)]
+    src_fn = write(str(tmp_path / 'src.tif'))
+    os.makedirs(str(tmp_path / 'out1'))
+    os.makedirs(str(tmp_path / 'out2'))
+    vrt1 = write_vrt(str(tmp_path / 'out1' / 'ref.vrt'), tile_fn_list)
+    vrt2 = write_vrt(str(tmp_path / 'out2' / 'ref.vrt'), tile_fn_list[::-1])
+    cache = ResultCache(str(tmp_path / 'cache'))
+    key = cache.make_key(vrt1, src_fn, params)
+    assert cache.make_key(vrt2, src_fn, params) == key
+    vrt3 = write_vrt(str(tmp_path / 'out2' / 'ref_sub.vrt'), tile_fn_list[:2])
+    assert cache.make_key(vrt3, src_fn, params) != key
+
+def test_evict_by_count(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_entries=2)
+    set_mtime(cache.put('a', {'x':1}), 1000)
+    set_mtime(cache.put('b', {'x':2}), 2000)
+    #Hit makes 'a' the most recently used, so 'b' is evicted
+    assert cache.get('a') is not None
+    cache.put('c', {'x':3})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+
+def test_evict_by_bytes(tmp_path):
+    stats = {'x':'a'*100}
+    cache = ResultCache(str(tmp_path / 'cache'), max_entries=None, max_bytes=250)
+    set_mtime(cache.put('a', stats), 1000)
+    set_mtime(cache.put('b', stats), 2000)
+    cache.put('c', stats)
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
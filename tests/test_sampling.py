@@ -0,0 +1,57 @@
+"""
+Stratified sample allocation and bilinear interpolation at shifted sample positions.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pygeotools')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+import sampling
+
+def test_quota_sums_to_budget():
+    counts = np.array([5, 1000, 40, 0, 300, 7])
+    for budget in (200, 201, 1000):
+        quota = sampling.stratum_quota(counts, budget)
+        assert quota.sum() == budget
+        assert (quota <= counts).all()
+        #Small strata are taken whole, the rest share equally
+        capped = quota < counts
+        assert np.ptp(quota[capped]) <= 1
+        assert (quota[~capped] <= quota[capped].max()).all()
+
+def test_quota_under_budget_keeps_all():
+    counts = np.array([3, 0, 8])
+    assert (sampling.stratum_quota(counts, 100) == counts).all()
+
+def test_stratified_sample():
+    rs = np.random.RandomState(1)
+    shape = (200, 300)
+    slope = rs.uniform(0, 45, shape)
+    aspect = rs.uniform(0, 360, shape)
+    valid = rs.uniform(size=shape) > 0.3
+    idx = sampling.stratified_sample(valid, slope, aspect, 5000, seed=0)
+    assert idx.size == 5000
+    assert np.unique(idx).size == idx.size
+    assert valid.ravel()[idx].all()
+    #Same seed, same sample
+    assert (idx == sampling.stratified_sample(valid, slope, aspect, 5000, seed=0)).all()
+
+def test_bilinear_reproduces_plane():
+    r, c = np.mgrid[0:50, 0:60].astype(np.float64)
+    a = np.ma.array(2.5*r - 1.25*c + 10)
+    rs = np.random.RandomState(0)
+    rows = rs.uniform(0, 49, 1000)
+    cols = rs.uniform(0, 59, 1000)
+    z = sampling.bilinear(a, rows, cols)
+    assert not np.ma.getmaskarray(z).any()
+    assert np.allclose(z, 2.5*rows - 1.25*cols + 10)
+
+def test_bilinear_masks_invalid_neighbors():
+    a = np.ma.array(np.ones((10, 10)))
+    a[5, 5] = np.ma.masked
+    z = sampling.bilinear(a, np.array([4.5, 5.5, 1.5, -0.5, 9.5]), np.array([4.5, 5.5, 1.5, 1.0, 1.0]))
+    assert np.ma.getmaskarray(z).tolist() == [True, True, False, True, True]
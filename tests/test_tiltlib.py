@@ -0,0 +1,62 @@
+"""
+Tilt correction fit on a subsample and block-wise evaluation, on synthetic polynomial surfaces.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('pygeotools')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utilities'))
+import tiltlib
+
+gt = (450000.0, 2.0, 0.0, 4400000.0, 0.0, -2.0)
+shape = (300, 400)
+
+def quadratic(x, y):
+    """Known quadratic surface (m) in map coordinates, centered near the grid"""
+    u = (x - 450400.)/400.
+    v = (y - 4399700.)/300.
+    return 0.5 + 0.8*u - 0.3*v + 0.2*u**2 - 0.15*u*v + 0.1*v**2
+
+def synthetic_diff(masked_frac=0.3, seed=0):
+    cols = np.arange(shape[1]) + 0.5
+    rows = (np.arange(shape[0]) + 0.5)[:,np.newaxis]
+    z = quadratic(gt[0] + cols*gt[1], gt[3] + rows*gt[5])
+    mask = np.random.RandomState(seed).uniform(size=shape) < masked_frac
+    #Masked pixels hold blunders, which must not reach the fit
+    z = np.where(mask, 1E4, z)
+    return np.ma.array(z, mask=mask), z
+
+@pytest.mark.parametrize('azimuth', [None, 30.0])
+def test_recovers_quadratic(azimuth):
+    diff, z = synthetic_diff()
+    tilt = tiltlib.fit_tilt(diff, gt, order=2, azimuth=azimuth, max_samples=5000)
+    val = tilt.evaluate(gt, 0, 0, shape[1], shape[0])
+    valid = ~np.ma.getmaskarray(diff)
+    assert np.allclose(val[valid], z[valid], atol=1E-4)
+
+def test_evaluate_windows_match_full_grid():
+    diff, z = synthetic_diff()
+    tilt = tiltlib.fit_tilt(diff, gt, order=2, azimuth=30.0, max_samples=5000)
+    full = tilt.evaluate(gt, 0, 0, shape[1], shape[0])
+    assert np.allclose(tilt.evaluate(gt, 150, 100, 50, 40), full[100:140, 150:200])
+
+def test_too_few_samples():
+    diff, z = synthetic_diff(masked_frac=0.9999)
+    tilt = tiltlib.fit_tilt(diff, gt, order=2)
+    assert (tilt.coeff == 0).all()
+
+@pytest.mark.parametrize('block_px', [1000, 2**20])
+def test_sample_valid(block_px):
+    diff, z = synthetic_diff()
+    n_valid = diff.count()
+    for max_samples in (1000, n_valid + 10):
+        idx, n = tiltlib.sample_valid(diff, max_samples, seed=1, block_px=block_px)
+        assert n == n_valid
+        assert idx.size == min(max_samples, n_valid)
+        assert np.unique(idx).size == idx.size
+        assert not np.ma.getmaskarray(diff).ravel()[idx].any()
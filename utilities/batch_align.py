@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+"""
+Align many source DEMs against one reference DEM in parallel, and write a summary table of shifts and stats.
+
+Example:
+python batch_align.py ref_dem.tif src1.tif src2.tif src3.tif -outdir aligned -processes 8
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+
+from demcoreg import dem_mask
+from dem_align import get_shift
+from difflib import match_diff
+import coreg_engine
+from convergence import convergence_choices
+import logger
+import footprint
+import fftcorr
+import outlierlib
+import writelib
+from logger import Logger
+
+summary_fields = ['src_fn', 'status', 'align_fn', 'dx', 'dy', 'dz', 'dm', 'after_med', 'after_nmad', \
+        'diff_fn', 'stats_fn', 'elapsed', 'error']
+
+def getparser():
+    parser = argparse.ArgumentParser(description="Align multiple source DEMs to a single reference DEM in parallel", \
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('ref_fn', type=str, help='Reference DEM filename, tile directory or footprint index json')
+    parser.add_argument('src_fn_list', type=str, nargs='*', help='Source DEM filenames to be shifted')
+    parser.add_argument('-src_dir', type=str, default=None, \
+            help='Discover source DEMs under this directory (in addition to src_fn_list)')
+    parser.add_argument('-pattern', type=str, nargs='+', default=['*.tif'], help='Glob pattern(s) for -src_dir filenames')
+    parser.add_argument('-regex', type=str, default=None, help='Regular expression for -src_dir filenames')
+    parser.add_argument('-no_recursive', action='store_true', help='Only search the top level of -src_dir')
+    parser.add_argument('-outdir', type=str, required=True, help='Output directory, one subdirectory per source DEM')
+    parser.add_argument('-processes', type=int, default=None, help='Number of worker processes (default: cpu count)')
+    parser.add_argument('-mode', type=str, default='nuth', choices=['ncc', 'sad', 'nuth', 'all'] + fftcorr.fft_modes, \
+            help='Type of co-registration to use')
+    parser.add_argument('-mask_list', nargs='+', type=str, default=[], choices=dem_mask.mask_choices, \
+            help='Define masks to use to limit reference surfaces for co-registration')
+    parser.add_argument('-tiltcorr', action='store_true', \
+            help='After preliminary translation, fit polynomial to residual elevation offsets and remove')
+    parser.add_argument('-polyorder', type=int, default=1, help='Specify order of polynomial fit')
+    parser.add_argument('-tol', type=float, default=0.02, help='Iteration tolerance (meters)')
+    parser.add_argument('-max_offset', type=float, default=100, help='Maximum expected horizontal offset in meters')
+    parser.add_argument('-max_dz', type=float, default=100, help='Maximum expected vertical offset in meters')
+    parser.add_argument('-outlier_method', type=str, default='exact', choices=outlierlib.outlier_method_choices, \
+            help='Outlier filter: exact median/MAD (exact), or streaming histogram median/MAD with a two-sided |dz| <= max_dz limit (hist)')
+    parser.add_argument('-res', type=str, default='max', choices=['min', 'max', 'mean', 'common_scale_factor'], \
+            help='Warp intputs to this resolution')
+    parser.add_argument('-extent', type=str, default='intersection', \
+            choices=['intersection', 'union', 'first', 'second'], help='Extent for the final DoD')
+    parser.add_argument('-slope_lim', type=float, nargs=2, default=(0.1, 40), \
+            help='Minimum and maximum surface slope limits to consider')
+    parser.add_argument('-max_iter', type=int, default=30, help='Maximum number of iterations')
+    parser.add_argument('-convergence', type=str, default='tol', choices=convergence_choices, \
+            help='Stop on tol only (tol), also on predicted error or oscillation (predict), and extrapolate (accel)')
+    parser.add_argument('-warp_engine', type=str, default='warp', choices=coreg_engine.engine_choices, \
+            help='Iteration engine used for resampling the shifted source')
+    parser.add_argument('-no_diff', action='store_true', help='Skip match_diff after alignment')
+    parser.add_argument('-cache_dir', type=str, default=None, \
+            help='Shared result cache, sources already aligned with the same parameters skip iteration')
+    parser.add_argument('-out_profile', type=str, default=writelib.default_profile, choices=writelib.profile_choices, \
+            help='GeoTIFF layout for aligned DEMs and difference maps')
+    parser.add_argument('-summary_fn', type=str, default=None, \
+            help='Summary table filename (default: outdir/batch_align_summary.csv)')
+    return parser
+
+def init_worker():
+    """Pool initializer: one GDAL thread per worker unless GDAL_NUM_THREADS is set, the pool already uses every core"""
+    os.environ.setdefault('GDAL_NUM_THREADS', '1')
+
+def align_one(job):
+    """Worker: run get_shift and match_diff for a single source DEM, returning a summary row"""
+    src_dem_fn, ref_dem_fn, outdir, kwargs = job
+    mode = kwargs.pop('mode')
+    res = kwargs.pop('res')
+    extent = kwargs.pop('extent')
+    no_diff = kwargs.pop('no_diff')
+    run_log_fn = kwargs.pop('run_log_fn')
+    row = {'src_fn':src_dem_fn, 'status':'ok'}
+    t0 = time.time()
+    try:
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        #Tile directory or index json resolves to a VRT of overlapping tiles, used for both alignment and DoD
+        ref_dem_fn = footprint.resolve_reference(ref_dem_fn, src_dem_fn, outdir)
+        align_fn, shift = get_shift(ref_dem_fn, src_dem_fn, outdir, mode=mode, res=res, **kwargs)
+        row['align_fn'] = align_fn
+        row['dx'], row['dy'], row['dz'] = shift
+        row['dm'] = (shift[0]**2 + shift[1]**2 + shift[2]**2)**0.5
+        align_stats_fn = os.path.splitext(align_fn)[0] + '_stats.json'
+        if os.path.exists(align_stats_fn):
+            with open(align_stats_fn) as f:
+                after = json.load(f).get('after', {})
+            row['after_med'] = after.get('med')
+            row['after_nmad'] = after.get('nmad')
+        if not no_diff:
+            row['diff_fn'], row['stats_fn'] = match_diff(align_fn, ref_dem_fn, res, extent, outdir=outdir, \
+                    out_profile=kwargs.get('out_profile'))
+    #get_shift uses sys.exit for failed alignments
+    except (Exception, SystemExit) as e:
+        row['status'] = 'failed'
+        row['error'] = str(e)
+    row['elapsed'] = round(time.time() - t0, 1)
+    #Shared run log, one locked append per source DEM
+    with Logger(run_log_fn, json_file=True, print_msg=False) as log:
+        log.log("%s: %s (%0.1f s)" % (os.path.split(src_dem_fn)[-1], row['status'], row['elapsed']), **row)
+    return row
+
+def batch_align(ref_dem_fn, src_dem_fn_list, outdir, processes=None, summary_fn=None, **kwargs):
+    """
+    Align source DEMs against one reference on a process pool.
+    Parameters:
+    - ref_dem_fn (str): Reference DEM filename, shared read-only by all workers. Each worker reprojects it
+      to the source CRS in the single cubic warp of get_shift, so reference samples are interpolated once.
+    - src_dem_fn_list (list): Source DEM filenames to be shifted.
+    - outdir (str): Output directory, each source gets its own subdirectory.
+    - processes (int): Number of worker processes, default is cpu count.
+    - summary_fn (str): Summary table filename (csv).
+    - kwargs: Options passed to get_shift, plus mode, res, extent, no_diff and run_log_fn (shared text/JSON-lines log).
+    Returns:
+    - rows (list): Summary dict for each source DEM, in input order.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if summary_fn is None:
+        summary_fn = os.path.join(outdir, 'batch_align_summary.csv')
+    kwargs.setdefault('mode', 'nuth')
+    kwargs.setdefault('res', 'max')
+    kwargs.setdefault('extent', 'intersection')
+    kwargs.setdefault('no_diff', False)
+    kwargs.setdefault('run_log_fn', os.path.join(outdir, 'batch_align_log.txt'))
+    if os.path.isdir(ref_dem_fn):
+        #Index the tiles once here, workers only load the json
+        ref_dem_fn = footprint.index_folder(ref_dem_fn, outdir)
+
+    #Tile directory or footprint index is resolved per worker to a mosaic of its overlapping tiles
+    jobs = []
+    for src_dem_fn in src_dem_fn_list:
+        src_outdir = os.path.join(outdir, os.path.splitext(os.path.split(src_dem_fn)[-1])[0])
+        jobs.append((src_dem_fn, ref_dem_fn, src_outdir, dict(kwargs)))
+
+    print("Aligning %i source DEMs with %s processes" % (len(jobs), processes or multiprocessing.cpu_count()))
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        rows = pool.map(align_one, jobs, chunksize=1)
+
+    print("Writing summary: %s" % summary_fn)
+    with open(summary_fn, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=summary_fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return rows
+
+def main(argv=None):
+    parser = getparser()
+    args = parser.parse_args(argv)
+    kwargs = vars(args)
+    ref_dem_fn = kwargs.pop('ref_fn')
+    src_dem_fn_list = kwargs.pop('src_fn_list')
+    src_dir = kwargs.pop('src_dir')
+    pattern = kwargs.pop('pattern')
+    regex = kwargs.pop('regex')
+    recursive = not kwargs.pop('no_recursive')
+    outdir = kwargs.pop('outdir')
+    if src_dir is not None:
+        src_dem_fn_list += [fn for fn in logger.iter_files(src_dir, pattern=pattern, regex=regex, recursive=recursive) \
+                if os.path.abspath(fn) != os.path.abspath(ref_dem_fn)]
+    #Header-only footprint check, so no alignment work is scheduled for sources outside the reference
+    if os.path.isdir(ref_dem_fn) or os.path.splitext(ref_dem_fn)[1].lower() == '.json':
+        if os.path.isdir(ref_dem_fn):
+            #Index once here, workers only load it
+            ref_dem_fn = footprint.index_folder(ref_dem_fn, outdir)
+        ref_idx = footprint.FootprintIndex.load(ref_dem_fn)
+        src_dem_fn_list = [fn for fn in src_dem_fn_list if ref_idx.query_fn(fn)]
+    else:
+        src_dem_fn_list = list(footprint.filter_overlapping(src_dem_fn_list, ref_dem_fn))
+    if not src_dem_fn_list:
+        sys.exit("No source DEMs overlap the reference DEM")
+    kwargs['slope_lim'] = tuple(kwargs['slope_lim'])
+    rows = batch_align(ref_dem_fn, src_dem_fn_list, outdir, **kwargs)
+    nfail = sum(row['status'] != 'ok' for row in rows)
+    if nfail:
+        print("%i of %i alignments failed, see summary table" % (nfail, len(rows)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Convergence monitor for the iterative shift estimate.
+Tracks the incremental and cumulative shifts and estimates the contraction rate r = |step_k|/|step_k-1|.
+For geometric convergence the remaining error after step k is about |step_k|*r/(1 - r), so iteration can
+stop once that prediction is below tol, rather than waiting for the step itself to drop below tol.
+Alternating steps that do not contract are an oscillation about the solution, which further
+iterations will not resolve.
+
+With acceleration, the final cumulative shift is extrapolated from the last three totals with
+Aitken's delta-squared process (per component), or taken as the midpoint of an oscillation.
+"""
+import numpy as np
+
+#tol: stop on step < tol or max_iter only; predict: also on predicted error < tol or oscillation;
+#accel: as predict, and extrapolate the final shift
+convergence_choices = ['tol', 'predict', 'accel']
+
+def aitken(x0, x1, x2):
+    """Aitken delta-squared limit of x0, x1, x2, or x2 if the second difference vanishes"""
+    d1 = x1 - x0
+    d2 = x2 - x1
+    denom = d2 - d1
+    if abs(denom) < 1E-12:
+        return x2
+    return x2 - d2**2/denom
+
+class ConvergenceMonitor(object):
+    """
+    Per-iteration stop decision from the shift history.
+
+    Example:
+    monitor = ConvergenceMonitor(tol, max_iter, method='accel')
+    while True:
+        ...
+        reason = monitor.update(n, (dx, dy, dz), (dx_total, dy_total, dz_total))
+        if reason is not None:
+            dx_total, dy_total, dz_total = monitor.final_shift()
+            break
+    """
+    def __init__(self, tol, max_iter, method='tol', min_iter=3, max_rate=0.9, osc_iter=3, max_gain=10.):
+        """
+        Parameters:
+        - tol (float): Tolerance (m) for the step, and for the predicted remaining error.
+        - max_iter (int): Stop at this iteration number.
+        - method (str): One of convergence_choices.
+        - min_iter (int): Minimum number of iterations recorded by this monitor before a predicted or oscillation stop.
+        - max_rate (float): Contraction rates above this are not treated as geometric convergence.
+        - osc_iter (int): Number of consecutive reversals of the step direction for an oscillation.
+        - max_gain (float): Extrapolations larger than max_gain times the last step are rejected.
+        """
+        self.tol = tol
+        self.max_iter = max_iter
+        self.method = method
+        self.min_iter = min_iter
+        self.max_rate = max_rate
+        self.osc_iter = osc_iter
+        self.max_gain = max_gain
+        self.steps = []
+        self.totals = []
+        self.history = []
+        self.reason = None
+        self.extrapolated = None
+
+    def rate(self):
+        """Contraction rate from the last two step ratios (the larger, to be conservative), None if unknown"""
+        dm = [np.linalg.norm(s) for s in self.steps[-3:]]
+        if len(dm) < 3 or dm[0] == 0 or dm[1] == 0:
+            return None
+        return max(dm[1]/dm[0], dm[2]/dm[1])
+
+    def reversals(self):
+        """Number of consecutive most recent steps that reverse the direction of the previous step"""
+        k = 0
+        for a, b in zip(self.steps[-1:0:-1], self.steps[-2::-1]):
+            if np.dot(a, b) >= 0:
+                break
+            k += 1
+        return k
+
+    def update(self, n, step, total):
+        """
+        Record iteration n, with incremental step (dx, dy, dz) and cumulative total after it.
+        Returns the stop reason ('tol', 'max_iter', 'predicted', 'oscillation'), or None to continue.
+        """
+        step = np.asarray(step, dtype=np.float64)
+        self.steps.append(step)
+        self.totals.append(np.asarray(total, dtype=np.float64))
+        dm = float(np.linalg.norm(step))
+        r = self.rate()
+        osc = self.reversals() >= self.osc_iter
+        #Remaining error: tail of the geometric series, or distance to the midpoint of an oscillation
+        pred_err = None
+        if r is not None and r < 1:
+            pred_err = dm*r/(1 - r)
+        elif osc:
+            pred_err = dm/2.
+        reason = None
+        if dm < self.tol:
+            reason = 'tol'
+        elif self.method != 'tol' and len(self.steps) >= self.min_iter:
+            if r is not None and r <= self.max_rate and pred_err < self.tol:
+                reason = 'predicted'
+            elif osc and (r is None or r > self.max_rate):
+                reason = 'oscillation'
+        if reason is None and n >= self.max_iter:
+            reason = 'max_iter'
+        self.history.append({'iter':n, 'dx':float(step[0]), 'dy':float(step[1]), 'dz':float(step[2]), 'dm':dm, \
+                'rate':r, 'pred_err':pred_err, 'oscillating':bool(osc), 'reason':reason or 'continue'})
+        self.reason = reason
+        return reason
+
+    def final_shift(self, max_total=None):
+        """
+        Cumulative shift to use after stopping: extrapolated for method 'accel' after an early stop, else the last total.
+        Extrapolations with a total magnitude above max_total (m) are rejected.
+        """
+        total = self.totals[-1]
+        if self.method != 'accel' or len(self.totals) < 3 or self.reason not in ('predicted', 'oscillation'):
+            return tuple(float(x) for x in total)
+        x0, x1, x2 = self.totals[-3:]
+        if self.reason == 'oscillation':
+            out = (x1 + x2)/2.
+        else:
+            out = np.array([aitken(a, b, c) for a, b, c in zip(x0, x1, x2)])
+        #Guard against a vanishing second difference blowing up the correction
+        dm = np.linalg.norm(self.steps[-1])
+        if np.linalg.norm(out - total) > self.max_gain*dm:
+            print("Rejected extrapolated shift, correction too large relative to last step")
+            return tuple(float(x) for x in total)
+        if max_total is not None and np.linalg.norm(out) > max_total:
+            print("Rejected extrapolated shift, total offset exceeds %0.2f m" % max_total)
+            return tuple(float(x) for x in total)
+        self.extrapolated = [float(x) for x in out - total]
+        print("Extrapolated final shift (%s): dx=%+0.3fm, dy=%+0.3fm, dz=%+0.3fm" % \
+                ((self.reason,) + tuple(self.extrapolated)))
+        return tuple(float(x) for x in out)
+
+    def to_dict(self):
+        return {'method':self.method, 'tol':self.tol, 'stop_reason':self.reason, \
+                'extrapolated':dict(zip(['dx', 'dy', 'dz'], self.extrapolated)) if self.extrapolated else None, \
+                'iterations':self.history}
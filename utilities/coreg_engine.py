@@ -0,0 +1,130 @@
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage
+
+from pygeotools.lib import iolib
+from demcoreg import coreglib
+
+#Methods for updating the source DEM on the fixed reference grid
+engine_choices = ['warp', 'array']
+
+def mem_ds_like(a, gt, proj, ndv=-9999):
+    """
+    Create an in-memory GDAL dataset holding a masked array on the specified grid.
+    Parameters:
+    - a (np.ma.MaskedArray): Array to store.
+    - gt (tuple): Geotransform of the output dataset.
+    - proj (str): Projection WKT of the output dataset.
+    - ndv (float): Nodata value used for masked pixels.
+    Returns:
+    - ds (gdal.Dataset): MEM dataset with a single Float32 band.
+    """
+    ny, nx = a.shape
+    ds = iolib.mem_drv.Create('', nx, ny, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform(tuple(gt))
+    ds.SetProjection(proj)
+    b = ds.GetRasterBand(1)
+    b.SetNoDataValue(ndv)
+    b.WriteArray(np.ma.filled(a.astype(np.float32), ndv))
+    return ds
+
+def shift_array(a, dcol, drow, order=1):
+    """
+    Resample a masked array by a sub-pixel offset.
+    Output pixel (r, c) samples the input at (r - drow, c - dcol).
+    Pixels that touch masked or out-of-bounds input are masked in the output.
+    Parameters:
+    - a (np.ma.MaskedArray): Input array.
+    - dcol, drow (float): Offset in pixels along columns and rows.
+    - order (int): Spline order, 1 (bilinear) or 3 (cubic).
+    Returns:
+    - out (np.ma.MaskedArray): Shifted array.
+    """
+    mask = np.ma.getmaskarray(a)
+    if order == 1:
+        #No prefilter for bilinear, so nan only propagates to direct neighbors
+        out = ndimage.shift(np.ma.filled(a.astype(np.float64), np.nan), (drow, dcol), order=1, \
+                mode='constant', cval=np.nan, prefilter=False)
+        return np.ma.masked_invalid(out)
+    #Cubic spline prefilter spreads nan over the whole array, so fill holes and shift the mask separately
+    fill = a.mean() if a.count() > 0 else 0
+    out = ndimage.shift(np.ma.filled(a.astype(np.float64), fill), (drow, dcol), order=order, \
+            mode='constant', cval=fill)
+    out_mask = ndimage.shift(mask.astype(np.float32), (drow, dcol), order=1, mode='constant', cval=1.0) > 0
+    out_mask = ndimage.binary_dilation(out_mask, iterations=order//2)
+    return np.ma.array(out, mask=out_mask)
+
+class WarpOnceEngine(object):
+    """
+    Iteration engine that keeps the reference DEM fixed on a single grid.
+    The reference is read once, and each iteration only resamples the shifted source DEM onto that grid.
+
+    method='warp' warps the source dataset (with updated geotransform) onto the reference grid.
+    method='array' warps the source once, then applies incremental shifts as sub-pixel resampling of the cached array.
+    Vertical shifts are accumulated and added to the resampled array, rather than rewriting the source dataset.
+    """
+    def __init__(self, ref_dem_ds, src_dem_ds, method='warp', r='cubic', order=1):
+        if method not in engine_choices:
+            raise ValueError("Unknown warp engine method: %s" % method)
+        self.method = method
+        self.r = r
+        self.order = order
+        self.ref_ds = ref_dem_ds
+        self.gt = np.array(ref_dem_ds.GetGeoTransform())
+        self.proj = ref_dem_ds.GetProjection()
+        self.shape = (ref_dem_ds.RasterYSize, ref_dem_ds.RasterXSize)
+        self.ref_dem = iolib.ds_getma(ref_dem_ds)
+        self.src_ds = None
+        self.reset(src_dem_ds)
+
+    def reset(self, src_dem_ds):
+        """Use a new source dataset (e.g., after tilt correction) as the base for subsequent shifts"""
+        self.src_ds = src_dem_ds
+        #Shifts applied since the last reset
+        self.dx = 0
+        self.dy = 0
+        self.dz = 0
+        self.src_base = None
+        if self.method == 'array':
+            self.src_base = iolib.ds_getma(self.warp_to_grid(src_dem_ds))
+
+    def warp_to_grid(self, src_ds):
+        """Warp a dataset onto the fixed reference grid"""
+        ny, nx = self.shape
+        gt = self.gt
+        bounds = (gt[0], gt[3] + ny*gt[5], gt[0] + nx*gt[1], gt[3])
+        ndv = iolib.get_ndv_ds(src_ds)
+        opt = gdal.WarpOptions(format='MEM', outputBounds=bounds, width=nx, height=ny, \
+                dstSRS=self.proj, resampleAlg=self.r, dstNodata=ndv, outputType=gdal.GDT_Float32)
+        return gdal.Warp('', src_ds, options=opt)
+
+    def apply_shift(self, dx, dy, dz):
+        """Record an incremental shift, only the source geotransform is updated"""
+        self.src_ds = coreglib.apply_xy_shift(self.src_ds, dx, dy, createcopy=False)
+        self.dx += dx
+        self.dy += dy
+        self.dz += dz
+
+    def clip(self):
+        """
+        Return the reference and shifted source arrays on the fixed grid.
+        Returns:
+        - ref_dem (np.ma.MaskedArray): Reference DEM, read once at initialization.
+        - src_dem (np.ma.MaskedArray): Source DEM with all shifts applied.
+        - src_dem_clip_ds (gdal.Dataset): MEM dataset for src_dem, used for masks and terrain derivatives.
+        """
+        if self.method == 'array':
+            #Geotransform has negative y resolution, np array is positive down
+            src_dem = shift_array(self.src_base, self.dx/self.gt[1], self.dy/self.gt[5], order=self.order)
+        else:
+            src_dem = iolib.ds_getma(self.warp_to_grid(self.src_ds))
+        src_dem = src_dem + self.dz
+        src_dem_clip_ds = mem_ds_like(src_dem, self.gt, self.proj)
+        return self.ref_dem, src_dem, src_dem_clip_ds
+
+    def get_src_ds(self):
+        """Return the source dataset with pending vertical shift applied, and rebase the engine on it"""
+        if self.dz != 0:
+            self.src_ds = coreglib.apply_z_shift(self.src_ds, self.dz, createcopy=False)
+        self.reset(self.src_ds)
+        return self.src_ds
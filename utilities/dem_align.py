@@ -2,13 +2,15 @@
 
 #Todo
 #Better outlier removal
-#Check Nuth and Kaab bin median
 #Implement check for empty diff
 
 import sys
 import os
 import argparse
 import subprocess
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from osgeo import gdal, osr
 import numpy as np
@@ -18,6 +20,25 @@ from pygeotools.lib import iolib, warplib, malib, filtlib, geolib
 from demcoreg import coreglib, dem_mask
 from imview.lib import pltlib
 
+import coreg_engine
+from convergence import ConvergenceMonitor, convergence_choices
+import footprint
+import fftcorr
+import nuthlib
+import outlierlib
+import sampling
+import statslib
+import tiltlib
+from result_cache import ResultCache
+from scratch import Scratch
+from sidecar import SidecarStore
+import writelib
+from terrain_cache import TerrainCache
+from profiler import Profiler, null_profiler
+
+#Methods combined in mode 'all' by default, the FFT searches cost about as much as nuth,
+#the brute-force ncc and sad searches are orders of magnitude slower
+default_ensemble_modes = ['nuth'] + fftcorr.fft_modes
 
 
 #Turn off numpy multithreading
@@ -26,22 +47,35 @@ from imview.lib import pltlib
 def getparser():
     parser = argparse.ArgumentParser(description="Perform DEM co-registration using multiple algorithms", \
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('ref_fn', type=str, nargs='?', default = '', help='Reference DEM filename')
+    parser.add_argument('ref_fn', type=str, nargs='?', default = '', \
+            help='Reference DEM filename, directory of reference DEM tiles or footprint index json')
     parser.add_argument('src_fn', type=str, nargs='?', default = '', help='Source DEM filename to be shifted')
-    parser.add_argument('-mode', type=str, default='nuth', choices=['ncc', 'sad', 'nuth', 'none'], \
-            help='Type of co-registration to use')
+    parser.add_argument('-mode', type=str, default='nuth', choices=['ncc', 'sad', 'nuth', 'all', 'none'] + fftcorr.fft_modes, \
+            help='Type of co-registration to use (ncc_fft, ssd_fft: masked FFT search, coarse-to-fine; all: robust average of -ensemble_modes)')
+    parser.add_argument('-ensemble_modes', type=str, nargs='+', default=default_ensemble_modes, \
+            choices=['ncc', 'sad', 'nuth'] + fftcorr.fft_modes, help='Methods run concurrently and combined in mode all')
     parser.add_argument('-mask_list', nargs='+', type=str, default=[], choices=dem_mask.mask_choices, \
             help='Define masks to use to limit reference surfaces for co-registration')
     parser.add_argument('-tiltcorr', action='store_true', \
             help='After preliminary translation, fit polynomial to residual elevation offsets and remove')
     parser.add_argument('-polyorder', type=int, default=1, \
             help='Specify order of polynomial fit') 
+    parser.add_argument('-track_azimuth', type=float, default=None, \
+            help='tiltcorr: along-track direction (degrees clockwise from north), fit terms in along/cross-track coordinates')
+    parser.add_argument('-tilt_along_order', type=int, default=0, \
+            help='tiltcorr: order of additional along-track polynomial terms')
+    parser.add_argument('-tilt_cross_order', type=int, default=0, \
+            help='tiltcorr: order of additional cross-track polynomial terms')
+    parser.add_argument('-tilt_samples', type=int, default=1000000, \
+            help='tiltcorr: maximum number of residual pixels used in the fit')
     parser.add_argument('-tol', type=float, default=0.005, \
             help='When iterative translation magnitude is below this tolerance (meters), break and write out corrected DEM')
     parser.add_argument('-max_offset', type=float, default=100, \
             help='Maximum expected horizontal offset in meters, used to set search range for ncc and sad modes')
     parser.add_argument('-max_dz', type=float, default=100, \
             help='Maximum expected vertical offset in meters, used to filter outliers')
+    parser.add_argument('-outlier_method', type=str, default='exact', choices=outlierlib.outlier_method_choices, \
+            help='Outlier filter: exact median/MAD of the full array (exact), or streaming histogram median/MAD with max_dz applied to |dz| (hist)')
     res_choices = ['min', 'max', 'mean', 'common_scale_factor']
     parser.add_argument('-res', type=str, default='max', choices=res_choices, \
             help='Warp intputs to this resolution') 
@@ -49,25 +83,92 @@ def getparser():
             help='Minimum and maximum surface slope limits to consider')
     parser.add_argument('-max_iter', type=int, default=30, \
             help='Maximum number of iterations, if tol is not reached')
+    parser.add_argument('-convergence', type=str, default='tol', choices=convergence_choices, \
+            help='Stop on step below tol or max_iter (tol), also on predicted remaining error below tol or oscillation (predict), or predict and extrapolate the final shift (accel)')
     parser.add_argument('-outdir', default=None, help='Output directory')
+    parser.add_argument('-warp_engine', type=str, default='warp', choices=coreg_engine.engine_choices, \
+            help='Warp reference once and resample only the shifted source each iteration (warp: GDAL warp, array: sub-pixel shift of cached array)')
+    parser.add_argument('-terrain_cache_px', type=float, default=0.5, \
+            help='Reuse cached slope, aspect and static mask until cumulative source shift exceeds this many pixels')
+    parser.add_argument('-pyramid_levels', type=int, default=0, \
+            help='Number of coarse-to-fine levels (downsampled by 2**level) to converge on before full resolution')
+    parser.add_argument('-pyramid_iter', type=int, default=5, \
+            help='Maximum number of iterations at each pyramid level')
+    parser.add_argument('-shift_method', type=str, default='window', choices=writelib.shift_choices, \
+            help='How to write the shifted output DEM (window: blockwise rewrite, vrt: geotransform/offset VRT, copy: in-memory copy)')
+    parser.add_argument('-out_profile', type=str, default=writelib.default_profile, choices=writelib.profile_choices, \
+            help='GeoTIFF layout for outputs (gtiff: pygeotools defaults, deflate/zstd: tiled and compressed, cog: tiled with overviews)')
+    parser.add_argument('-profile', action='store_true', \
+            help='Record time for each stage and iteration, and the growth of the process memory high-water mark per stage, in the output stats json')
+    parser.add_argument('-trace_fn', type=str, default=None, \
+            help='With -profile, also write stage timings to this Chrome trace json (chrome://tracing, Perfetto)')
+    parser.add_argument('-nuth_solver', type=str, default='coreglib', choices=nuthlib.nuth_solver_choices, \
+            help='Nuth and Kaab fit (binned: fit to aspect bin statistics, coreglib: original curve fit)')
+    parser.add_argument('-nuth_stat', type=str, default='median', choices=nuthlib.nuth_stat_choices, \
+            help='Statistic of dh/tan(slope) in each aspect bin for the binned solver')
+    parser.add_argument('-nuth_stride', type=int, default=1, \
+            help='Use every nth pixel in each dimension for the binned solver')
+    parser.add_argument('-sample_budget', type=int, default=None, \
+            help='nuth mode: estimate offsets from this many stable-terrain pixels, stratified by slope and aspect (e.g. 2000000)')
+    parser.add_argument('-sample_seed', type=int, default=0, help='Random seed for -sample_budget')
+    parser.add_argument('-init_shift', type=str, nargs='+', default=None, \
+            help='Initial shift to apply before iterating: dx dy dz (m), or an earlier _align_stats.json')
+    parser.add_argument('-cache_dir', type=str, default=None, \
+            help='Reuse shift and stats from earlier runs with the same inputs and parameters, stored in this directory')
+    parser.add_argument('-cache_max_entries', type=int, default=1000, help='Maximum number of cached results')
+    parser.add_argument('-cache_max_mb', type=float, default=None, help='Maximum size of cached results (MB)')
+    parser.add_argument('-cache_hash', action='store_true', \
+            help='Identify inputs by content hash instead of size and modification time')
+    parser.add_argument('-sidecar', action='store_true', \
+            help='Store slope, aspect and static mask rasters for the source DEM (in <src>_sidecar) and reuse them in later runs')
+    parser.add_argument('-sidecar_dir', type=str, default=None, \
+            help='Directory for -sidecar rasters, e.g. a shared cache (implies -sidecar)')
+    parser.add_argument('-mem_limit_mb', type=float, default=None, \
+            help='Use memory-mapped scratch files for the final difference map when it would need more than this (MB)')
+    parser.add_argument('-scratch_dir', type=str, default=None, \
+            help='Directory for memory-mapped scratch files (default: system temporary directory)')
     
     return parser
 
-def get_mask(ds, mask_list, dem_fn=None):
+def get_mask(ds, mask_list, dem_fn=None, sidecar=None, src_ds=None):
     #This returns True (1) for areas to mask, False (0) for valid static surfaces
+    if sidecar is not None:
+        #Stored mask for the source DEM, warped to ds with the current shift of src_ds
+        return sidecar.static_mask(ds, src_ds, mask_list)
     static_mask = dem_mask.get_mask(ds, mask_list, dem_fn, writeout=False)
     #return ~(static_mask)
     return static_mask
 
-def outlier_filter(diff, f=3, perc=None, max_dz=100):
+def get_cached(terrain_cache, name, clip_ds, src_ds, params, func):
+    #Look up terrain derivative in cache, computing and storing it on a miss
+    if terrain_cache is None:
+        return func()
+    a = terrain_cache.get(name, clip_ds, src_ds, params)
+    if a is None:
+        a = func()
+        terrain_cache.put(name, clip_ds, src_ds, a, params)
+    else:
+        print("Using cached %s" % name)
+    return a
+
+def outlier_filter(diff, f=3, perc=None, max_dz=100, method='exact', verbose=False):
     print("Removing outliers")
-    print("Initial pixel count:")
-    print(diff.count())
+    if method == 'hist':
+        #Single histogram pass, pixel counts come from the same passes as the filter
+        diff, counts = outlierlib.outlier_filter(diff, f=f, perc=perc, max_dz=max_dz)
+        print("Pixel count: %i initial, %i after absolute dz filter (%0.2f), %i after outlier filter (%0.2f to %0.2f)" % \
+                (counts['initial'], counts['max_dz'], max_dz, counts['final'], counts['range'][0], counts['range'][1]))
+        return diff
+    #Each count() is a full pass over the mask, only done when requested
+    if verbose:
+        print("Initial pixel count:")
+        print(diff.count())
 
     print("Absolute dz filter: %0.2f" % max_dz)
     #Absolute dz filter
     diff = np.ma.masked_greater(diff, max_dz)
-    print(diff.count())
+    if verbose:
+        print(diff.count())
 
     if perc is not None:
         diff = filtlib.perc_fltr(diff, perc)
@@ -75,13 +176,17 @@ def outlier_filter(diff, f=3, perc=None, max_dz=100):
         #diff = filtlib.sigma_fltr(diff, f)
         diff = filtlib.mad_fltr(diff, f)
 
-    print(diff.count())
+    if verbose:
+        print(diff.count())
     return diff
 
-def get_filtered_slope(ds, slope_lim=(0.1, 40)):
+def get_filtered_slope(ds, slope_lim=(0.1, 40), sidecar=None, src_ds=None):
     #Generate slope map
-    print("Computing slope")
-    slope = geolib.gdaldem_mem_ds(ds, processing='slope', returnma=True, computeEdges=False)
+    if sidecar is not None:
+        slope = sidecar.slope(ds, src_ds)
+    else:
+        print("Computing slope")
+        slope = geolib.gdaldem_mem_ds(ds, processing='slope', returnma=True, computeEdges=False)
     #slope_stats = malib.print_stats(slope)
     print("Slope filter: %0.2f - %0.2f" % slope_lim)
     print("Initial count: %i" % slope.count()) 
@@ -89,12 +194,133 @@ def get_filtered_slope(ds, slope_lim=(0.1, 40)):
     print(slope.count())
     return slope
 
+def offset_from_mode(mode, ref_dem, src_dem, diff, slope, aspect, static_mask, src_dem_gt, pad, plot=True, \
+        nuth_opt=None):
+    """
+    Horizontal offset (dx, dy) of the source relative to the reference for a single method.
+    Arrays are not modified, so several methods can run on them concurrently.
+    Returns:
+    - dx, dy (float): Offset in map units, (0, 0) if the method failed.
+    - fig: Method plot, or None.
+    """
+    if nuth_opt is None:
+        nuth_opt = {}
+    fig = None
+    #Default horizntal shift is (0,0)
+    dx = 0
+    dy = 0
+    #Sum of absolute differences
+    if mode == "sad":
+        ref_dem = np.ma.array(ref_dem, mask=static_mask)
+        src_dem = np.ma.array(src_dem, mask=static_mask)
+        m, int_offset, sp_offset = coreglib.compute_offset_sad(ref_dem, src_dem, pad=pad)
+        #Geotransform has negative y resolution, so don't need negative sign
+        #np array is positive down
+        #GDAL coordinates are positive up
+        dx = sp_offset[1]*src_dem_gt[1]
+        dy = sp_offset[0]*src_dem_gt[5]
+    #Normalized cross-correlation of clipped, overlapping areas
+    elif mode == "ncc":
+        ref_dem = np.ma.array(ref_dem, mask=static_mask)
+        src_dem = np.ma.array(src_dem, mask=static_mask)
+        m, int_offset, sp_offset, fig = coreglib.compute_offset_ncc(ref_dem, src_dem, \
+                pad=pad, prefilter=False, plot=plot)
+        dx = sp_offset[1]*src_dem_gt[1]
+        dy = sp_offset[0]*src_dem_gt[5]
+    #Masked NCC or SSD for all offsets at once via FFT, cost does not grow with the search radius
+    elif mode in fftcorr.fft_modes:
+        ref_dem = np.ma.array(ref_dem, mask=static_mask)
+        src_dem = np.ma.array(src_dem, mask=static_mask)
+        m, int_offset, sp_offset, fig = fftcorr.compute_offset_fft(ref_dem, src_dem, pad=pad, \
+                method=mode.split('_')[0], plot=plot)
+        dx = sp_offset[1]*src_dem_gt[1]
+        dy = sp_offset[0]*src_dem_gt[5]
+    #Nuth and Kaab (2011)
+    elif mode == "nuth":
+        #Compute relationship between elevation difference, slope and aspect
+        if nuth_opt.get('solver', 'coreglib') == 'binned':
+            #Fit to aspect bin statistics, single pass over the pixels
+            fit_param, fig = nuthlib.compute_offset_nuth(diff, slope, aspect, stat=nuth_opt.get('stat', 'median'), \
+                    stride=nuth_opt.get('stride', 1), plot=plot)
+        else:
+            fit_param, fig = coreglib.compute_offset_nuth(diff, slope, aspect, plot=plot)
+        if fit_param is None:
+            print("Failed to calculate horizontal shift")
+        else:
+            #fit_param[0] is magnitude of shift vector
+            #fit_param[1] is direction of shift vector
+            #fit_param[2] is mean bias divided by tangent of mean slope
+            #print(fit_param)
+            dx = fit_param[0]*np.sin(np.deg2rad(fit_param[1]))
+            dy = fit_param[0]*np.cos(np.deg2rad(fit_param[1]))
+            med_slope = malib.fast_median(slope)
+            nuth_dz = fit_param[2]*np.tan(np.deg2rad(med_slope))
+            print('Nuth dz: %0.2f' % nuth_dz)
+    else:
+        raise ValueError("Unknown mode: %s" % mode)
+    return dx, dy, fig
+
+def robust_mean_offset(offsets, res, k=2.0):
+    """
+    Weighted mean of (dx, dy) estimates, down-weighting those far from the median estimate.
+    Weights are 1 within k*scale of the median and k*scale/distance beyond, where scale is the
+    NMAD of the distances, but at least a tenth of a pixel.
+    """
+    offsets = np.array(offsets, dtype=float)
+    med = np.median(offsets, axis=0)
+    r = np.hypot(*(offsets - med).T)
+    scale = max(1.4826*np.median(r), 0.1*res)
+    w = np.where(r <= k*scale, 1.0, k*scale/np.maximum(r, 1E-12))
+    return np.sum(offsets*w[:,np.newaxis], axis=0)/w.sum(), w
+
+def ensemble_offset(modes, ref_dem, src_dem, diff, slope, aspect, static_mask, src_dem_gt, pad, res, nuth_opt=None):
+    """
+    Run several offset methods concurrently on a thread pool and combine them with robust_mean_offset.
+    Returns:
+    - dx, dy (float): Combined offset.
+    - info (dict): Estimate, weight and wall time of each method.
+    """
+    def run(mode):
+        t0 = time.perf_counter()
+        #No plots from worker threads, matplotlib is not thread safe
+        dx, dy, fig = offset_from_mode(mode, ref_dem, src_dem, diff, slope, aspect, static_mask, src_dem_gt, pad, \
+                plot=False, nuth_opt=nuth_opt)
+        return {'dx':float(dx), 'dy':float(dy), 'time':time.perf_counter() - t0}
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(modes)) as executor:
+        results = dict(zip(modes, executor.map(run, modes)))
+    (dx, dy), w = robust_mean_offset([(results[m]['dx'], results[m]['dy']) for m in modes], res)
+    for m, wi in zip(modes, w):
+        results[m]['weight'] = float(wi)
+        print("%s: dx=%+0.3fm, dy=%+0.3fm, weight %0.2f (%0.1f s)" % (m, results[m]['dx'], results[m]['dy'], wi, \
+                results[m]['time']))
+    print("Ensemble offset: dx=%+0.3fm, dy=%+0.3fm" % (dx, dy))
+    return dx, dy, {'methods':results, 'dx':float(dx), 'dy':float(dy), 'time':time.perf_counter() - t0}
+
 def compute_offset(ref_dem_ds, src_dem_ds, src_dem_fn, mode='nuth', remove_outliers=True, max_offset=100, \
-        max_dz=100, slope_lim=(0.1, 40), mask_list=['glaciers',], plot=True):
-    #Make sure the input datasets have the same resolution/extent
-    #Use projection of source DEM
-    ref_dem_clip_ds, src_dem_clip_ds = warplib.memwarp_multi([ref_dem_ds, src_dem_ds], \
-            res='max', extent='intersection', t_srs=src_dem_ds, r='cubic')
+        max_dz=100, slope_lim=(0.1, 40), mask_list=['glaciers',], plot=True, engine=None, terrain_cache=None, profiler=None, \
+        nuth_solver='coreglib', nuth_stat='median', nuth_stride=1, ensemble_modes=default_ensemble_modes, info=None, \
+        sidecar=None, outlier_method='exact'):
+    """
+    Estimate the (dx, dy, dz) that aligns src_dem_ds to ref_dem_ds, as in coreglib (minus the src - ref offset).
+    For mode 'all', the methods in ensemble_modes are combined, and each estimate is added to info (dict) if given.
+    Slope, aspect and static mask are read from sidecar (SidecarStore) if given, on TerrainCache misses.
+    """
+    if profiler is None:
+        profiler = null_profiler
+    stage = profiler.start('warp')
+    if engine is not None:
+        #Reference stays on a fixed grid, only the shifted source is resampled
+        ref_dem_clip_ds = engine.ref_ds
+        ref_dem, src_dem, src_dem_clip_ds = engine.clip()
+    else:
+        #Make sure the input datasets have the same resolution/extent
+        #Use projection of source DEM
+        ref_dem_clip_ds, src_dem_clip_ds = warplib.memwarp_multi([ref_dem_ds, src_dem_ds], \
+                res='max', extent='intersection', t_srs=src_dem_ds, r='cubic')
+        ref_dem = iolib.ds_getma(ref_dem_clip_ds, 1)
+        src_dem = iolib.ds_getma(src_dem_clip_ds, 1)
+    profiler.stop(stage)
 
     #Compute size of NCC and SAD search window in pixels
     res = float(geolib.get_res(ref_dem_clip_ds, square=True)[0])
@@ -105,29 +331,39 @@ def compute_offset(ref_dem_ds, src_dem_ds, src_dem_fn, mode='nuth', remove_outli
     #This will be updated geotransform for src_dem
     src_dem_gt = np.array(src_dem_clip_ds.GetGeoTransform())
 
-    #Load the arrays
-    ref_dem = iolib.ds_getma(ref_dem_clip_ds, 1)
-    src_dem = iolib.ds_getma(src_dem_clip_ds, 1)
-
     print("Elevation difference stats for uncorrected input DEMs (src - ref)")
     diff = src_dem - ref_dem
 
-    static_mask = get_mask(src_dem_clip_ds, mask_list, src_dem_fn)
+    stage = profiler.start('mask')
+    static_mask = get_cached(terrain_cache, 'static_mask', src_dem_clip_ds, src_dem_ds, (tuple(mask_list),), \
+            lambda: get_mask(src_dem_clip_ds, mask_list, src_dem_fn, sidecar=sidecar, src_ds=src_dem_ds))
+    profiler.stop(stage)
     diff = np.ma.array(diff, mask=static_mask)
 
     if diff.count() == 0:
         sys.exit("No overlapping, unmasked pixels shared between input DEMs")
 
     if remove_outliers:
-        diff = outlier_filter(diff, f=3, max_dz=max_dz)
+        stage = profiler.start('outlier_filter')
+        diff = outlier_filter(diff, f=3, max_dz=max_dz, method=outlier_method)
+        profiler.stop(stage)
 
     #Want to use higher quality DEM, should determine automatically from original res/count
     #slope = get_filtered_slope(ref_dem_clip_ds, slope_lim=slope_lim)
-    slope = get_filtered_slope(src_dem_clip_ds, slope_lim=slope_lim)
+    stage = profiler.start('slope')
+    slope = get_cached(terrain_cache, 'slope', src_dem_clip_ds, src_dem_ds, (tuple(slope_lim),), \
+            lambda: get_filtered_slope(src_dem_clip_ds, slope_lim=slope_lim, sidecar=sidecar, src_ds=src_dem_ds))
+    profiler.stop(stage)
 
-    print("Computing aspect")
     #aspect = geolib.gdaldem_mem_ds(ref_dem_clip_ds, processing='aspect', returnma=True, computeEdges=False)
-    aspect = geolib.gdaldem_mem_ds(src_dem_clip_ds, processing='aspect', returnma=True, computeEdges=False)
+    def _aspect():
+        if sidecar is not None:
+            return sidecar.aspect(src_dem_clip_ds, src_dem_ds)
+        print("Computing aspect")
+        return geolib.gdaldem_mem_ds(src_dem_clip_ds, processing='aspect', returnma=True, computeEdges=False)
+    stage = profiler.start('aspect')
+    aspect = get_cached(terrain_cache, 'aspect', src_dem_clip_ds, src_dem_ds, (), _aspect)
+    profiler.stop(stage)
 
     ref_dem_clip_ds = None
     src_dem_clip_ds = None
@@ -143,6 +379,7 @@ def compute_offset(ref_dem_ds, src_dem_ds, src_dem_fn, mode='nuth', remove_outli
     print("Filtered difference map")
     diff_stats = malib.print_stats(diff)
     dz = diff_stats[5]
+    nuth_opt = {'solver':nuth_solver, 'stat':nuth_stat, 'stride':nuth_stride}
 
     print("Computing sub-pixel offset between DEMs using mode: %s" % mode)
 
@@ -153,54 +390,142 @@ def compute_offset(ref_dem_ds, src_dem_ds, src_dem_fn, mode='nuth', remove_outli
     dx = 0
     dy = 0
 
-    #Sum of absolute differences
-    if mode == "sad":
-        ref_dem = np.ma.array(ref_dem, mask=static_mask)
-        src_dem = np.ma.array(src_dem, mask=static_mask)
-        m, int_offset, sp_offset = coreglib.compute_offset_sad(ref_dem, src_dem, pad=pad)
-        #Geotransform has negative y resolution, so don't need negative sign
-        #np array is positive down
-        #GDAL coordinates are positive up
-        dx = sp_offset[1]*src_dem_gt[1]
-        dy = sp_offset[0]*src_dem_gt[5]
-    #Normalized cross-correlation of clipped, overlapping areas
-    elif mode == "ncc":
-        ref_dem = np.ma.array(ref_dem, mask=static_mask)
-        src_dem = np.ma.array(src_dem, mask=static_mask)
-        m, int_offset, sp_offset, fig = coreglib.compute_offset_ncc(ref_dem, src_dem, \
-                pad=pad, prefilter=False, plot=plot)
-        dx = sp_offset[1]*src_dem_gt[1]
-        dy = sp_offset[0]*src_dem_gt[5]
-    #Nuth and Kaab (2011)
-    elif mode == "nuth":
-        #Compute relationship between elevation difference, slope and aspect
-        fit_param, fig = coreglib.compute_offset_nuth(diff, slope, aspect, plot=plot)
-        if fit_param is None:
-            print("Failed to calculate horizontal shift")
-        else:
-            #fit_param[0] is magnitude of shift vector
-            #fit_param[1] is direction of shift vector
-            #fit_param[2] is mean bias divided by tangent of mean slope
-            #print(fit_param)
-            dx = fit_param[0]*np.sin(np.deg2rad(fit_param[1]))
-            dy = fit_param[0]*np.cos(np.deg2rad(fit_param[1]))
-            med_slope = malib.fast_median(slope)
-            nuth_dz = fit_param[2]*np.tan(np.deg2rad(med_slope))
-            print('Median dz: %0.2f\nNuth dz: %0.2f' % (dz, nuth_dz))
-            #dz = nuth_dz
-    elif mode == "all":
-        print("Not yet implemented")
-        #Want to compare all methods, average offsets
-        #m, int_offset, sp_offset = coreglib.compute_offset_sad(ref_dem, src_dem)
-        #m, int_offset, sp_offset = coreglib.compute_offset_ncc(ref_dem, src_dem)
+    stage = profiler.start('fit')
+    if mode == "all":
+        #Run methods concurrently on the same arrays, numpy/GDAL work releases the GIL
+        dx, dy, ensemble = ensemble_offset(ensemble_modes, ref_dem, src_dem, diff, slope, aspect, static_mask, \
+                src_dem_gt, pad, res, nuth_opt=nuth_opt)
+        if info is not None:
+            info.update(ensemble)
     elif mode == "none":
         print("Skipping alignment, writing out DEM with median bias over static surfaces removed")
         dst_fn = outprefix+'_med%0.1f.tif' % dz
-        iolib.writeGTiff(src_dem_orig + dz, dst_fn, src_dem_ds)
+        writelib.write_ma(src_dem_orig + dz, dst_fn, src_dem_ds)
         sys.exit()
+    else:
+        dx, dy, fig = offset_from_mode(mode, ref_dem, src_dem, diff, slope, aspect, static_mask, src_dem_gt, pad, \
+                plot=plot, nuth_opt=nuth_opt)
+    profiler.stop(stage)
     #Note: minus signs here since we are computing dz=(src-ref), but adjusting src
     return -dx, -dy, -dz, static_mask, fig
 
+def sampled_offset(samples, dx_total, dy_total, dz_total, max_dz=100, nuth_stat='median', outlier_method='exact'):
+    """
+    Nuth and Kaab offset from a sampling.SampleSet at the current cumulative shift.
+    Returns the incremental (dx, dy, dz) with the same sign convention as compute_offset, and the fit plot.
+    """
+    diff = samples.diff(dx_total, dy_total, dz_total)
+    diff = outlier_filter(diff, f=3, max_dz=max_dz, method=outlier_method)
+    if diff.count() == 0:
+        sys.exit("No valid samples shared between input DEMs")
+    dz = float(np.ma.median(diff))
+    print("Sample median dz: %0.3f (%i samples)" % (dz, diff.count()))
+    dx = 0
+    dy = 0
+    fit_param, fig = nuthlib.compute_offset_nuth(diff, samples.slope, samples.aspect, stat=nuth_stat, plot=True)
+    if fit_param is None:
+        print("Failed to calculate horizontal shift")
+    else:
+        dx = fit_param[0]*np.sin(np.deg2rad(fit_param[1]))
+        dy = fit_param[0]*np.cos(np.deg2rad(fit_param[1]))
+    return -dx, -dy, -dz, fig
+
+def load_init_shift(init_shift):
+    """Return (dx, dy, dz) from a sequence, or from the 'shift' of an earlier _align_stats.json"""
+    if isinstance(init_shift, (list, tuple)) and len(init_shift) == 1:
+        init_shift = init_shift[0]
+    if isinstance(init_shift, str):
+        with open(init_shift) as f:
+            shift = json.load(f)['shift']
+        return shift['dx'], shift['dy'], shift['dz']
+    dx, dy, dz = [float(x) for x in init_shift]
+    return dx, dy, dz
+
+def pyramid_factors(levels):
+    #Accept number of levels or explicit list of downsampling factors
+    if not levels:
+        return []
+    if isinstance(levels, int):
+        return [2**i for i in range(levels, 0, -1)]
+    return sorted(levels, reverse=True)
+
+def pyramid_shift(ref_dem_fn, src_dem_fn, res, local_srs, levels, mode='nuth', tol=0.02, max_iter=5, \
+        max_offset=100, init_shift=(0, 0, 0), **kwargs):
+    """
+    Coarse-to-fine preliminary alignment on downsampled copies of the input DEMs.
+    Each level warps from the original files, so GDAL uses existing overviews where available,
+    otherwise the downsampled grid is built in memory with average resampling.
+    Parameters:
+    - ref_dem_fn (str): Reference DEM filename.
+    - src_dem_fn (str): Source DEM filename.
+    - res (float): Full coregistration resolution (m).
+    - local_srs (osr.SpatialReference): Coordinate system for coregistration.
+    - levels (int or list): Number of levels, or list of downsampling factors.
+    - tol (float): Tolerance at full resolution, scaled by the downsampling factor at each level.
+    - max_iter (int): Maximum number of iterations at each level.
+    - init_shift (tuple): Starting (dx, dy, dz), included in the returned totals.
+    - kwargs: Additional arguments for compute_offset (mask_list, max_dz, slope_lim, outlier_method).
+    Returns:
+    - dx_total, dy_total, dz_total (float): Cumulative shift from init_shift and all levels.
+    """
+    #In-memory VRTs so the source geotransform can be updated without touching the file
+    ref_dem_vrt = gdal.Translate('', ref_dem_fn, format='VRT')
+    src_dem_vrt = gdal.Translate('', src_dem_fn, format='VRT')
+    dx_total, dy_total, dz_total = init_shift
+    src_dem_vrt.SetGeoTransform(writelib.shifted_gt(src_dem_vrt, dx_total, dy_total))
+    for f in pyramid_factors(levels):
+        lvl_res = res*f
+        print("\n*** Pyramid level %ix (%0.2f m) ***" % (f, lvl_res))
+        ref_lvl_ds = warplib.memwarp_multi([ref_dem_vrt, src_dem_vrt], res=lvl_res, extent='intersection', \
+                t_srs=local_srs, r='average')[0]
+        engine = coreg_engine.WarpOnceEngine(ref_lvl_ds, src_dem_vrt, method='warp', r='average')
+        #Horizontal shift from previous levels is already in the VRT geotransform
+        engine.dz = dz_total
+        n = 1
+        while True:
+            dx, dy, dz, static_mask, fig = compute_offset(ref_lvl_ds, engine.src_ds, src_dem_fn, mode, \
+                    max_offset=max_offset, plot=False, engine=engine, **kwargs)
+            engine.apply_shift(dx, dy, dz)
+            dx_total += dx
+            dy_total += dy
+            dz_total += dz
+            print("Level %ix iteration %i cumulative offset: dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm" % \
+                    (f, n, dx_total, dy_total, dz_total))
+            dm = np.sqrt(dx**2 + dy**2 + dz**2)
+            dm_total = np.sqrt(dx_total**2 + dy_total**2 + dz_total**2)
+            if dm_total > max_offset:
+                sys.exit("Total offset exceeded specified max_offset (%0.2f m). Consider increasing -max_offset argument" % max_offset)
+            n += 1
+            if n > max_iter or dm < tol*f:
+                break
+        engine = None
+        ref_lvl_ds = None
+    return dx_total, dy_total, dz_total
+
+def cached_shift(align_stats, src_dem_fn, outprefix, mode, write_align=True, shift_method='window', out_profile=None):
+    """
+    Return get_shift outputs from a cached result, without iterating.
+    The shifted DEM and stats json are regenerated in the current output directory if missing.
+    """
+    shift = align_stats['shift']
+    dx_total, dy_total, dz_total = shift['dx'], shift['dy'], shift['dz']
+    print("Using cached shift: dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm" % (dx_total, dy_total, dz_total))
+    xyz_shift_str_cum_fn = '_%s_x%+0.2f_y%+0.2f_z%+0.2f' % (mode, dx_total, dy_total, dz_total)
+    align_fn = None
+    if write_align:
+        align_fn = outprefix + '%s_align.tif' % xyz_shift_str_cum_fn
+        if not os.path.exists(align_fn):
+            src_dem_ds = gdal.Open(src_dem_fn)
+            writelib.write_shifted(src_dem_ds, align_fn, dx_total, dy_total, dz_total, \
+                    method='window' if shift_method == 'copy' else shift_method, profile=out_profile)
+            src_dem_ds = None
+    align_stats_fn = outprefix + '%s_align_stats.json' % xyz_shift_str_cum_fn
+    if not os.path.exists(align_stats_fn):
+        align_stats = dict(align_stats, align_fn=align_fn)
+        with open(align_stats_fn, 'w') as f:
+            json.dump(align_stats, f)
+    return align_fn, [dx_total, dy_total, dz_total]
+
 def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs):
     #parser = getparser()
     #args = parser.parse_args()
@@ -213,12 +538,45 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
     mask_list = kwargs.get('mask_list', [])
     max_offset = kwargs.get('max_offset', 100)
     max_dz = kwargs.get('max_dz', 100)
+    outlier_method = kwargs.get('outlier_method', 'exact')
     slope_lim = kwargs.get('slope_lim', (0, 50))
     tiltcorr = kwargs.get('tiltcorr', False)
     polyorder = kwargs.get('polyorder', 1)
+    track_azimuth = kwargs.get('track_azimuth', None)
+    tilt_along_order = kwargs.get('tilt_along_order', 0)
+    tilt_cross_order = kwargs.get('tilt_cross_order', 0)
+    tilt_samples = kwargs.get('tilt_samples', 1000000)
     
     max_iter = kwargs.get('max_iter', 30)
     tol = kwargs.get('tol', 0.005)
+    convergence = kwargs.get('convergence', 'tol')
+    warp_engine = kwargs.get('warp_engine', 'warp')
+    terrain_cache_px = kwargs.get('terrain_cache_px', 0.5)
+    pyramid_levels = kwargs.get('pyramid_levels', 0)
+    pyramid_iter = kwargs.get('pyramid_iter', 5)
+    profile = kwargs.get('profile', False)
+    trace_fn = kwargs.get('trace_fn', None)
+    init_shift = kwargs.get('init_shift', None)
+    if init_shift is not None:
+        init_shift = load_init_shift(init_shift)
+    nuth_solver = kwargs.get('nuth_solver', 'coreglib')
+    nuth_stat = kwargs.get('nuth_stat', 'median')
+    nuth_stride = kwargs.get('nuth_stride', 1)
+    ensemble_modes = kwargs.get('ensemble_modes', default_ensemble_modes)
+    sample_budget = kwargs.get('sample_budget', None)
+    sample_seed = kwargs.get('sample_seed', 0)
+    mem_limit_mb = kwargs.get('mem_limit_mb', None)
+    sidecar_dir = kwargs.get('sidecar_dir', None)
+    use_sidecar = kwargs.get('sidecar', False) or sidecar_dir is not None
+    scratch_dir = kwargs.get('scratch_dir', None)
+    #Set False when the caller applies the shift itself (e.g., in-memory pipeline)
+    write_align = kwargs.get('write_align', True)
+    shift_method = kwargs.get('shift_method', 'window')
+    out_profile = kwargs.get('out_profile', writelib.default_profile)
+    cache_dir = kwargs.get('cache_dir', None)
+    cache_max_entries = kwargs.get('cache_max_entries', 1000)
+    cache_max_mb = kwargs.get('cache_max_mb', None)
+    cache_hash = kwargs.get('cache_hash', False)
 
     min_dx = tol
     min_dy = tol
@@ -238,6 +596,10 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    #Reference can be a tile directory or footprint index, only overlapping tiles are used
+    #Fails here, before any warping, if the source does not intersect the reference
+    ref_dem_fn = footprint.resolve_reference(ref_dem_fn, src_dem_fn, outdir)
+
     outprefix = '%s_%s' % (os.path.splitext(os.path.split(src_dem_fn)[-1])[0], \
             os.path.splitext(os.path.split(ref_dem_fn)[-1])[0])
     outprefix = os.path.join(outdir, outprefix)
@@ -249,6 +611,24 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
     print("Tolerance: %0.3f" % tol)
     print("Max iterations: %i" % max_iter)
     print("Slope limits: %0.2f - %0.2f" % slope_lim)
+
+    #Previous result for identical inputs and parameters
+    #Tilt correction is not a pure shift, so those runs are not cached
+    result_cache = None
+    if cache_dir is not None and not tiltcorr:
+        max_bytes = cache_max_mb*1024**2 if cache_max_mb is not None else None
+        result_cache = ResultCache(cache_dir, max_entries=cache_max_entries, max_bytes=max_bytes, hash_inputs=cache_hash)
+        params = dict(kwargs, mode=mode, res=res, mask_list=mask_list, max_offset=max_offset, max_dz=max_dz, \
+                slope_lim=slope_lim, max_iter=max_iter, tol=tol, warp_engine=warp_engine, \
+                terrain_cache_px=terrain_cache_px, pyramid_levels=pyramid_levels, pyramid_iter=pyramid_iter, \
+                init_shift=init_shift, nuth_solver=nuth_solver, nuth_stat=nuth_stat, nuth_stride=nuth_stride, \
+                ensemble_modes=list(ensemble_modes) if mode == 'all' else None, \
+                sample_budget=sample_budget, sample_seed=sample_seed, sidecar=use_sidecar, \
+                outlier_method=outlier_method, convergence=convergence)
+        cache_key = result_cache.make_key(ref_dem_fn, src_dem_fn, params)
+        align_stats = result_cache.get(cache_key)
+        if align_stats is not None:
+            return cached_shift(align_stats, src_dem_fn, outprefix, mode, write_align, shift_method, out_profile)
     src_dem_ds = gdal.Open(src_dem_fn)
     ref_dem_ds = gdal.Open(ref_dem_fn)
 
@@ -302,6 +682,43 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
     print("Source DEM res: %0.2f" % src_dem_res)
     print("Resolution for coreg: %s (%0.2f m)\n" % (res, res))
 
+    #Warp the reference once, subsequent iterations only resample the shifted source
+    engine = None
+    if warp_engine is not None:
+        print("Warp engine: %s" % warp_engine)
+        engine = coreg_engine.WarpOnceEngine(ref_dem_ds, src_dem_ds_align, method=warp_engine)
+
+    #Slope, aspect and static mask are reused until the source has moved by terrain_cache_px
+    terrain_cache = None
+    if terrain_cache_px is not None:
+        terrain_cache = TerrainCache(max_shift_px=terrain_cache_px)
+
+    #Stored slope, aspect and static mask of the source DEM, reused across runs
+    sidecar = None
+    if use_sidecar:
+        sidecar = SidecarStore(src_dem_fn, sidecar_dir)
+        sidecar.bind(src_dem_ds_align)
+
+    #Stage timings and memory high-water mark, no-op unless requested
+    profiler = Profiler(enabled=profile)
+
+    #Full-resolution intermediates of the final stage, disk-backed above the memory ceiling
+    scratch = Scratch(scratch_dir, mem_limit=mem_limit_mb*1024**2 if mem_limit_mb is not None else None)
+
+    #Per-method estimates for each iteration in mode 'all'
+    ensemble_info = []
+    #Stop reason and predicted remaining error for each iteration, one monitor per pass
+    monitor = ConvergenceMonitor(tol, max_iter, method=convergence)
+    convergence_info = []
+
+    #Fixed stable-terrain sample for the Nuth and Kaab iterations, drawn before any shift is applied
+    samples = None
+    if sample_budget and mode == 'nuth':
+        with profiler.stage('sample'):
+            samples = sampling.SampleSet(ref_dem_ds, src_dem_ds_align, get_mask(src_dem_ds_align, mask_list, src_dem_fn, \
+                    sidecar=sidecar, src_ds=src_dem_ds_align), \
+                    budget=sample_budget, slope_lim=slope_lim, seed=sample_seed)
+
     #Iteration number
     n = 1
     #Cumulative offsets
@@ -309,11 +726,49 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
     dy_total = 0
     dz_total = 0
 
+    #Start from a prior estimate, e.g. the shift of an earlier survey of the same site
+    #The prior counts toward the cumulative total, including the max_offset check
+    if init_shift is not None:
+        dx_total, dy_total, dz_total = init_shift
+        print("Initial shift: dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm\n" % (dx_total, dy_total, dz_total))
+
+    #Converge on downsampled DEMs first, so full resolution only needs a couple of iterations
+    if pyramid_levels:
+        stage = profiler.start('pyramid')
+        dx_total, dy_total, dz_total = pyramid_shift(ref_dem_fn, src_dem_fn, res, local_srs, pyramid_levels, \
+                mode=mode, tol=tol, max_iter=pyramid_iter, max_offset=max_offset, mask_list=mask_list, \
+                max_dz=max_dz, slope_lim=slope_lim, init_shift=(dx_total, dy_total, dz_total), \
+                nuth_solver=nuth_solver, nuth_stat=nuth_stat, nuth_stride=nuth_stride, ensemble_modes=ensemble_modes, \
+                outlier_method=outlier_method)
+        profiler.stop(stage)
+        print("\nPyramid offset: dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm\n" % (dx_total, dy_total, dz_total))
+
+    if dx_total or dy_total or dz_total:
+        if engine is not None:
+            engine.apply_shift(dx_total, dy_total, dz_total)
+        else:
+            src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx_total, dy_total, createcopy=False)
+            src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz_total, createcopy=False)
+
     #Now iteratively update geotransform and vertical shift
     while True:
         print("*** Iteration %i ***" % n)
-        dx, dy, dz, static_mask, fig = compute_offset(ref_dem_ds, src_dem_ds_align, src_dem_fn, mode, max_offset, \
-                mask_list=mask_list, max_dz=max_dz, slope_lim=slope_lim, plot=True)
+        profiler.set_iteration(n)
+        info = {'iter':n}
+        if samples is not None:
+            #Samples interpolated at the cumulative shift, no full-raster work until the final diff
+            with profiler.stage('fit'):
+                dx, dy, dz, fig = sampled_offset(samples, dx_total, dy_total, dz_total, max_dz=max_dz, \
+                        nuth_stat=nuth_stat, outlier_method=outlier_method)
+            static_mask = None
+        else:
+            dx, dy, dz, static_mask, fig = compute_offset(ref_dem_ds, src_dem_ds_align, src_dem_fn, mode, \
+                    max_offset=max_offset, mask_list=mask_list, max_dz=max_dz, slope_lim=slope_lim, plot=True, \
+                    engine=engine, terrain_cache=terrain_cache, profiler=profiler, nuth_solver=nuth_solver, \
+                    nuth_stat=nuth_stat, nuth_stride=nuth_stride, ensemble_modes=ensemble_modes, info=info, \
+                    sidecar=sidecar, outlier_method=outlier_method)
+        if mode == 'all':
+            ensemble_info.append(info)
         xyz_shift_str_iter = "dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm" % (dx, dy, dz)
         print("Incremental offset: %s" % xyz_shift_str_iter)
 
@@ -335,24 +790,44 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
                 fig.gca().set_title("Incremental: %s\nCumulative: %s" % (xyz_shift_str_iter, xyz_shift_str_cum))
                 fig.savefig(dst_fn, dpi=300)
 
-        #Apply the horizontal shift to the original dataset
-        src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
-        #Should 
-        src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+        stage = profiler.start('apply_shift')
+        if engine is not None:
+            #Update geotransform, vertical shift is applied when the source is resampled
+            engine.apply_shift(dx, dy, dz)
+        else:
+            #Apply the horizontal shift to the original dataset
+            src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
+            #Should 
+            src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+        profiler.stop(stage)
 
         n += 1
         print("\n")
         #If magnitude of shift in all directions is less than tol
         #if n > max_iter or (abs(dx) <= min_dx and abs(dy) <= min_dy and abs(dz) <= min_dz):
-        #If magnitude of shift is less than tol
-        dm = np.sqrt(dx**2 + dy**2 + dz**2)
         dm_total = np.sqrt(dx_total**2 + dy_total**2 + dz_total**2)
 
         if dm_total > max_offset:
             sys.exit("Total offset exceeded specified max_offset (%0.2f m). Consider increasing -max_offset argument" % max_offset)
 
         #Stop iteration
-        if n > max_iter or dm < tol:
+        stop_reason = monitor.update(n - 1, (dx, dy, dz), (dx_total, dy_total, dz_total))
+        if stop_reason is not None:
+            print("Stopping after iteration %i: %s" % (n - 1, stop_reason))
+            #Extrapolated totals are checked against max_offset like every iteration
+            dx_final, dy_final, dz_final = monitor.final_shift(max_total=max_offset)
+            if monitor.extrapolated:
+                #Apply the extrapolated remainder, as for an extra iteration
+                dx, dy, dz = dx_final - dx_total, dy_final - dy_total, dz_final - dz_total
+                if engine is not None:
+                    engine.apply_shift(dx, dy, dz)
+                else:
+                    src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
+                    src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+                dx_total, dy_total, dz_total = dx_final, dy_final, dz_final
+                dm_total = np.sqrt(dx_total**2 + dy_total**2 + dz_total**2)
+                xyz_shift_str_cum = "dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm" % (dx_total, dy_total, dz_total)
+                xyz_shift_str_cum_fn = '_%s_x%+0.2f_y%+0.2f_z%+0.2f' % (mode, dx_total, dy_total, dz_total)
 
             if fig is not None:
                 dst_fn = outprefix + '_%s_iter%02i_plot.png' % (mode, n)
@@ -361,79 +836,95 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
                 fig.savefig(dst_fn, dpi=300)
 
             #Compute final elevation difference
-            if True:
-                ref_dem_clip_ds_align, src_dem_clip_ds_align = warplib.memwarp_multi([ref_dem_ds, src_dem_ds_align], \
-                        res=res, extent='intersection', t_srs=local_srs, r='cubic')
-                ref_dem_align = iolib.ds_getma(ref_dem_clip_ds_align, 1)
-                src_dem_align = iolib.ds_getma(src_dem_clip_ds_align, 1)
-                ref_dem_clip_ds_align = None
-
-                diff_align = src_dem_align - ref_dem_align
+            profiler.set_iteration(None)
+            with profiler.stage('final_diff'):
+                if engine is not None:
+                    ref_dem_align, src_dem_align, src_dem_clip_ds_align = engine.clip()
+                else:
+                    ref_dem_clip_ds_align, src_dem_clip_ds_align = warplib.memwarp_multi([ref_dem_ds, src_dem_ds_align], \
+                            res=res, extent='intersection', t_srs=local_srs, r='cubic')
+                    ref_dem_align = iolib.ds_getma(ref_dem_clip_ds_align, 1)
+                    src_dem_align = iolib.ds_getma(src_dem_clip_ds_align, 1)
+                    ref_dem_clip_ds_align = None
+
+                scratch.plan(ref_dem_align.shape)
+                diff_align = scratch.masked_subtract(src_dem_align, ref_dem_align, 'diff_align')
                 src_dem_align = None
                 ref_dem_align = None
 
                 #Get updated, final mask
-                static_mask_final = get_mask(src_dem_clip_ds_align, mask_list, src_dem_fn)
-                static_mask_final = np.logical_or(np.ma.getmaskarray(diff_align), static_mask_final)
+                static_mask_final = get_cached(terrain_cache, 'static_mask', src_dem_clip_ds_align, src_dem_ds_align, \
+                        (tuple(mask_list),), lambda: get_mask(src_dem_clip_ds_align, mask_list, src_dem_fn, \
+                        sidecar=sidecar, src_ds=src_dem_ds_align))
+                static_mask_final = scratch.logical_or(np.ma.getmaskarray(diff_align), static_mask_final, 'static_mask_final')
                 
                 #Final stats, before outlier removal
-                diff_align_compressed = diff_align[~static_mask_final]
-                diff_align_stats = malib.get_stats_dict(diff_align_compressed, full=True)
+                #Masked view instead of a compressed copy of the valid pixels
+                diff_align_stats = statslib.diff_stats(np.ma.array(diff_align, mask=static_mask_final, keep_mask=False))
 
                 #Prepare filtered version for tiltcorr fit
                 diff_align_filt = np.ma.array(diff_align, mask=static_mask_final)
-                diff_align_filt = outlier_filter(diff_align_filt, f=3, max_dz=max_dz)
-                #diff_align_filt = outlier_filter(diff_align_filt, perc=(12.5, 87.5), max_dz=max_dz)
-                slope = get_filtered_slope(src_dem_clip_ds_align)
+                diff_align_filt = outlier_filter(diff_align_filt, f=3, max_dz=max_dz, method=outlier_method)
+                #diff_align_filt = outlier_filter(diff_align_filt, perc=(12.5, 87.5), max_dz=max_dz, method=outlier_method)
+                slope = get_filtered_slope(src_dem_clip_ds_align, sidecar=sidecar, src_ds=src_dem_ds_align)
                 diff_align_filt = np.ma.array(diff_align_filt, mask=np.ma.getmaskarray(slope))
-                diff_align_filt_stats = malib.get_stats_dict(diff_align_filt, full=True)
+                slope = None
+                diff_align_filt_stats = statslib.diff_stats(diff_align_filt)
 
             #Fit 2D polynomial to residuals and remove
-            #To do: add support for along-track and cross-track artifacts
             if tiltcorr and not tiltcorr_done:
                 print("\n************")
                 print("Calculating 'tiltcorr' 2D polynomial fit to residuals with order %i" % polyorder)
                 print("************\n")
+                stage = profiler.start('tiltcorr')
                 gt = src_dem_clip_ds_align.GetGeoTransform()
 
                 #Need to apply the mask here, so we're only fitting over static surfaces
-                #Note that the origmask=False will compute vals for all x and y indices, which is what we want
-                vals, resid, coeff = geolib.ma_fitpoly(diff_align_filt, order=polyorder, gt=gt, perc=(0,100), origmask=False)
-                #vals, resid, coeff = geolib.ma_fitplane(diff_align_filt, gt, perc=(12.5, 87.5), origmask=False)
-
-                #Should write out coeff or grid with correction 
+                #Fit on a subsample, the model is evaluated block by block on any grid
+                tilt = tiltlib.fit_tilt(diff_align_filt, gt, order=polyorder, along_order=tilt_along_order, \
+                        cross_order=tilt_cross_order, azimuth=track_azimuth, max_samples=tilt_samples)
 
-                vals_stats = malib.get_stats_dict(vals)
+                #Stats of the correction over the clipped intersection, from a decimated grid
+                valgrid = tilt.preview(gt, src_dem_clip_ds_align.RasterXSize, src_dem_clip_ds_align.RasterYSize)
+                vals_stats = malib.get_stats_dict(valgrid)
 
                 #Want to have max_tilt check here
                 #max_tilt = 4.0 #m
                 #Should do percentage
                 #vals.ptp() > max_tilt
 
-                #Note: dimensions of ds and vals will be different as vals are computed for clipped intersection
-                #Need to recompute planar offset for full src_dem_ds_align extent and apply
-                xgrid, ygrid = geolib.get_xy_grids(src_dem_ds_align)
-                valgrid = geolib.polyval2d(xgrid, ygrid, coeff) 
-                #For results of ma_fitplane
-                #valgrid = coeff[0]*xgrid + coeff[1]*ygrid + coeff[2]
-                src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, -valgrid, createcopy=False)
+                #Note: dimensions of ds and diff_align are different, diff_align is for clipped intersection
+                #Correction is evaluated for the full src_dem_ds_align extent and applied window by window
+                if engine is not None:
+                    src_dem_ds_align = engine.get_src_ds()
+                tilt.apply_ds(src_dem_ds_align)
+                if engine is not None:
+                    engine.reset(src_dem_ds_align)
+                #Source elevations changed, cached slope and aspect are stale
+                if terrain_cache is not None:
+                    terrain_cache.clear()
+                #Sidecar layers are kept, the smooth tilt surface leaves slope and aspect effectively unchanged
+                #Samples hold the uncorrected source, remaining iterations use the full rasters
+                samples = None
+                profiler.stop(stage)
 
                 if True:
                     print("Creating plot of polynomial fit to residuals")
                     fig, axa = plt.subplots(1,2, figsize=(8, 4))
-                    dz_clim = malib.calcperc_sym(vals, (2, 98))
+                    dz_clim = malib.calcperc_sym(valgrid, (2, 98))
                     ax = pltlib.iv(diff_align_filt, ax=axa[0], cmap='RdBu', clim=dz_clim, \
                             label='Residual dz (m)', scalebar=False)
                     ax = pltlib.iv(valgrid, ax=axa[1], cmap='RdBu', clim=dz_clim, \
-                            label='Polyfit dz (m)', ds=src_dem_ds_align)
+                            label='Polyfit dz (m)', scalebar=False)
                     #if tiltcorr:
                         #xyz_shift_str_cum_fn += "_tiltcorr"
                     tiltcorr_fig_fn = outprefix + '%s_polyfit.png' % xyz_shift_str_cum_fn
                     print("Writing out figure: %s\n" % tiltcorr_fig_fn)
                     fig.savefig(tiltcorr_fig_fn, dpi=300)
+                valgrid = None
 
                 print("Applying tilt correction to difference map")
-                diff_align -= vals
+                tilt.subtract_ma(diff_align, gt)
 
                 #Should iterate until tilts are below some threshold
                 #For now, only do one tiltcorr
@@ -441,27 +932,74 @@ def get_shift(ref_dem_fn, src_dem_fn, outdir, mode ='nuth', res ='max', **kwargs
                 #Now use original tolerance, and number of iterations 
                 tol = tol
                 max_iter = n + max_iter
+                #Shift history before the tilt correction says nothing about the next pass
+                convergence_info.append(monitor.to_dict())
+                monitor = ConvergenceMonitor(tol, max_iter, method=convergence)
             else:
                 break
     
-    align_fn = outprefix + '%s_align.tif' % xyz_shift_str_cum_fn
-    print("Writing out shifted src_dem with median vertical offset removed: %s" % align_fn)
-    #Open original uncorrected dataset at native resolution
-    src_dem_ds = gdal.Open(src_dem_fn)
-    src_dem_ds_align = iolib.mem_drv.CreateCopy('', src_dem_ds, 0)
-    #Apply final horizontal and vertial shift to the original dataset
-    #Note: potentially issues if we used a different projection during coregistration!
-    src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx_total, dy_total, createcopy=False)
-    src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz_total, createcopy=False)
-    if tiltcorr:
-        xgrid, ygrid = geolib.get_xy_grids(src_dem_ds_align)
-        valgrid = geolib.polyval2d(xgrid, ygrid, coeff) 
-        #For results of ma_fitplane
-        #valgrid = coeff[0]*xgrid + coeff[1]*ygrid + coeff[2]
-        src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, -valgrid, createcopy=False)
-    #Might be cleaner way to write out MEM ds directly to disk
-    src_dem_full_align = iolib.ds_getma(src_dem_ds_align)
-    iolib.writeGTiff(src_dem_full_align, align_fn, src_dem_ds_align)
+    #Final difference maps are only needed for the stats
+    diff_align = diff_align_filt = static_mask_final = None
+    scratch.cleanup()
+
+    align_fn = None
+    if write_align:
+        align_fn = outprefix + '%s_align.tif' % xyz_shift_str_cum_fn
+        print("Writing out shifted src_dem with median vertical offset removed: %s" % align_fn)
+        stage = profiler.start('write')
+        #Open original uncorrected dataset at native resolution
+        src_dem_ds = gdal.Open(src_dem_fn)
+        if shift_method != 'copy' and tiltcorr:
+            #Tilt varies across the DEM, so it is evaluated and removed block by block while writing
+            tiltlib.write_corrected(src_dem_ds, align_fn, dx_total, dy_total, dz_total, tilt, profile=out_profile)
+        elif shift_method != 'copy':
+            #Origin offset plus constant, no full-raster copies
+            writelib.write_shifted(src_dem_ds, align_fn, dx_total, dy_total, dz_total, method=shift_method, \
+                    profile=out_profile)
+        else:
+            src_dem_ds_align = iolib.mem_drv.CreateCopy('', src_dem_ds, 0)
+            #Apply final horizontal and vertial shift to the original dataset
+            #Note: potentially issues if we used a different projection during coregistration!
+            src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx_total, dy_total, createcopy=False)
+            src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz_total, createcopy=False)
+            if tiltcorr:
+                tilt.apply_ds(src_dem_ds_align)
+            #Might be cleaner way to write out MEM ds directly to disk
+            src_dem_full_align = iolib.ds_getma(src_dem_ds_align)
+            writelib.write_ma(src_dem_full_align, align_fn, src_dem_ds_align, profile=out_profile)
+        profiler.stop(stage)
+        src_dem_ds = None
+
+    if True:
+        align_stats_fn = outprefix + '%s_align_stats.json' % xyz_shift_str_cum_fn
+        align_stats = {}
+        align_stats['src_fn'] = src_dem_fn 
+        align_stats['ref_fn'] = ref_dem_fn 
+        align_stats['align_fn'] = align_fn 
+        align_stats['res'] = {'src':src_dem_res, 'ref':ref_dem_res, 'coreg':res}
+        align_stats['shift'] = {'dx':dx_total, 'dy':dy_total, 'dz':dz_total, 'dm':dm_total}
+        if init_shift is not None:
+            align_stats['init_shift'] = dict(zip(['dx', 'dy', 'dz'], init_shift))
+        if ensemble_info:
+            align_stats['ensemble'] = ensemble_info
+        #One entry per pass, the second after tilt correction
+        align_stats['convergence'] = convergence_info + [monitor.to_dict()]
+        if tiltcorr:
+            align_stats['tiltcorr'] = dict(tilt.to_dict(), val_stats=vals_stats)
+        align_stats['after'] = diff_align_stats
+        align_stats['after_filt'] = diff_align_filt_stats
+        if terrain_cache is not None:
+            align_stats['terrain_cache'] = terrain_cache.stats()
+        if sidecar is not None:
+            align_stats['sidecar'] = sidecar.stats()
+        if profile:
+            align_stats['profile'] = profiler.summary()
+            if trace_fn is not None:
+                print("Writing profile trace: %s" % profiler.write_trace(trace_fn))
+        with open(align_stats_fn, 'w') as f:
+            json.dump(align_stats, f)
+        if result_cache is not None:
+            result_cache.put(cache_key, align_stats)
     return align_fn, [dx_total, dy_total, dz_total] 
 
 def align_dems(**kwargs):
@@ -475,13 +1013,39 @@ def align_dems(**kwargs):
     mask_list = kwargs.get('mask_list', [])
     max_offset = kwargs.get('max_offset', 100)
     max_dz = kwargs.get('max_dz', 100)
+    outlier_method = kwargs.get('outlier_method', 'exact')
     slope_lim = kwargs.get('slope_lim', (0.1, 40))
     tiltcorr = kwargs.get('tiltcorr', False)
     polyorder = kwargs.get('polyorder', 1)
+    track_azimuth = kwargs.get('track_azimuth', None)
+    tilt_along_order = kwargs.get('tilt_along_order', 0)
+    tilt_cross_order = kwargs.get('tilt_cross_order', 0)
+    tilt_samples = kwargs.get('tilt_samples', 1000000)
     res = kwargs.get('res', 'mean')
     max_iter = kwargs.get('max_iter', 30)
     tol = kwargs.get('tol', 0.02)
+    convergence = kwargs.get('convergence', 'tol')
     outdir = kwargs.get('outdir')
+    warp_engine = kwargs.get('warp_engine', 'warp')
+    terrain_cache_px = kwargs.get('terrain_cache_px', 0.5)
+    pyramid_levels = kwargs.get('pyramid_levels', 0)
+    pyramid_iter = kwargs.get('pyramid_iter', 5)
+    profile = kwargs.get('profile', False)
+    trace_fn = kwargs.get('trace_fn', None)
+    init_shift = kwargs.get('init_shift', None)
+    if init_shift is not None:
+        init_shift = load_init_shift(init_shift)
+    nuth_solver = kwargs.get('nuth_solver', 'coreglib')
+    nuth_stat = kwargs.get('nuth_stat', 'median')
+    nuth_stride = kwargs.get('nuth_stride', 1)
+    ensemble_modes = kwargs.get('ensemble_modes', default_ensemble_modes)
+    sample_budget = kwargs.get('sample_budget', None)
+    sample_seed = kwargs.get('sample_seed', 0)
+    mem_limit_mb = kwargs.get('mem_limit_mb', None)
+    sidecar_dir = kwargs.get('sidecar_dir', None)
+    use_sidecar = kwargs.get('sidecar', False) or sidecar_dir is not None
+    scratch_dir = kwargs.get('scratch_dir', None)
+    out_profile = kwargs.get('out_profile', writelib.default_profile)
     min_dx = tol
     min_dy = tol
     min_dz = tol
@@ -562,6 +1126,43 @@ def align_dems(**kwargs):
     print("Source DEM res: %0.2f" % src_dem_res)
     print("Resolution for coreg: %s (%0.2f m)\n" % (args.res, res))
 
+    #Warp the reference once, subsequent iterations only resample the shifted source
+    engine = None
+    if warp_engine is not None:
+        print("Warp engine: %s" % warp_engine)
+        engine = coreg_engine.WarpOnceEngine(ref_dem_ds, src_dem_ds_align, method=warp_engine)
+
+    #Slope, aspect and static mask are reused until the source has moved by terrain_cache_px
+    terrain_cache = None
+    if terrain_cache_px is not None:
+        terrain_cache = TerrainCache(max_shift_px=terrain_cache_px)
+
+    #Stored slope, aspect and static mask of the source DEM, reused across runs
+    sidecar = None
+    if use_sidecar:
+        sidecar = SidecarStore(src_dem_fn, sidecar_dir)
+        sidecar.bind(src_dem_ds_align)
+
+    #Stage timings and memory high-water mark, no-op unless requested
+    profiler = Profiler(enabled=profile)
+
+    #Full-resolution intermediates of the final stage, disk-backed above the memory ceiling
+    scratch = Scratch(scratch_dir, mem_limit=mem_limit_mb*1024**2 if mem_limit_mb is not None else None)
+
+    #Per-method estimates for each iteration in mode 'all'
+    ensemble_info = []
+    #Stop reason and predicted remaining error for each iteration, one monitor per pass
+    monitor = ConvergenceMonitor(tol, max_iter, method=convergence)
+    convergence_info = []
+
+    #Fixed stable-terrain sample for the Nuth and Kaab iterations, drawn before any shift is applied
+    samples = None
+    if sample_budget and mode == 'nuth':
+        with profiler.stage('sample'):
+            samples = sampling.SampleSet(ref_dem_ds, src_dem_ds_align, get_mask(src_dem_ds_align, mask_list, src_dem_fn, \
+                    sidecar=sidecar, src_ds=src_dem_ds_align), \
+                    budget=sample_budget, slope_lim=slope_lim, seed=sample_seed)
+
     #Iteration number
     n = 1
     #Cumulative offsets
@@ -569,11 +1170,49 @@ def align_dems(**kwargs):
     dy_total = 0
     dz_total = 0
 
+    #Start from a prior estimate, e.g. the shift of an earlier survey of the same site
+    #The prior counts toward the cumulative total, including the max_offset check
+    if init_shift is not None:
+        dx_total, dy_total, dz_total = init_shift
+        print("Initial shift: dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm\n" % (dx_total, dy_total, dz_total))
+
+    #Converge on downsampled DEMs first, so full resolution only needs a couple of iterations
+    if pyramid_levels:
+        stage = profiler.start('pyramid')
+        dx_total, dy_total, dz_total = pyramid_shift(ref_dem_fn, src_dem_fn, res, local_srs, pyramid_levels, \
+                mode=mode, tol=tol, max_iter=pyramid_iter, max_offset=max_offset, mask_list=mask_list, \
+                max_dz=max_dz, slope_lim=slope_lim, init_shift=(dx_total, dy_total, dz_total), \
+                nuth_solver=nuth_solver, nuth_stat=nuth_stat, nuth_stride=nuth_stride, ensemble_modes=ensemble_modes, \
+                outlier_method=outlier_method)
+        profiler.stop(stage)
+        print("\nPyramid offset: dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm\n" % (dx_total, dy_total, dz_total))
+
+    if dx_total or dy_total or dz_total:
+        if engine is not None:
+            engine.apply_shift(dx_total, dy_total, dz_total)
+        else:
+            src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx_total, dy_total, createcopy=False)
+            src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz_total, createcopy=False)
+
     #Now iteratively update geotransform and vertical shift
     while True:
         print("*** Iteration %i ***" % n)
-        dx, dy, dz, static_mask, fig = compute_offset(ref_dem_ds, src_dem_ds_align, src_dem_fn, mode, max_offset, \
-                mask_list=mask_list, max_dz=max_dz, slope_lim=slope_lim, plot=True)
+        profiler.set_iteration(n)
+        info = {'iter':n}
+        if samples is not None:
+            #Samples interpolated at the cumulative shift, no full-raster work until the final diff
+            with profiler.stage('fit'):
+                dx, dy, dz, fig = sampled_offset(samples, dx_total, dy_total, dz_total, max_dz=max_dz, \
+                        nuth_stat=nuth_stat, outlier_method=outlier_method)
+            static_mask = None
+        else:
+            dx, dy, dz, static_mask, fig = compute_offset(ref_dem_ds, src_dem_ds_align, src_dem_fn, mode, \
+                    max_offset=max_offset, mask_list=mask_list, max_dz=max_dz, slope_lim=slope_lim, plot=True, \
+                    engine=engine, terrain_cache=terrain_cache, profiler=profiler, nuth_solver=nuth_solver, \
+                    nuth_stat=nuth_stat, nuth_stride=nuth_stride, ensemble_modes=ensemble_modes, info=info, \
+                    sidecar=sidecar, outlier_method=outlier_method)
+        if mode == 'all':
+            ensemble_info.append(info)
         xyz_shift_str_iter = "dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm" % (dx, dy, dz)
         print("Incremental offset: %s" % xyz_shift_str_iter)
 
@@ -595,24 +1234,44 @@ def align_dems(**kwargs):
                 fig.gca().set_title("Incremental: %s\nCumulative: %s" % (xyz_shift_str_iter, xyz_shift_str_cum))
                 fig.savefig(dst_fn, dpi=300)
 
-        #Apply the horizontal shift to the original dataset
-        src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
-        #Should 
-        src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+        stage = profiler.start('apply_shift')
+        if engine is not None:
+            #Update geotransform, vertical shift is applied when the source is resampled
+            engine.apply_shift(dx, dy, dz)
+        else:
+            #Apply the horizontal shift to the original dataset
+            src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
+            #Should 
+            src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+        profiler.stop(stage)
 
         n += 1
         print("\n")
         #If magnitude of shift in all directions is less than tol
         #if n > max_iter or (abs(dx) <= min_dx and abs(dy) <= min_dy and abs(dz) <= min_dz):
-        #If magnitude of shift is less than tol
-        dm = np.sqrt(dx**2 + dy**2 + dz**2)
         dm_total = np.sqrt(dx_total**2 + dy_total**2 + dz_total**2)
 
         if dm_total > max_offset:
             sys.exit("Total offset exceeded specified max_offset (%0.2f m). Consider increasing -max_offset argument" % max_offset)
 
         #Stop iteration
-        if n > max_iter or dm < tol:
+        stop_reason = monitor.update(n - 1, (dx, dy, dz), (dx_total, dy_total, dz_total))
+        if stop_reason is not None:
+            print("Stopping after iteration %i: %s" % (n - 1, stop_reason))
+            #Extrapolated totals are checked against max_offset like every iteration
+            dx_final, dy_final, dz_final = monitor.final_shift(max_total=max_offset)
+            if monitor.extrapolated:
+                #Apply the extrapolated remainder, as for an extra iteration
+                dx, dy, dz = dx_final - dx_total, dy_final - dy_total, dz_final - dz_total
+                if engine is not None:
+                    engine.apply_shift(dx, dy, dz)
+                else:
+                    src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
+                    src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+                dx_total, dy_total, dz_total = dx_final, dy_final, dz_final
+                dm_total = np.sqrt(dx_total**2 + dy_total**2 + dz_total**2)
+                xyz_shift_str_cum = "dx=%+0.2fm, dy=%+0.2fm, dz=%+0.2fm" % (dx_total, dy_total, dz_total)
+                xyz_shift_str_cum_fn = '_%s_x%+0.2f_y%+0.2f_z%+0.2f' % (mode, dx_total, dy_total, dz_total)
 
             if fig is not None:
                 dst_fn = outprefix + '_%s_iter%02i_plot.png' % (mode, n)
@@ -621,79 +1280,95 @@ def align_dems(**kwargs):
                 fig.savefig(dst_fn, dpi=300)
 
             #Compute final elevation difference
-            if True:
-                ref_dem_clip_ds_align, src_dem_clip_ds_align = warplib.memwarp_multi([ref_dem_ds, src_dem_ds_align], \
-                        res=res, extent='intersection', t_srs=local_srs, r='cubic')
-                ref_dem_align = iolib.ds_getma(ref_dem_clip_ds_align, 1)
-                src_dem_align = iolib.ds_getma(src_dem_clip_ds_align, 1)
-                ref_dem_clip_ds_align = None
-
-                diff_align = src_dem_align - ref_dem_align
+            profiler.set_iteration(None)
+            with profiler.stage('final_diff'):
+                if engine is not None:
+                    ref_dem_align, src_dem_align, src_dem_clip_ds_align = engine.clip()
+                else:
+                    ref_dem_clip_ds_align, src_dem_clip_ds_align = warplib.memwarp_multi([ref_dem_ds, src_dem_ds_align], \
+                            res=res, extent='intersection', t_srs=local_srs, r='cubic')
+                    ref_dem_align = iolib.ds_getma(ref_dem_clip_ds_align, 1)
+                    src_dem_align = iolib.ds_getma(src_dem_clip_ds_align, 1)
+                    ref_dem_clip_ds_align = None
+
+                scratch.plan(ref_dem_align.shape)
+                diff_align = scratch.masked_subtract(src_dem_align, ref_dem_align, 'diff_align')
                 src_dem_align = None
                 ref_dem_align = None
 
                 #Get updated, final mask
-                static_mask_final = get_mask(src_dem_clip_ds_align, mask_list, src_dem_fn)
-                static_mask_final = np.logical_or(np.ma.getmaskarray(diff_align), static_mask_final)
+                static_mask_final = get_cached(terrain_cache, 'static_mask', src_dem_clip_ds_align, src_dem_ds_align, \
+                        (tuple(mask_list),), lambda: get_mask(src_dem_clip_ds_align, mask_list, src_dem_fn, \
+                        sidecar=sidecar, src_ds=src_dem_ds_align))
+                static_mask_final = scratch.logical_or(np.ma.getmaskarray(diff_align), static_mask_final, 'static_mask_final')
                 
                 #Final stats, before outlier removal
                 diff_align_compressed = diff_align[~static_mask_final]
-                diff_align_stats = malib.get_stats_dict(diff_align_compressed, full=True)
+                diff_align_stats = statslib.diff_stats(diff_align_compressed)
 
                 #Prepare filtered version for tiltcorr fit
                 diff_align_filt = np.ma.array(diff_align, mask=static_mask_final)
-                diff_align_filt = outlier_filter(diff_align_filt, f=3, max_dz=max_dz)
-                #diff_align_filt = outlier_filter(diff_align_filt, perc=(12.5, 87.5), max_dz=max_dz)
-                slope = get_filtered_slope(src_dem_clip_ds_align)
+                diff_align_filt = outlier_filter(diff_align_filt, f=3, max_dz=max_dz, method=outlier_method)
+                #diff_align_filt = outlier_filter(diff_align_filt, perc=(12.5, 87.5), max_dz=max_dz, method=outlier_method)
+                slope = get_filtered_slope(src_dem_clip_ds_align, sidecar=sidecar, src_ds=src_dem_ds_align)
                 diff_align_filt = np.ma.array(diff_align_filt, mask=np.ma.getmaskarray(slope))
-                diff_align_filt_stats = malib.get_stats_dict(diff_align_filt, full=True)
+                slope = None
+                diff_align_filt_stats = statslib.diff_stats(diff_align_filt)
 
             #Fit 2D polynomial to residuals and remove
-            #To do: add support for along-track and cross-track artifacts
             if tiltcorr and not tiltcorr_done:
                 print("\n************")
                 print("Calculating 'tiltcorr' 2D polynomial fit to residuals with order %i" % polyorder)
                 print("************\n")
+                stage = profiler.start('tiltcorr')
                 gt = src_dem_clip_ds_align.GetGeoTransform()
 
                 #Need to apply the mask here, so we're only fitting over static surfaces
-                #Note that the origmask=False will compute vals for all x and y indices, which is what we want
-                vals, resid, coeff = geolib.ma_fitpoly(diff_align_filt, order=polyorder, gt=gt, perc=(0,100), origmask=False)
-                #vals, resid, coeff = geolib.ma_fitplane(diff_align_filt, gt, perc=(12.5, 87.5), origmask=False)
-
-                #Should write out coeff or grid with correction 
+                #Fit on a subsample, the model is evaluated block by block on any grid
+                tilt = tiltlib.fit_tilt(diff_align_filt, gt, order=polyorder, along_order=tilt_along_order, \
+                        cross_order=tilt_cross_order, azimuth=track_azimuth, max_samples=tilt_samples)
 
-                vals_stats = malib.get_stats_dict(vals)
+                #Stats of the correction over the clipped intersection, from a decimated grid
+                valgrid = tilt.preview(gt, src_dem_clip_ds_align.RasterXSize, src_dem_clip_ds_align.RasterYSize)
+                vals_stats = malib.get_stats_dict(valgrid)
 
                 #Want to have max_tilt check here
                 #max_tilt = 4.0 #m
                 #Should do percentage
                 #vals.ptp() > max_tilt
 
-                #Note: dimensions of ds and vals will be different as vals are computed for clipped intersection
-                #Need to recompute planar offset for full src_dem_ds_align extent and apply
-                xgrid, ygrid = geolib.get_xy_grids(src_dem_ds_align)
-                valgrid = geolib.polyval2d(xgrid, ygrid, coeff) 
-                #For results of ma_fitplane
-                #valgrid = coeff[0]*xgrid + coeff[1]*ygrid + coeff[2]
-                src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, -valgrid, createcopy=False)
+                #Note: dimensions of ds and diff_align are different, diff_align is for clipped intersection
+                #Correction is evaluated for the full src_dem_ds_align extent and applied window by window
+                if engine is not None:
+                    src_dem_ds_align = engine.get_src_ds()
+                tilt.apply_ds(src_dem_ds_align)
+                if engine is not None:
+                    engine.reset(src_dem_ds_align)
+                #Source elevations changed, cached slope and aspect are stale
+                if terrain_cache is not None:
+                    terrain_cache.clear()
+                #Sidecar layers are kept, the smooth tilt surface leaves slope and aspect effectively unchanged
+                #Samples hold the uncorrected source, remaining iterations use the full rasters
+                samples = None
+                profiler.stop(stage)
 
                 if True:
                     print("Creating plot of polynomial fit to residuals")
                     fig, axa = plt.subplots(1,2, figsize=(8, 4))
-                    dz_clim = malib.calcperc_sym(vals, (2, 98))
+                    dz_clim = malib.calcperc_sym(valgrid, (2, 98))
                     ax = pltlib.iv(diff_align_filt, ax=axa[0], cmap='RdBu', clim=dz_clim, \
                             label='Residual dz (m)', scalebar=False)
                     ax = pltlib.iv(valgrid, ax=axa[1], cmap='RdBu', clim=dz_clim, \
-                            label='Polyfit dz (m)', ds=src_dem_ds_align)
+                            label='Polyfit dz (m)', scalebar=False)
                     #if tiltcorr:
                         #xyz_shift_str_cum_fn += "_tiltcorr"
                     tiltcorr_fig_fn = outprefix + '%s_polyfit.png' % xyz_shift_str_cum_fn
                     print("Writing out figure: %s\n" % tiltcorr_fig_fn)
                     fig.savefig(tiltcorr_fig_fn, dpi=300)
+                valgrid = None
 
                 print("Applying tilt correction to difference map")
-                diff_align -= vals
+                tilt.subtract_ma(diff_align, gt)
 
                 #Should iterate until tilts are below some threshold
                 #For now, only do one tiltcorr
@@ -701,6 +1376,9 @@ def align_dems(**kwargs):
                 #Now use original tolerance, and number of iterations 
                 tol = args.tol
                 max_iter = n + args.max_iter
+                #Shift history before the tilt correction says nothing about the next pass
+                convergence_info.append(monitor.to_dict())
+                monitor = ConvergenceMonitor(tol, max_iter, method=convergence)
             else:
                 break
 
@@ -708,13 +1386,13 @@ def align_dems(**kwargs):
         #Write out aligned difference map for clipped extent with vertial offset removed
         align_diff_fn = outprefix + '%s_align_diff.tif' % xyz_shift_str_cum_fn
         print("Writing out aligned difference map with median vertical offset removed")
-        iolib.writeGTiff(diff_align, align_diff_fn, src_dem_clip_ds_align)
+        writelib.write_ma(diff_align, align_diff_fn, src_dem_clip_ds_align, profile=out_profile)
 
     if True:
         #Write out fitered aligned difference map
         align_diff_filt_fn = outprefix + '%s_align_diff_filt.tif' % xyz_shift_str_cum_fn
         print("Writing out filtered aligned difference map with median vertical offset removed")
-        iolib.writeGTiff(diff_align_filt, align_diff_filt_fn, src_dem_clip_ds_align)
+        writelib.write_ma(diff_align_filt, align_diff_filt_fn, src_dem_clip_ds_align, profile=out_profile)
 
     #Extract final center coordinates for intersection
     center_coord_ll = geolib.get_center(src_dem_clip_ds_align, t_srs=geolib.wgs_srs)
@@ -724,6 +1402,7 @@ def align_dems(**kwargs):
     #Write out final aligned src_dem 
     align_fn = outprefix + '%s_align.tif' % xyz_shift_str_cum_fn
     print("Writing out shifted src_dem with median vertical offset removed: %s" % align_fn)
+    stage = profiler.start('write')
     #Open original uncorrected dataset at native resolution
     src_dem_ds = gdal.Open(src_dem_fn)
     src_dem_ds_align = iolib.mem_drv.CreateCopy('', src_dem_ds, 0)
@@ -732,14 +1411,11 @@ def align_dems(**kwargs):
     src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx_total, dy_total, createcopy=False)
     src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz_total, createcopy=False)
     if tiltcorr:
-        xgrid, ygrid = geolib.get_xy_grids(src_dem_ds_align)
-        valgrid = geolib.polyval2d(xgrid, ygrid, coeff) 
-        #For results of ma_fitplane
-        #valgrid = coeff[0]*xgrid + coeff[1]*ygrid + coeff[2]
-        src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, -valgrid, createcopy=False)
+        tilt.apply_ds(src_dem_ds_align)
     #Might be cleaner way to write out MEM ds directly to disk
     src_dem_full_align = iolib.ds_getma(src_dem_ds_align)
-    iolib.writeGTiff(src_dem_full_align, align_fn, src_dem_ds_align)
+    writelib.write_ma(src_dem_full_align, align_fn, src_dem_ds_align, profile=out_profile)
+    profiler.stop(stage)
 
     if True:
         #Output final aligned src_dem, masked so only best pixels are preserved
@@ -751,14 +1427,14 @@ def align_dems(**kwargs):
         align_diff_filt_full = iolib.ds_getma(align_diff_filt_full_ds)
         align_diff_filt_full_ds = None
         align_fn_masked = outprefix + '%s_align_filt.tif' % xyz_shift_str_cum_fn
-        iolib.writeGTiff(np.ma.array(src_dem_full_align, mask=np.ma.getmaskarray(align_diff_filt_full)), \
-                align_fn_masked, src_dem_ds_align)
+        writelib.write_ma(np.ma.array(src_dem_full_align, mask=np.ma.getmaskarray(align_diff_filt_full)), \
+                align_fn_masked, src_dem_ds_align, profile=out_profile)
 
     src_dem_full_align = None
     src_dem_ds_align = None
 
     #Compute original elevation difference
-    if True:
+    with profiler.stage('orig_diff'):
         ref_dem_clip_ds, src_dem_clip_ds = warplib.memwarp_multi([ref_dem_ds, src_dem_ds], \
                 res=res, extent='intersection', t_srs=local_srs, r='cubic')
         src_dem_ds = None
@@ -775,20 +1451,20 @@ def align_dems(**kwargs):
         static_mask_orig = np.logical_or(np.ma.getmaskarray(diff_orig), static_mask_orig)
         #For some reason, ASTER DEM diff have a spike near the 0 bin, could be an issue with masking?
         diff_orig_compressed = diff_orig[~static_mask_orig]
-        diff_orig_stats = malib.get_stats_dict(diff_orig_compressed, full=True)
+        diff_orig_stats = statslib.diff_stats(diff_orig_compressed)
 
         #Prepare filtered version for comparison 
         diff_orig_filt = np.ma.array(diff_orig, mask=static_mask_orig)
-        diff_orig_filt = outlier_filter(diff_orig_filt, f=3, max_dz=max_dz)
-        #diff_orig_filt = outlier_filter(diff_orig_filt, perc=(12.5, 87.5), max_dz=max_dz)
+        diff_orig_filt = outlier_filter(diff_orig_filt, f=3, max_dz=max_dz, method=outlier_method)
+        #diff_orig_filt = outlier_filter(diff_orig_filt, perc=(12.5, 87.5), max_dz=max_dz, method=outlier_method)
         slope = get_filtered_slope(src_dem_clip_ds)
         diff_orig_filt = np.ma.array(diff_orig_filt, mask=np.ma.getmaskarray(slope))
-        diff_orig_filt_stats = malib.get_stats_dict(diff_orig_filt, full=True)
+        diff_orig_filt_stats = statslib.diff_stats(diff_orig_filt)
 
         #Write out original difference map
         print("Writing out original difference map for common intersection before alignment")
         orig_diff_fn = outprefix + '_orig_diff.tif'
-        iolib.writeGTiff(diff_orig, orig_diff_fn, ref_dem_clip_ds)
+        writelib.write_ma(diff_orig, orig_diff_fn, ref_dem_clip_ds, profile=out_profile)
         src_dem_clip_ds = None
         ref_dem_clip_ds = None
 
@@ -805,17 +1481,28 @@ def align_dems(**kwargs):
         align_stats['center_coord'] = {'lon':center_coord_ll[0], 'lat':center_coord_ll[1], \
                 'x':center_coord_xy[0], 'y':center_coord_xy[1]}
         align_stats['shift'] = {'dx':dx_total, 'dy':dy_total, 'dz':dz_total, 'dm':dm_total}
+        if init_shift is not None:
+            align_stats['init_shift'] = dict(zip(['dx', 'dy', 'dz'], init_shift))
+        if ensemble_info:
+            align_stats['ensemble'] = ensemble_info
+        #One entry per pass, the second after tilt correction
+        align_stats['convergence'] = convergence_info + [monitor.to_dict()]
         #This tiltcorr flag gets set to false, need better flag
         if tiltcorr:
-            align_stats['tiltcorr'] = {}
-            align_stats['tiltcorr']['coeff'] = coeff.tolist()
-            align_stats['tiltcorr']['val_stats'] = vals_stats
+            align_stats['tiltcorr'] = dict(tilt.to_dict(), val_stats=vals_stats)
         align_stats['before'] = diff_orig_stats
         align_stats['before_filt'] = diff_orig_filt_stats
         align_stats['after'] = diff_align_stats
         align_stats['after_filt'] = diff_align_filt_stats
+        if terrain_cache is not None:
+            align_stats['terrain_cache'] = terrain_cache.stats()
+        if sidecar is not None:
+            align_stats['sidecar'] = sidecar.stats()
+        if profile:
+            align_stats['profile'] = profiler.summary()
+            if trace_fn is not None:
+                print("Writing profile trace: %s" % profiler.write_trace(trace_fn))
         
-        import json
         with open(align_stats_fn, 'w') as f:
             json.dump(align_stats, f)
 
@@ -839,7 +1526,7 @@ def align_dems(**kwargs):
         pltlib.add_cbar(axa[0,1], im, arr=src_dem_orig, clim=dem_clim, label=None)
         axa[0,1].set_title('Source DEM')
         #axa[0,2].imshow(~static_mask_orig, clim=(0,1), cmap='gray')
-        axa[0,2].imshow(~static_mask, clim=(0,1), cmap='gray', **kwargs)
+        axa[0,2].imshow(~(static_mask if static_mask is not None else static_mask_final), clim=(0,1), cmap='gray', **kwargs)
         axa[0,2].set_title('Surfaces for co-registration')
         dz_clim = malib.calcperc_sym(diff_orig_compressed, (5, 95))
         im = axa[1,0].imshow(diff_orig, cmap='RdBu', clim=dz_clim, **kwargs)
@@ -885,6 +1572,9 @@ def align_dems(**kwargs):
         fig_fn = outprefix + '%s_align.png' % xyz_shift_str_cum_fn
         print("Writing out figure: %s" % fig_fn)
         f.savefig(fig_fn, dpi=300)
+
+    diff_align = diff_align_filt = static_mask_final = None
+    scratch.cleanup()
         
 def main(argv=None):
     src_dems = [
@@ -8,21 +8,20 @@ from matplotlib.colors import LightSource
 from pygeotools.lib import iolib, warplib, geolib
 from demcoreg import coreglib 
 from statslib import DoD_Stats, plot_DoD
+import writelib
   
-def shift_dem(src_dem_fn, outdir, shift):
+def shift_dem_ds(src_dem_ds, shift):
     """
-    Shifts a Digital Elevation Model (DEM) by a specified amount in the x, y, and z directions using pygeotools library functions.
+    Return an in-memory copy of a DEM dataset shifted by (dx, dy, dz).
     Parameters:
-    - src_dem_fn (str): The file path of the source DEM to be shifted.
-    - outdir (str): The directory where the shifted DEM will be saved as a GeoTIFF file.
+    - src_dem_ds (gdal.Dataset): The source DEM dataset.
     - shift (tuple): The amount to shift the DEM in the x, y, and z directions.
     Returns:
-    - src_out_fn (str): The file path for the shifted DEM GeoTIFF.
+    - src_dem_ds_align (gdal.Dataset): Shifted MEM dataset.
     """
     dx = shift[0]
     dy = shift[1]
     dz = shift[2]
-    src_dem_ds = gdal.Open(src_dem_fn)
     print(f"Shifting DEM by: {dx}, {dy}, {dz}")
     src_dem_ds_align = iolib.mem_drv.CreateCopy('', src_dem_ds, 0)
     if dx is not None and dy is not None and dz is not None:
@@ -31,15 +30,38 @@ def shift_dem(src_dem_fn, outdir, shift):
         src_dem_ds_align = coreglib.apply_xy_shift(src_dem_ds_align, dx, dy, createcopy=False)
         print("Applying z shift: %0.2f" % dz)
         src_dem_ds_align = coreglib.apply_z_shift(src_dem_ds_align, dz, createcopy=False)
+    return src_dem_ds_align
+
+def shift_dem(src_dem_fn, outdir, shift, method='window', out_profile=None):
+    """
+    Shifts a Digital Elevation Model (DEM) by a specified amount in the x, y, and z directions using pygeotools library functions.
+    Parameters:
+    - src_dem_fn (str): The file path of the source DEM to be shifted.
+    - outdir (str): The directory where the shifted DEM will be saved as a GeoTIFF file.
+    - shift (tuple): The amount to shift the DEM in the x, y, and z directions.
+    - method (str): 'window' rewrites the DEM block by block with an updated geotransform,
+      'vrt' writes a VRT referencing the source with updated geotransform and offset (no pixel copy),
+      'copy' loads the full DEM into memory.
+    - out_profile (str): GeoTIFF output profile, one of writelib.profile_choices.
+    Returns:
+    - src_out_fn (str): The file path for the shifted DEM GeoTIFF (or VRT).
+    """
+    src_dem_ds = gdal.Open(src_dem_fn)
+    if method != 'copy':
+        ext = '.vrt' if method == 'vrt' else '.tif'
+        src_out_fn = os.path.join(outdir, os.path.splitext(os.path.split(src_dem_fn)[-1])[0] + '_shifted' + ext)
+        dx, dy, dz = shift
+        return writelib.write_shifted(src_dem_ds, src_out_fn, dx, dy, dz, method=method, profile=out_profile)
+    src_dem_ds_align = shift_dem_ds(src_dem_ds, shift)
     
     print("Converting source DEM to array...")
     src_dem_full_align = iolib.ds_getma(src_dem_ds_align)
     src_out_fn = os.path.join(outdir, os.path.splitext(os.path.split(src_dem_fn)[-1])[0] + '_shifted.tif')
     print("Writing source DEM to: %s" % src_out_fn)
-    iolib.writeGTiff(src_dem_full_align, src_out_fn, src_dem_ds_align)
+    writelib.write_ma(src_dem_full_align, src_out_fn, src_dem_ds_align, profile=out_profile)
     return src_out_fn
     
-def match_dems(src_dem_fn, ref_dem_fn, outdir, res, extent, writeref=False):
+def match_dems(src_dem_fn, ref_dem_fn, outdir, res, extent, writeref=False, out_profile=None):
     """
     Aligns and resamples two Digital Elevation Models (DEMs) to a common grid and resolution using pygeotools library functions.
 
@@ -47,6 +69,7 @@ def match_dems(src_dem_fn, ref_dem_fn, outdir, res, extent, writeref=False):
     - ref_dem_fn (str): The file path of the reference DEM.
     - src_dem_fn (str): The file path of the source DEM to be aligned with the reference.
     - outdir (str): The directory where the aligned and resampled DEMs will be saved as GeoTIFF files.
+    - out_profile (str): GeoTIFF output profile, one of writelib.profile_choices.
 
     Returns:
     - ref_out_fn (str): The file path for the processed reference DEM GeoTIFF.
@@ -101,12 +124,12 @@ def match_dems(src_dem_fn, ref_dem_fn, outdir, res, extent, writeref=False):
     print("Matched resolution: %0.3f m" % geolib.get_res(src_dem_ds_align, square=True)[0])
     src_out_fn = os.path.join(outdir, os.path.splitext(os.path.split(src_dem_fn)[-1])[0] + '_matched.tif')
     print("Writing source DEM to: %s" % src_out_fn)
-    iolib.writeGTiff(src_dem_array, src_out_fn, ref_dem_ds)
+    writelib.write_ma(src_dem_array, src_out_fn, ref_dem_ds, profile=out_profile)
     if writeref:
         print("Getting reference DEM array for writing new DEM to file")
         ref_dem_array = iolib.ds_getma(ref_dem_ds)
         print("Writing reference DEM to: %s" % ref_out_fn)
-        iolib.writeGTiff(ref_dem_array, ref_out_fn, ref_dem_ds)
+        writelib.write_ma(ref_dem_array, ref_out_fn, ref_dem_ds, profile=out_profile)
         src_dem_ds_align = None
         ref_dem_ds = None
         return ref_out_fn, src_out_fn
@@ -116,7 +139,8 @@ def match_dems(src_dem_fn, ref_dem_fn, outdir, res, extent, writeref=False):
         ref_dem_ds = None
         return ref_out_fn, src_out_fn
           
-def match_diff(src_dem_fn, ref_dem_fn, res, extent, outdir = None, align_stats_fn =None, orig_stats = False):
+def match_diff(src_dem_fn, ref_dem_fn, res, extent, outdir = None, align_stats_fn =None, orig_stats = False, tile_size = None, \
+        out_profile = None):
     """ Match resolution and extent of two DEMs before differencing them
 
     Args:
@@ -126,6 +150,8 @@ def match_diff(src_dem_fn, ref_dem_fn, res, extent, outdir = None, align_stats_f
     extent (str): The extent parameter for matching the DEMs. Options include 'intersection', 'union', 'first', 'second'.
     outdir (str): The directory where the aligned and resampled DEMs will be saved as GeoTIFF files.
     orig_stats (bool): If True, the original statistics will be computed for the difference map.
+    tile_size (int): If specified, match with warped VRTs and stream the difference map and statistics in windows of this size.
+    out_profile (str): GeoTIFF output profile for the matched DEMs and difference map, one of writelib.profile_choices.
     
     Returns:
     diff_fn (str): The file path for the difference map GeoTIFF.
@@ -143,7 +169,15 @@ def match_diff(src_dem_fn, ref_dem_fn, res, extent, outdir = None, align_stats_f
     else:
         diff_fn = os.path.join(outdir, 'Matched_DoD.tif')
 
-    ref_out_fn, src_out_fn = match_dems(ref_dem_fn, src_dem_fn, outdir, res, extent, writeref= True)
+    if tile_size is not None:
+        if align_stats_fn is None:
+            align_stats_fn = os.path.join(outdir, 'Matched_DoD_Stats.txt')
+        #Windowed mode matches grids lazily, full rasters are never held in memory
+        DoD_Stats(src_dem_fn, ref_dem_fn, outdir, res, extent, log_file = align_stats_fn, out_diff_fn=diff_fn, \
+                tile_size=tile_size, out_profile=out_profile)
+        return diff_fn, align_stats_fn
+
+    ref_out_fn, src_out_fn = match_dems(ref_dem_fn, src_dem_fn, outdir, res, extent, writeref= True, out_profile=out_profile)
     
     ref_out_ds = gdal.Open(ref_out_fn)
     src_out_ds = gdal.Open(src_out_fn)
@@ -159,7 +193,9 @@ def match_diff(src_dem_fn, ref_dem_fn, res, extent, outdir = None, align_stats_f
         align_stats_fn = os.path.join(outdir, 'Matched_DoD_Stats.txt')
     print(f"Align stats file: {align_stats_fn}")
 
-    DoD_Stats(ref_out_fn, src_out_fn, outdir, res, extent, log_file = align_stats_fn, out_diff_fn=diff_fn)
+    #Grids were matched above
+    DoD_Stats(ref_out_fn, src_out_fn, outdir, res, extent, match=False, log_file = align_stats_fn, out_diff_fn=diff_fn, \
+            out_profile=out_profile)
 
     #Close datasets
     src_dem_ds = None
@@ -0,0 +1,161 @@
+"""
+Masked normalized cross-correlation (NCC) and sum of squared differences (SSD) offset search via FFT.
+All overlap sums for every integer displacement come from a few FFT correlations of the data, squared
+data and validity masks (Padfield, 2012, Masked object registration in the Fourier domain), so invalid
+pixels never contribute and the cost is O(N log N) regardless of the search radius.
+A coarse-to-fine pyramid finds large offsets on block-averaged copies, then refines in a small window.
+
+Offsets follow coreglib: sp_offset = (row, col) displacement of src relative to ref, so that
+src[r + drow, c + dcol] matches ref[r, c].
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+
+fft_modes = ['ncc_fft', 'ssd_fft']
+
+try:
+    from scipy.fft import next_fast_len
+except ImportError:
+    def next_fast_len(n):
+        return int(2**np.ceil(np.log2(n)))
+
+def _prep(a):
+    """Return zero-filled, mean-removed data and float validity mask"""
+    m = ~np.ma.getmaskarray(a)
+    d = np.ma.getdata(a).astype(np.float64)
+    #Removing the mean keeps the sums well conditioned for absolute elevations
+    d = np.where(m, d - d[m].mean(), 0.0) if m.any() else np.zeros(a.shape)
+    return d, m.astype(np.float64)
+
+def masked_score(ref, src, pad, method='ncc', min_overlap=0.1):
+    """
+    Score every integer displacement within +/-pad pixels, higher is better.
+    Parameters:
+    - ref, src (np.ma.array): Same-shape arrays, masked where invalid.
+    - pad (int or tuple): Search radius in pixels (rows, cols).
+    - method (str): 'ncc' for masked NCC, 'ssd' for negative variance of (src - ref) over the overlap,
+      which ignores a constant vertical offset.
+    - min_overlap (float): Minimum fraction of valid ref pixels that must overlap, else score is nan.
+    Returns:
+    - score (np.array): Shape (2*pad_row + 1, 2*pad_col + 1), center is zero displacement.
+    """
+    if np.isscalar(pad):
+        pad = (pad, pad)
+    f, mf = _prep(ref)
+    g, mg = _prep(src)
+    shape = [next_fast_len(n + p) for n, p in zip(ref.shape, pad)]
+    fft = lambda a: np.fft.rfft2(a, shape)
+    Fmf, Ff, Fff = fft(mf), fft(f), fft(f*f)
+    Fmg, Fg, Fgg = fft(mg), fft(g), fft(g*g)
+    #corr(a, b)[d] = sum_p a[p]*b[p + d]
+    rows = np.arange(-pad[0], pad[0]+1) % shape[0]
+    cols = np.arange(-pad[1], pad[1]+1) % shape[1]
+    corr = lambda A, B: np.fft.irfft2(np.conj(A)*B, shape)[np.ix_(rows, cols)]
+    n = np.round(corr(Fmf, Fmg))
+    sf = corr(Ff, Fmg)
+    sg = corr(Fmf, Fg)
+    sff = corr(Fff, Fmg)
+    sgg = corr(Fmf, Fgg)
+    sfg = corr(Ff, Fg)
+    valid = n >= max(min_overlap*mf.sum(), 1)
+    nn = np.where(valid, n, 1)
+    if method == 'ncc':
+        num = sfg - sf*sg/nn
+        den = (sff - sf*sf/nn)*(sgg - sg*sg/nn)
+        score = num/np.sqrt(np.where(den > 0, den, np.inf))
+    elif method == 'ssd':
+        mean_d = (sg - sf)/nn
+        score = -((sff + sgg - 2*sfg)/nn - mean_d**2)
+    else:
+        raise ValueError("Unknown method: %s" % method)
+    score[~valid] = np.nan
+    return score
+
+def downsample(a, f):
+    """Block average over valid pixels, blocks with fewer than half valid pixels are masked"""
+    if f == 1:
+        return a
+    ny, nx = (a.shape[0]//f)*f, (a.shape[1]//f)*f
+    m = ~np.ma.getmaskarray(a)[:ny,:nx]
+    d = np.where(m, np.ma.getdata(a)[:ny,:nx], 0).astype(np.float64)
+    shape = (ny//f, f, nx//f, f)
+    count = m.reshape(shape).sum(axis=(1, 3))
+    total = d.reshape(shape).sum(axis=(1, 3))
+    return np.ma.array(total/np.maximum(count, 1), mask=count < (f*f)/2.)
+
+def overlap(ref, src, drow, dcol):
+    """Crop ref and src to their overlap when src is displaced by integer (drow, dcol)"""
+    ny, nx = ref.shape
+    r0, c0 = max(0, -drow), max(0, -dcol)
+    r1, c1 = ny - max(0, drow), nx - max(0, dcol)
+    return ref[r0:r1, c0:c1], src[r0+drow:r1+drow, c0+dcol:c1+dcol]
+
+def subpixel_peak(score, i, j):
+    """Parabolic refinement of the peak at (i, j) along each axis"""
+    def parabola(a, b, c):
+        d = a - 2*b + c
+        if not np.isfinite(d) or d >= 0:
+            return 0.0
+        return float(np.clip(0.5*(a - c)/d, -0.5, 0.5))
+    di = dj = 0.0
+    if 0 < i < score.shape[0]-1:
+        di = parabola(score[i-1,j], score[i,j], score[i+1,j])
+    if 0 < j < score.shape[1]-1:
+        dj = parabola(score[i,j-1], score[i,j], score[i,j+1])
+    return di, dj
+
+def pyramid_factors(pad, shape, refine_pad=2, min_size=64):
+    """Downsampling factors, coarse to fine, until the search radius at the coarsest level is small"""
+    factors = [1]
+    while max(pad)/(factors[-1]*2) > 4*refine_pad and min(shape)//(factors[-1]*2) >= min_size:
+        factors.append(factors[-1]*2)
+    return factors[::-1]
+
+def compute_offset_fft(ref_dem, src_dem, pad=(9, 9), method='ncc', refine_pad=2, plot=False):
+    """
+    Coarse-to-fine masked FFT offset search.
+    Parameters:
+    - ref_dem, src_dem (np.ma.array): Same-shape arrays, masked where invalid or excluded.
+    - pad (tuple): Full search radius in pixels (rows, cols).
+    - method (str): 'ncc' or 'ssd'.
+    - refine_pad (int): Search radius in pixels at each finer level, around the upsampled estimate.
+    Returns:
+    - m (np.array): Score surface at full resolution (around int_offset).
+    - int_offset (np.array): Integer (row, col) offset.
+    - sp_offset (np.array): Sub-pixel (row, col) offset.
+    - fig: Plot of score surface, or None.
+    """
+    if np.isscalar(pad):
+        pad = (pad, pad)
+    est = np.array([0, 0])
+    factors = pyramid_factors(pad, ref_dem.shape, refine_pad=refine_pad)
+    for k, f in enumerate(factors):
+        if k == 0:
+            p = (int(np.ceil(pad[0]/f)), int(np.ceil(pad[1]/f)))
+            r, s = downsample(ref_dem, f), downsample(src_dem, f)
+            center = np.array([0, 0])
+        else:
+            p = (refine_pad, refine_pad)
+            center = np.round(est/f).astype(int)
+            r, s = overlap(downsample(ref_dem, f), downsample(src_dem, f), *center)
+        score = masked_score(r, s, p, method=method)
+        if np.all(np.isnan(score)):
+            print("No valid overlap for offset search at %ix" % f)
+            return score, np.array([0, 0]), np.array([0.0, 0.0]), None
+        i, j = np.unravel_index(np.nanargmax(score), score.shape)
+        est = (center + np.array([i - p[0], j - p[1]]))*f
+        print("FFT %s search at %ix: radius %s px, offset (row, col): %s" % (method, f, p, est))
+    int_offset = est
+    di, dj = subpixel_peak(score, i, j)
+    sp_offset = int_offset + np.array([di, dj])
+    fig = None
+    if plot:
+        fig, ax = plt.subplots(figsize=(5, 4))
+        extent = (center[1]-p[1]-0.5, center[1]+p[1]+0.5, center[0]+p[0]+0.5, center[0]-p[0]-0.5)
+        im = ax.imshow(score, extent=extent, cmap='inferno')
+        ax.plot(sp_offset[1], sp_offset[0], 'c+')
+        fig.colorbar(im, ax=ax, label=method)
+        ax.set_xlabel('Column offset (px)')
+        ax.set_ylabel('Row offset (px)')
+        ax.set_title('Sub-pixel offset: %0.2f, %0.2f' % tuple(sp_offset))
+    return score, int_offset, sp_offset, fig
@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+
+import numpy as np
+from osgeo import gdal, osr
+
+from logger import iter_files
+
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    rtree_index = None
+
+def get_footprint(fn):
+    """
+    Read raster footprint from the header only, no pixel data is read.
+    Returns:
+    - fp (dict): fn, bounds [xmin, ymin, xmax, ymax], res (x, y), shape (rows, cols) and CRS wkt.
+      None if the file can't be opened as a raster.
+    """
+    ds = gdal.OpenEx(fn, gdal.OF_RASTER)
+    if ds is None:
+        return None
+    gt = ds.GetGeoTransform()
+    nx, ny = ds.RasterXSize, ds.RasterYSize
+    x = [gt[0], gt[0] + nx*gt[1] + ny*gt[2]]
+    y = [gt[3], gt[3] + nx*gt[4] + ny*gt[5]]
+    fp = {'fn':fn, 'bounds':[min(x), min(y), max(x), max(y)], 'res':(abs(gt[1]), abs(gt[5])), \
+            'shape':(ny, nx), 'wkt':ds.GetProjection()}
+    ds = None
+    return fp
+
+def iter_footprints(fn_iter):
+    """Lazily yield footprints for an iterable of filenames, skipping non-rasters"""
+    for fn in fn_iter:
+        fp = get_footprint(fn)
+        if fp is not None:
+            yield fp
+
+def get_srs(wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    #Keep x/y (easting/northing, lon/lat) axis order with GDAL 3
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def transform_bounds(bounds, src_wkt, dst_wkt, densify=21):
+    """Transform [xmin, ymin, xmax, ymax] between CRS, sampling points along each edge"""
+    if not src_wkt or not dst_wkt or get_srs(src_wkt).IsSame(get_srs(dst_wkt)):
+        return list(bounds)
+    xmin, ymin, xmax, ymax = bounds
+    t = np.linspace(0, 1, densify)
+    x = np.concatenate([xmin + t*(xmax - xmin), np.full(densify, xmax), xmax - t*(xmax - xmin), np.full(densify, xmin)])
+    y = np.concatenate([np.full(densify, ymin), ymin + t*(ymax - ymin), np.full(densify, ymax), ymax - t*(ymax - ymin)])
+    ct = osr.CoordinateTransformation(get_srs(src_wkt), get_srs(dst_wkt))
+    pts = np.array(ct.TransformPoints(np.column_stack([x, y]).tolist()))
+    return [pts[:,0].min(), pts[:,1].min(), pts[:,0].max(), pts[:,1].max()]
+
+def bounds_intersection(a, b):
+    """Return intersection of two [xmin, ymin, xmax, ymax] bounds, None if they don't overlap"""
+    out = [max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])]
+    if out[0] >= out[2] or out[1] >= out[3]:
+        return None
+    return out
+
+def overlaps(fp, ref_fp, min_area=0):
+    """Check whether footprint fp overlaps ref_fp (in the reference CRS) by more than min_area"""
+    bounds = transform_bounds(fp['bounds'], fp['wkt'], ref_fp['wkt'])
+    inter = bounds_intersection(bounds, ref_fp['bounds'])
+    if inter is None:
+        return False
+    return (inter[2] - inter[0])*(inter[3] - inter[1]) > min_area
+
+def filter_overlapping(fn_iter, ref_dem_fn, min_area=0, verbose=True):
+    """
+    Lazily yield filenames whose footprint overlaps the reference DEM.
+    Only raster headers are read, so non-overlapping candidates cost one open each.
+    Parameters:
+    - fn_iter (iterable): Candidate filenames, e.g. from logger.iter_files.
+    - ref_dem_fn (str): Reference DEM filename.
+    - min_area (float): Minimum overlap area in reference CRS units.
+    """
+    ref_fp = get_footprint(ref_dem_fn)
+    for fp in iter_footprints(fn_iter):
+        if overlaps(fp, ref_fp, min_area):
+            yield fp['fn']
+        elif verbose:
+            print("No overlap with reference, skipping: %s" % fp['fn'])
+
+class FootprintIndex(object):
+    """
+    Persistent index of raster footprints, e.g. for a directory of reference DEM tiles.
+    Bounds are stored in the CRS of the first tile; queries use an R-tree when the rtree
+    package is available, otherwise a regular grid of cells. The index is saved as json,
+    and tiles with unchanged size and mtime are not reopened when it is rebuilt.
+
+    Example:
+    idx = FootprintIndex.from_folder(ref_dir, index_fn=os.path.join(outdir, 'ref_footprint_index.json'))
+    ref_vrt_fn = idx.build_vrt(idx.query_fn(src_dem_fn), 'ref.vrt')
+    """
+    def __init__(self, footprints=(), cell_size=None):
+        self.footprints = []
+        self.wkt = None
+        self.cell_size = cell_size
+        self._tree = None
+        self._grid = None
+        for fp in footprints:
+            self.add(fp)
+
+    def add(self, fp):
+        if self.wkt is None:
+            self.wkt = fp['wkt']
+        if 'ibounds' not in fp:
+            #Bounds in the index CRS
+            fp['ibounds'] = transform_bounds(fp['bounds'], fp['wkt'], self.wkt)
+        self.footprints.append(fp)
+        #Rebuild search structure on next query
+        self._tree = None
+        self._grid = None
+
+    def __len__(self):
+        return len(self.footprints)
+
+    @classmethod
+    def from_folder(cls, folder, index_fn=None, pattern='*.tif', regex=None, recursive=True):
+        """Index rasters under folder, reusing entries from an existing index_fn and saving the result"""
+        old = {}
+        if index_fn is not None and os.path.exists(index_fn):
+            old = dict((fp['fn'], fp) for fp in cls.load(index_fn).footprints)
+        idx = cls()
+        for fn in iter_files(folder, pattern=pattern, regex=regex, recursive=recursive):
+            st = os.stat(fn)
+            fp = old.get(fn)
+            if fp is None or fp.get('size') != st.st_size or fp.get('mtime') != st.st_mtime:
+                fp = get_footprint(fn)
+                if fp is None:
+                    continue
+                fp['size'] = st.st_size
+                fp['mtime'] = st.st_mtime
+            else:
+                #Index CRS is taken from the first tile, which may have changed
+                fp.pop('ibounds', None)
+            idx.add(fp)
+        print("Indexed %i rasters in %s (%i reused)" % (len(idx), folder, len(set(old) & set(fp['fn'] for fp in idx.footprints))))
+        if index_fn is not None:
+            idx.save(index_fn)
+        return idx
+
+    @classmethod
+    def load(cls, index_fn):
+        with open(index_fn) as f:
+            d = json.load(f)
+        idx = cls(cell_size=d.get('cell_size'))
+        idx.wkt = d['wkt']
+        for fp in d['footprints']:
+            idx.add(fp)
+        return idx
+
+    def save(self, index_fn):
+        """Write to a temporary file and rename, so concurrent readers never see a partial index"""
+        tmp_fn = '%s_%i_tmp.json' % (os.path.splitext(index_fn)[0], os.getpid())
+        with open(tmp_fn, 'w') as f:
+            json.dump({'wkt':self.wkt, 'cell_size':self.cell_size, 'footprints':self.footprints}, f)
+        os.replace(tmp_fn, index_fn)
+        return index_fn
+
+    def _build(self):
+        if rtree_index is not None:
+            self._tree = rtree_index.Index()
+            for i, fp in enumerate(self.footprints):
+                self._tree.insert(i, fp['ibounds'])
+            return
+        if self.cell_size is None:
+            #Default cell is the median tile width, so each tile lands in a few cells
+            self.cell_size = float(np.median([fp['ibounds'][2] - fp['ibounds'][0] for fp in self.footprints])) or 1.0
+        self._grid = {}
+        for i, fp in enumerate(self.footprints):
+            for key in self._cells(fp['ibounds']):
+                self._grid.setdefault(key, []).append(i)
+
+    def _cells(self, bounds):
+        c = self.cell_size
+        i0, j0 = int(np.floor(bounds[0]/c)), int(np.floor(bounds[1]/c))
+        i1, j1 = int(np.floor(bounds[2]/c)), int(np.floor(bounds[3]/c))
+        return [(i, j) for i in range(i0, i1+1) for j in range(j0, j1+1)]
+
+    def query(self, bounds, wkt=None):
+        """Return footprints intersecting [xmin, ymin, xmax, ymax] (in wkt CRS, default index CRS)"""
+        if not self.footprints:
+            return []
+        if wkt is not None:
+            bounds = transform_bounds(bounds, wkt, self.wkt)
+        if self._tree is None and self._grid is None:
+            self._build()
+        if self._tree is not None:
+            candidates = self._tree.intersection(bounds)
+        else:
+            candidates = set()
+            for key in self._cells(bounds):
+                candidates.update(self._grid.get(key, []))
+        out = [self.footprints[i] for i in sorted(candidates)]
+        return [fp for fp in out if bounds_intersection(fp['ibounds'], bounds) is not None]
+
+    def query_fn(self, fn):
+        """Return filenames of indexed rasters overlapping the footprint of fn"""
+        fp = get_footprint(fn)
+        return [r['fn'] for r in self.query(fp['bounds'], fp['wkt'])]
+
+    def build_vrt(self, fn_list, vrt_fn):
+        """
+        Mosaic fn_list as a VRT; tiles are only read when the VRT is warped.
+        An existing VRT of the same tiles is kept as is, so its size and mtime (the result cache key) do not change.
+        """
+        if os.path.exists(vrt_fn):
+            vrt_ds = gdal.Open(vrt_fn)
+            if vrt_ds is not None:
+                vrt_tiles = set(os.path.abspath(fn) for fn in vrt_ds.GetFileList()) - set([os.path.abspath(vrt_fn)])
+                vrt_ds = None
+                if vrt_tiles == set(os.path.abspath(fn) for fn in fn_list):
+                    print("Using existing VRT of %i overlapping tiles: %s" % (len(fn_list), vrt_fn))
+                    return vrt_fn
+        print("Building VRT from %i overlapping tiles: %s" % (len(fn_list), vrt_fn))
+        vrt_ds = gdal.BuildVRT(vrt_fn, fn_list)
+        vrt_ds = None
+        return vrt_fn
+
+def index_folder(ref_dir, outdir):
+    """
+    Index the tiles under ref_dir and return the index json filename.
+    The index is saved in outdir, as the tile directory is often a read-only archive.
+    """
+    ref_dir = os.path.normpath(ref_dir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    index_fn = os.path.join(outdir, os.path.split(ref_dir)[-1] + '_footprint_index.json')
+    FootprintIndex.from_folder(ref_dir, index_fn=index_fn)
+    return index_fn
+
+def resolve_reference(ref_dem_fn, src_dem_fn, outdir):
+    """
+    Return a single reference DEM filename for src_dem_fn, exiting early if nothing overlaps.
+    ref_dem_fn can be a DEM, a directory of DEM tiles or a FootprintIndex json. For tiles, only those
+    intersecting the source footprint are mosaicked as a VRT in outdir. A directory is indexed into
+    outdir first; for many sources, index it once with index_folder and pass the json instead.
+    """
+    src_fp = get_footprint(src_dem_fn)
+    if os.path.isdir(ref_dem_fn):
+        ref_dem_fn = index_folder(ref_dem_fn, outdir)
+    if os.path.splitext(ref_dem_fn)[1].lower() == '.json':
+        ref_dir = os.path.splitext(ref_dem_fn)[0]
+        idx = FootprintIndex.load(ref_dem_fn)
+        fn_list = [fp['fn'] for fp in idx.query(src_fp['bounds'], src_fp['wkt'])]
+        if not fn_list:
+            sys.exit("No reference tiles intersect source DEM: %s" % src_dem_fn)
+        vrt_fn = os.path.join(outdir, os.path.split(ref_dir)[-1] + '.vrt')
+        return idx.build_vrt(fn_list, vrt_fn)
+    if not overlaps(src_fp, get_footprint(ref_dem_fn)):
+        sys.exit("Source DEM does not intersect reference DEM: %s" % src_dem_fn)
+    return ref_dem_fn
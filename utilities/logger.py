@@ -1,5 +1,16 @@
 import os
+import re
+import sys
+import json
+import time
+import fnmatch
 
+if sys.platform == 'win32':
+    import msvcrt
+    fcntl = None
+else:
+    import fcntl
+    msvcrt = None
 
 
 def log(msg, log_file, header =False, print_msg = True):
@@ -16,17 +27,131 @@ def log(msg, log_file, header =False, print_msg = True):
         if print_msg:
             print(msg)
 
+def lock_file(f):
+    """Block until an exclusive lock is held on open file f"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        #Lock the first byte; writes in append mode still go to the end of the file
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                #LK_LOCK gives up after 10 attempts
+                time.sleep(0.1)
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+class Logger(object):
+    """
+    Buffered logger writing plain text and, optionally, JSON-lines records.
+    Messages are held in memory and appended in a single locked write per flush, so one log file
+    can be shared by several worker processes and network shares see one round-trip per run.
+
+    Example:
+    with Logger(log_file, json_file=True) as log:
+        log.log("Average difference: %0.4f" % m, key='mean', value=m)
+    """
+    def __init__(self, log_file, json_file=None, header=False, print_msg=True):
+        """
+        Parameters:
+        - log_file (str): Text log filename.
+        - json_file (str or bool): JSON-lines filename, True for log_file with .jsonl extension, None for text only.
+        - header (bool): Truncate existing files on first flush and start with a separator line, as log(header=True).
+        - print_msg (bool): Also print messages as they are logged.
+        """
+        self.log_file = log_file
+        if json_file is True:
+            json_file = os.path.splitext(log_file)[0] + '.jsonl'
+        self.json_file = json_file
+        self.header = header
+        self.print_msg = print_msg
+        self.records = []
+
+    def log(self, msg, **fields):
+        """Buffer a message; keyword fields are only written to the JSON-lines output"""
+        if self.print_msg:
+            print(msg)
+        rec = {'time':time.time(), 'pid':os.getpid(), 'msg':msg}
+        rec.update(fields)
+        self.records.append(rec)
+
+    def flush(self):
+        if not self.records:
+            return
+        mode = 'w' if self.header else 'a'
+        text = ''.join(rec['msg'] + '\n' for rec in self.records)
+        if self.header:
+            text = '----------------------------------------------\n' + text
+        write_locked(self.log_file, text, mode)
+        if self.json_file is not None:
+            #default=float handles numpy scalars
+            text = ''.join(json.dumps(rec, default=float) + '\n' for rec in self.records)
+            write_locked(self.json_file, text, mode)
+        self.header = False
+        self.records = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+def write_locked(fn, text, mode='a'):
+    """Write text to fn in one call while holding an exclusive lock"""
+    with open(fn, mode) as f:
+        lock_file(f)
+        try:
+            f.write(text)
+            f.flush()
+        finally:
+            unlock_file(f)
+
 def files_from_folder(folder, ext = None, tag = None):
     """Return a list of files from a folder.
     folder: folder path
     ext: file extension
+    tag: substring that must be in the filename
     """
-    if ext is None and tag is None:
-        return [os.path.join(folder, f) for f in os.listdir(folder)]
-    elif ext is not None and tag is None:
-        return [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(ext)]
-    elif ext is None and tag is not None:
-        return [os.path.join(folder, f) for f in os.listdir(folder) if tag in f]
-    else:
-        return [os.path.join(folder, f) for f in os.listdir(folder) if tag in f and f.endswith(ext)]
+    out = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if ext is not None and not entry.name.endswith(ext):
+                continue
+            if tag is not None and tag not in entry.name:
+                continue
+            out.append(entry.path)
+    return out
 
+def iter_files(folder, pattern = None, regex = None, recursive = True):
+    """Yield paths of files under folder, walking with os.scandir.
+    folder: folder path
+    pattern: glob pattern (or list of patterns) matched against the filename, e.g. '*.tif'
+    regex: regular expression searched in the filename
+    recursive: descend into subdirectories
+    """
+    if isinstance(pattern, str):
+        pattern = [pattern]
+    if isinstance(regex, str):
+        regex = re.compile(regex)
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                    continue
+                if pattern is not None and not any(fnmatch.fnmatch(entry.name, p) for p in pattern):
+                    continue
+                if regex is not None and regex.search(entry.name) is None:
+                    continue
+                yield entry.path
@@ -0,0 +1,120 @@
+"""
+Nuth and Kaab (2011) horizontal offset from binned aspect statistics.
+diff/tan(slope) is reduced to one robust value per aspect bin in a single pass, then
+y = a*cos(b - aspect) + c is fit to the bin values by linear least squares, as
+y = p*cos(aspect) + q*sin(aspect) + c, with a = hypot(p, q) and b = atan2(q, p).
+Output matches coreglib.compute_offset_nuth: fit_param = [a, b (degrees), c].
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+
+nuth_solver_choices = ['binned', 'coreglib']
+nuth_stat_choices = ['median', 'trimmed', 'mean']
+
+def nuth_samples(diff, slope, aspect, stride=1, remove_outliers=True):
+    """
+    Return valid aspect (degrees) and diff/tan(slope) samples as 1D arrays.
+    stride > 1 keeps every stride-th pixel in each dimension, so results are deterministic.
+    """
+    if stride > 1:
+        diff = diff[::stride, ::stride]
+        slope = slope[::stride, ::stride]
+        aspect = aspect[::stride, ::stride]
+    mask = np.ma.getmaskarray(diff) | np.ma.getmaskarray(slope) | np.ma.getmaskarray(aspect)
+    valid = ~mask
+    x = np.ma.getdata(aspect)[valid].astype(np.float64)
+    y = np.ma.getdata(diff)[valid]/np.tan(np.deg2rad(np.ma.getdata(slope)[valid]))
+    finite = np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if remove_outliers and y.size:
+        #Slopes near zero blow up diff/tan(slope)
+        med = np.median(y)
+        nmad = 1.4826*np.median(np.abs(y - med))
+        keep = np.abs(y - med) <= 3*nmad if nmad > 0 else np.ones(y.size, dtype=bool)
+        x, y = x[keep], y[keep]
+    return x, y
+
+def bin_stats(x, y, bin_width=2.0, stat='median', trim=0.1):
+    """
+    Statistic of y in aspect bins of bin_width degrees, vectorized over all bins.
+    Parameters:
+    - stat (str): 'median', 'trimmed' (mean after dropping trim fraction at each end) or 'mean'.
+    Returns:
+    - centers, values, counts (np.array): One entry per bin, values are nan for empty bins.
+    """
+    nbins = int(np.ceil(360.0/bin_width))
+    idx = np.clip((np.mod(x, 360.0)/bin_width).astype(np.int64), 0, nbins-1)
+    counts = np.bincount(idx, minlength=nbins)
+    centers = (np.arange(nbins) + 0.5)*bin_width
+    values = np.full(nbins, np.nan)
+    nz = counts > 0
+    if stat == 'mean':
+        #Single pass, no sort
+        values[nz] = np.bincount(idx, weights=y, minlength=nbins)[nz]/counts[nz]
+        return centers, values, counts
+    #Sort by bin, then by value within bin
+    order = np.lexsort((y, idx))
+    ys = y[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    c = counts[nz]
+    s = starts[nz]
+    if stat == 'median':
+        values[nz] = 0.5*(ys[s + (c-1)//2] + ys[s + c//2])
+    elif stat == 'trimmed':
+        cs = np.concatenate([[0], np.cumsum(ys)])
+        k = np.floor(c*trim).astype(np.int64)
+        lo = s + k
+        hi = s + c - k
+        values[nz] = (cs[hi] - cs[lo])/(hi - lo)
+    else:
+        raise ValueError("Unknown bin statistic: %s" % stat)
+    return centers, values, counts
+
+def fit_bins(centers, values, weights=None):
+    """Weighted linear least squares fit of values = p*cos(x) + q*sin(x) + c, returns [a, b (deg), c]"""
+    xr = np.deg2rad(centers)
+    A = np.column_stack([np.cos(xr), np.sin(xr), np.ones_like(xr)])
+    if weights is not None:
+        w = np.sqrt(weights)
+        A = A*w[:,np.newaxis]
+        values = values*w
+    (p, q, c), _, _, _ = np.linalg.lstsq(A, values, rcond=None)
+    return np.array([np.hypot(p, q), np.rad2deg(np.arctan2(q, p)), c])
+
+def compute_offset_nuth(diff, slope, aspect, bin_width=2.0, min_count=100, stat='median', stride=1, \
+        remove_outliers=True, plot=True):
+    """
+    Drop-in replacement for coreglib.compute_offset_nuth using binned statistics.
+    Parameters:
+    - diff, slope, aspect (np.ma.array): Elevation difference (src - ref), slope and aspect (degrees).
+    - bin_width (float): Aspect bin width (degrees).
+    - min_count (int): Minimum number of samples for a bin to be used in the fit.
+    - stat (str): Bin statistic, one of nuth_stat_choices.
+    - stride (int): Subsample pixels with this stride in each dimension.
+    Returns:
+    - fit_param (np.array): [a, b (degrees), c], or None if too few bins are populated.
+    - fig (matplotlib.figure.Figure): Plot of bin values and fit, or None.
+    """
+    x, y = nuth_samples(diff, slope, aspect, stride=stride, remove_outliers=remove_outliers)
+    print("Nuth and Kaab binned fit: %i samples (stride %i), bin statistic: %s" % (y.size, stride, stat))
+    centers, values, counts = bin_stats(x, y, bin_width=bin_width, stat=stat)
+    #Scale minimum count with the sampling stride
+    valid = counts >= max(min_count//(stride**2), 1)
+    #Need bins covering enough of the circle to separate cos and sin terms
+    if valid.sum() < 3:
+        print("Too few aspect bins with at least %i samples" % min_count)
+        return None, None
+    fit_param = fit_bins(centers[valid], values[valid], weights=counts[valid])
+    fig = None
+    if plot:
+        fig, ax = plt.subplots(figsize=(6, 4))
+        xp = np.linspace(0, 360, 361)
+        ax.plot(centers[valid], values[valid], 'k.', label='Bin %s' % stat)
+        ax.plot(xp, fit_param[0]*np.cos(np.deg2rad(fit_param[1] - xp)) + fit_param[2], 'r-', label='Fit')
+        ax.axhline(0, color='k', linewidth=0.5)
+        ax.set_xlim(0, 360)
+        ax.set_xlabel('Aspect (degrees)')
+        ax.set_ylabel('dh/tan(slope) (m)')
+        ax.legend(loc='lower right', fontsize=8)
+        ax.set_title('a=%0.2f m, b=%0.1f deg, c=%0.2f m' % tuple(fit_param))
+    return fit_param, fig
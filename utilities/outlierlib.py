@@ -0,0 +1,132 @@
+"""
+Streaming outlier filter for elevation differences.
+Valid dz values are binned into a fixed-width histogram over [-max_dz, max_dz] in one pass over
+strips of rows, then the median and MAD (or percentiles for perc mode) are read from the histogram
+and the range filter is applied in a second pass, strip by strip. Neither pass sorts or copies the
+full array, so memory beyond the output mask depends on the strip size, and disk-backed (np.memmap)
+differences are read sequentially.
+
+Quantiles are interpolated within bins, so they are accurate to about bin_width. The number of bins
+is capped (max_bins), so for a large max_dz the bins are wider than the requested bin_width. The MAD
+is the median of |dz - median| taken from the same histogram folded about the median, no second pass
+needed.
+Pixel counts for each stage are accumulated during the passes instead of with extra count() calls.
+"""
+import numpy as np
+
+#'hist' is the streaming filter here, 'exact' is filtlib on the full array
+outlier_method_choices = ['hist', 'exact']
+
+def row_blocks(shape, block_px=2**20):
+    """Slices over axis 0 with about block_px elements each"""
+    row_px = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+    rows = max(1, block_px // max(1, row_px))
+    for y in range(0, shape[0], rows):
+        yield slice(y, min(y + rows, shape[0]))
+
+class DzHistogram(object):
+    """
+    Fixed-width histogram of dz over [-max_dz, max_dz], accumulated block by block.
+
+    Example:
+    h = DzHistogram(max_dz=100)
+    for d in blocks:
+        h.update(d)
+    med, mad = h.median_mad()
+    """
+    def __init__(self, max_dz=100, bin_width=0.001, max_bins=2**18):
+        """
+        Parameters:
+        - max_dz (float): Histogram range is [-max_dz, max_dz], values outside are clipped into the end bins.
+        - bin_width (float): Bin width (m), widened if the range would need more than max_bins.
+        - max_bins (int): Maximum number of bins, bounds memory (8 bytes per bin) and the per-block cost.
+        """
+        self.lo = -float(max_dz)
+        self.bin_width = max(bin_width, 2.*max_dz/(max_bins - 1))
+        self.nbins = int(np.ceil(2*max_dz/self.bin_width)) + 1
+        self.hist = np.zeros(self.nbins, dtype=np.int64)
+        self.count = 0
+
+    def update(self, d):
+        """Add 1D array of valid values"""
+        if d.size == 0:
+            return
+        idx = ((d - self.lo)/self.bin_width).astype(np.int64)
+        np.clip(idx, 0, self.nbins - 1, out=idx)
+        self.hist += np.bincount(idx, minlength=self.nbins)
+        self.count += d.size
+
+    def merge(self, other):
+        self.hist += other.hist
+        self.count += other.count
+        return self
+
+    def centers(self):
+        return self.lo + (np.arange(self.nbins) + 0.5)*self.bin_width
+
+    def quantile(self, q):
+        """Value at fraction q (scalar or array, 0-1) of the count, interpolated within the bin"""
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        cdf = np.cumsum(self.hist)
+        target = q*self.count
+        idx = np.clip(np.searchsorted(cdf, target, side='left'), 0, self.nbins - 1)
+        below = cdf[idx] - self.hist[idx]
+        frac = (target - below)/np.maximum(self.hist[idx], 1)
+        out = self.lo + (idx + np.clip(frac, 0, 1))*self.bin_width
+        return out if out.size > 1 else float(out[0])
+
+    def median_mad(self):
+        """Median and (unscaled) median absolute deviation"""
+        med = self.quantile(0.5)
+        #Fold non-empty bins about the median: MAD is the median of the bin distances, weighted by counts
+        nz = np.flatnonzero(self.hist)
+        dist = np.abs(self.lo + (nz + 0.5)*self.bin_width - med)
+        order = np.argsort(dist, kind='mergesort')
+        cdf = np.cumsum(self.hist[nz][order])
+        k = min(int(np.searchsorted(cdf, 0.5*self.count, side='left')), nz.size - 1)
+        return med, float(dist[order[k]])
+
+def outlier_filter(diff, f=3, perc=None, max_dz=100, bin_width=0.001, max_bins=2**18, block_px=2**20):
+    """
+    Mask |dz| > max_dz, then values outside median +/- f*NMAD, or outside the perc percentiles.
+    Equivalent to filtlib.mad_fltr/perc_fltr after the absolute filter, to within bin_width.
+    Parameters:
+    - diff (np.ma.array): Elevation difference, any shape, may be backed by np.memmap.
+    - f (float): Number of NMAD (1.4826*MAD) from the median to keep.
+    - perc (tuple): Lower and upper percentiles to keep, used instead of f if given.
+    - max_dz (float): Absolute dz limit.
+    - bin_width (float): Histogram bin width (m).
+    - max_bins (int): Maximum number of histogram bins.
+    - block_px (int): Approximate number of pixels per strip.
+    Returns:
+    - out (np.ma.array): diff data with a new mask, the data is not copied.
+    - counts (dict): Valid pixel counts after each stage ('initial', 'max_dz', 'final') and the kept 'range'.
+    """
+    data = np.ma.getdata(diff)
+    mask = np.ma.getmaskarray(diff)
+    h = DzHistogram(max_dz, bin_width, max_bins)
+    n_init = 0
+    for sl in row_blocks(data.shape, block_px):
+        d = data[sl][~mask[sl]]
+        n_init += d.size
+        h.update(d[np.abs(d) <= max_dz])
+    if h.count == 0:
+        lo, hi = -max_dz, max_dz
+    elif perc is not None:
+        lo, hi = h.quantile(np.array(perc, dtype=np.float64)/100.)
+    else:
+        med, mad = h.median_mad()
+        nmad = 1.4826*mad
+        lo, hi = med - f*nmad, med + f*nmad
+    lo, hi = max(lo, -max_dz), min(hi, max_dz)
+    out_mask = np.empty(data.shape, dtype=bool)
+    n_final = 0
+    for sl in row_blocks(data.shape, block_px):
+        d = data[sl]
+        m = out_mask[sl]
+        #NaN fails both comparisons, so it is masked too
+        np.logical_or(mask[sl], ~((d >= lo) & (d <= hi)), out=m)
+        n_final += m.size - np.count_nonzero(m)
+    out = np.ma.array(data, mask=out_mask, copy=False, fill_value=getattr(diff, 'fill_value', None))
+    counts = {'initial':n_init, 'max_dz':h.count, 'final':n_final, 'range':[float(lo), float(hi)]}
+    return out, counts
@@ -0,0 +1,98 @@
+import os
+from osgeo import gdal
+
+from pygeotools.lib import iolib, warplib, geolib
+from dem_align import get_shift
+import statslib
+import writelib
+
+#Products that can be written by align_pipeline
+product_choices = ['align', 'shifted', 'matched', 'dod']
+
+def match_ds(src_dem_ds, ref_dem_ds, res, extent):
+    """
+    Match resolution and extent of two DEM datasets in memory.
+    Parameters:
+    - src_dem_ds (gdal.Dataset): Source DEM, defines the output projection.
+    - ref_dem_ds (gdal.Dataset): Reference DEM.
+    - res (str): Resolution option, 'min', 'max', 'mean', 'common_scale_factor'.
+    - extent (str): Extent option, 'intersection', 'union', 'first', 'second'.
+    Returns:
+    - src_match_ds, ref_match_ds (gdal.Dataset): MEM datasets on a common grid.
+    """
+    local_srs = geolib.get_ds_srs(src_dem_ds)
+    ref_match_ds, src_match_ds = warplib.memwarp_multi([ref_dem_ds, src_dem_ds], \
+            extent=extent, res=res, t_srs=local_srs, r='cubic')
+    return src_match_ds, ref_match_ds
+
+def align_pipeline(ref_dem_fn, src_dem_fn, outdir, mode='nuth', res='max', extent='intersection', \
+        diff_ref_fn=None, products=('dod',), log_file=None, **kwargs):
+    """
+    Run get_shift -> shift -> match -> diff -> stats with in-memory datasets between stages.
+    Only the products listed in `products` are written to disk.
+    Parameters:
+    - ref_dem_fn (str): Reference DEM used for alignment.
+    - src_dem_fn (str): Source DEM to be shifted.
+    - outdir (str): Output directory.
+    - mode, res: Options for get_shift; res is also used for matching.
+    - extent (str): Extent option for matching the shifted source and difference reference.
+    - diff_ref_fn (str): Reference DEM for the DoD, defaults to ref_dem_fn.
+    - products (list): Any of 'align' (get_shift output), 'shifted', 'matched', 'dod'.
+    - log_file (str): DoD statistics log, default is outdir/Matched_DoD_Stats.txt.
+    - kwargs: Additional options passed to get_shift, out_profile also sets the GeoTIFF layout of products.
+    Returns:
+    - result (dict): shift, DoD stats, and filenames of written products.
+    """
+    for p in products:
+        if p not in product_choices:
+            raise ValueError("Unknown product: %s, choices are %s" % (p, product_choices))
+    if diff_ref_fn is None:
+        diff_ref_fn = ref_dem_fn
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if log_file is None:
+        log_file = os.path.join(outdir, 'Matched_DoD_Stats.txt')
+    src_prefix = os.path.join(outdir, os.path.splitext(os.path.split(src_dem_fn)[-1])[0])
+    ref_prefix = os.path.join(outdir, os.path.splitext(os.path.split(diff_ref_fn)[-1])[0])
+    out_fns = {}
+    out_profile = kwargs.get('out_profile', writelib.default_profile)
+
+    align_fn, shift = get_shift(ref_dem_fn, src_dem_fn, outdir, mode=mode, res=res, \
+            write_align=('align' in products), **kwargs)
+    if align_fn is not None:
+        out_fns['align'] = align_fn
+
+    #Shift by VRT geotransform and offset, pixels are only read when matched or written
+    src_orig_ds = gdal.Open(src_dem_fn)
+    src_dem_ds = writelib.shifted_vrt_ds(src_orig_ds, *shift)
+    if 'shifted' in products:
+        out_fns['shifted'] = src_prefix + '_shifted.tif'
+        print("Writing shifted source DEM: %s" % out_fns['shifted'])
+        writelib.write_windowed(src_dem_ds, out_fns['shifted'], profile=out_profile)
+
+    print("Matching shifted source DEM to reference: %s" % diff_ref_fn)
+    src_match_ds, ref_match_ds = match_ds(src_dem_ds, gdal.Open(diff_ref_fn), res, extent)
+    src_dem_ds = None
+    src_orig_ds = None
+    src_match = iolib.ds_getma(src_match_ds)
+    ref_match = iolib.ds_getma(ref_match_ds)
+    if 'matched' in products:
+        out_fns['src_matched'] = src_prefix + '_matched.tif'
+        out_fns['ref_matched'] = ref_prefix + '_matched.tif'
+        writelib.write_ma(src_match, out_fns['src_matched'], src_match_ds, profile=out_profile)
+        writelib.write_ma(ref_match, out_fns['ref_matched'], ref_match_ds, profile=out_profile)
+
+    diff = src_match - ref_match
+    src_match = None
+    ref_match = None
+    stats = statslib.diff_stats(diff)
+    res_out = geolib.get_res(src_match_ds, square=True)[0]
+    dod_fn = os.path.join(outdir, 'Matched_DoD.tif')
+    statslib.log_DoD_Stats(stats, src_dem_fn, diff_ref_fn, dod_fn, outdir, res_out, res_out, log_file)
+    if 'dod' in products:
+        out_fns['dod'] = dod_fn
+        print("Writing out difference map: %s" % dod_fn)
+        writelib.write_ma(diff, dod_fn, ref_match_ds, profile=out_profile)
+    src_match_ds = None
+    ref_match_ds = None
+    return {'shift':shift, 'stats':stats, 'log_file':log_file, 'products':out_fns}
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def peak_rss_mb():
+    """High-water mark of process resident memory (MB), None if unavailable"""
+    if resource is not None:
+        #ru_maxrss is kB on Linux, bytes on macOS
+        scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+    if psutil is not None:
+        mi = psutil.Process().memory_info()
+        #peak_wset is the Windows high-water mark
+        return getattr(mi, 'peak_wset', mi.rss)/1024.**2
+    return None
+
+class Profiler(object):
+    """
+    Lightweight per-stage and per-iteration timers with process memory.
+    Stages are context managers, or start/stop pairs around a block; when disabled, they do nothing.
+    The resident memory high-water mark is process-wide, so a stage record carries the mark as it stood
+    when the stage ended (process_peak_rss_mb), which includes the peaks of earlier stages. Only the
+    growth of the mark during the stage (rss_growth_mb) is attributable to that stage.
+
+    Example:
+    prof = Profiler()
+    prof.set_iteration(1)
+    with prof.stage('warp'):
+        ...
+    stage = prof.start('fit')
+    ...
+    prof.stop(stage)
+    prof.summary()
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.records = []
+        self.current_iter = None
+        self.t_start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        stage = self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(stage)
+
+    def start(self, name):
+        """Start timing stage name, returns the handle to pass to stop() (None when disabled)"""
+        if not self.enabled:
+            return None
+        return (name, self.current_iter, time.perf_counter(), peak_rss_mb())
+
+    def stop(self, stage):
+        """Record the stage started by start()"""
+        if stage is None:
+            return
+        t1 = time.perf_counter()
+        rss1 = peak_rss_mb()
+        name, n, t0, rss0 = stage
+        rec = {'name':name, 'iter':n, 'start':t0 - self.t_start, 'time':t1 - t0, 'process_peak_rss_mb':rss1}
+        if rss0 is not None:
+            #Growth of the high-water mark is attributed to the stage that caused it
+            rec['rss_growth_mb'] = rss1 - rss0
+        self.records.append(rec)
+
+    def set_iteration(self, n):
+        """Tag subsequent stages with iteration number n (None for stages outside the loop)"""
+        self.current_iter = n
+
+    def summary(self):
+        """
+        Return dict with totals per stage and stage times per iteration.
+        Per stage, process_peak_rss_mb is the process high-water mark at the end of its last call, and
+        rss_growth_mb the total rise of the mark during its calls.
+        """
+        stages = {}
+        iterations = {}
+        for rec in self.records:
+            s = stages.setdefault(rec['name'], {'time':0.0, 'calls':0, 'process_peak_rss_mb':None, 'rss_growth_mb':0.0})
+            s['time'] += rec['time']
+            s['calls'] += 1
+            if rec['process_peak_rss_mb'] is not None:
+                s['process_peak_rss_mb'] = max(s['process_peak_rss_mb'] or 0, rec['process_peak_rss_mb'])
+                s['rss_growth_mb'] += rec.get('rss_growth_mb', 0)
+            if rec['iter'] is not None:
+                it = iterations.setdefault(rec['iter'], {'iter':rec['iter'], 'start':rec['start'], 'end':0.0})
+                it[rec['name']] = it.get(rec['name'], 0) + rec['time']
+                it['start'] = min(it['start'], rec['start'])
+                it['end'] = max(it['end'], rec['start'] + rec['time'])
+        for it in iterations.values():
+            #Wall time from first to last stage of the iteration
+            it['time'] = it.pop('end') - it.pop('start')
+        return {'stages':stages, 'iterations':[iterations[k] for k in sorted(iterations)], \
+                'process_peak_rss_mb':peak_rss_mb()}
+
+    def write_trace(self, trace_fn):
+        """Write records as Chrome trace event JSON (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        events = []
+        for rec in self.records:
+            args = {'iter':rec['iter'], 'process_peak_rss_mb':rec['process_peak_rss_mb'], \
+                    'rss_growth_mb':rec.get('rss_growth_mb')}
+            events.append({'name':rec['name'], 'ph':'X', 'pid':pid, 'tid':0, \
+                    'ts':rec['start']*1E6, 'dur':rec['time']*1E6, 'args':args})
+        with open(trace_fn, 'w') as f:
+            json.dump({'traceEvents':events, 'displayTimeUnit':'ms'}, f)
+        return trace_fn
+
+#Used when profiling is off, so callers never need to check for None
+null_profiler = Profiler(enabled=False)
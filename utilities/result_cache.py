@@ -0,0 +1,120 @@
+import os
+import json
+import hashlib
+from xml.etree import ElementTree
+
+#get_shift options that change the estimated shift; anything else (outdir, plotting, output format) is ignored
+key_params = ['mode', 'res', 'mask_list', 'max_offset', 'max_dz', 'slope_lim', 'tiltcorr', 'polyorder', 'max_iter', \
+        'tol', 'warp_engine', 'terrain_cache_px', 'pyramid_levels', 'pyramid_iter', 'init_shift', \
+        'nuth_solver', 'nuth_stat', 'nuth_stride', 'ensemble_modes', \
+        'sample_budget', 'sample_seed', 'sidecar', 'outlier_method', 'convergence']
+
+def file_sig(fn, hash_inputs=False, blocksize=2**20):
+    """Identify file content by size and mtime, or by sha1 of the content if hash_inputs"""
+    st = os.stat(fn)
+    if not hash_inputs:
+        return [os.path.abspath(fn), st.st_size, st.st_mtime]
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return [st.st_size, h.hexdigest()]
+
+def vrt_sources(fn):
+    """Sorted absolute filenames of the sources of a VRT mosaic, empty for other VRTs"""
+    vrt_dir = os.path.dirname(os.path.abspath(fn))
+    out = set()
+    for el in ElementTree.parse(fn).getroot().iter('SourceFilename'):
+        src_fn = el.text.strip()
+        if el.get('relativeToVRT') == '1':
+            src_fn = os.path.join(vrt_dir, src_fn)
+        out.add(os.path.abspath(src_fn))
+    return sorted(out)
+
+def input_sig(fn, hash_inputs=False):
+    """
+    file_sig of an input DEM. A VRT mosaic (e.g. the tiled reference from footprint.resolve_reference,
+    written per outdir) is identified by the signatures of its tiles, not by its own path and mtime.
+    """
+    if os.path.splitext(fn)[1].lower() == '.vrt':
+        src_fn_list = vrt_sources(fn)
+        if src_fn_list:
+            return [file_sig(src_fn, hash_inputs) for src_fn in src_fn_list]
+    return file_sig(fn, hash_inputs)
+
+def normalize_params(params):
+    """Subset of params in key_params, with tuples as lists so equal settings give equal json"""
+    out = {}
+    for k in key_params:
+        v = params.get(k)
+        if isinstance(v, tuple):
+            v = list(v)
+        if isinstance(v, list):
+            v = [float(x) if isinstance(x, (int, float)) and not isinstance(x, bool) else x for x in v]
+        elif isinstance(v, int) and not isinstance(v, bool):
+            v = float(v)
+        out[k] = v
+    return out
+
+class ResultCache(object):
+    """
+    On-disk cache of get_shift results, keyed on both input files and the normalized parameters.
+    Each entry is one json file (the _align_stats.json content) named by the key, so several
+    processes can share a cache directory without a common index file. Entries are evicted
+    least recently used first when there are more than max_entries or they exceed max_bytes.
+    """
+    def __init__(self, cache_dir, max_entries=1000, max_bytes=None, hash_inputs=False):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hash_inputs = hash_inputs
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def make_key(self, ref_dem_fn, src_dem_fn, params):
+        d = {'ref':input_sig(ref_dem_fn, self.hash_inputs), 'src':input_sig(src_dem_fn, self.hash_inputs), \
+                'params':normalize_params(params)}
+        return hashlib.sha1(json.dumps(d, sort_keys=True).encode()).hexdigest()
+
+    def entry_fn(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """Return cached stats dict or None; a hit marks the entry as recently used"""
+        fn = self.entry_fn(key)
+        try:
+            with open(fn) as f:
+                stats = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        os.utime(fn, None)
+        return stats
+
+    def put(self, key, stats):
+        fn = self.entry_fn(key)
+        #Write to a temporary file and rename, so readers never see a partial entry
+        tmp_fn = '%s.%i.tmp' % (fn, os.getpid())
+        with open(tmp_fn, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp_fn, fn)
+        self.evict()
+        return fn
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        #Most recently used first
+        entries.sort(reverse=True)
+        nbytes = 0
+        for i, (mtime, size, fn) in enumerate(entries):
+            nbytes += size
+            if (self.max_entries is not None and i >= self.max_entries) or \
+                    (self.max_bytes is not None and nbytes > self.max_bytes):
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
@@ -0,0 +1,114 @@
+"""
+Fixed sample of stable-terrain pixels for iterative offset estimation.
+Samples are drawn once on the reference grid, stratified by reference slope and aspect so every
+aspect bin needed by the Nuth and Kaab fit is represented. Each iteration bilinearly interpolates
+the unshifted source at the sample positions displaced by the cumulative shift, so the per-iteration
+cost depends on the sample budget, not the raster size.
+"""
+import numpy as np
+
+from pygeotools.lib import iolib, geolib
+
+def stratum_quota(counts, budget):
+    """Per-stratum sample counts summing to min(budget, counts.sum()), as equal as possible (water-filling)"""
+    if counts.sum() <= budget:
+        return counts.copy()
+    lo, hi = 0, int(counts.max())
+    #Largest per-stratum cap q with sum(min(counts, q)) <= budget
+    while lo < hi:
+        q = (lo + hi + 1)//2
+        if np.minimum(counts, q).sum() <= budget:
+            lo = q
+        else:
+            hi = q - 1
+    quota = np.minimum(counts, lo)
+    #Remainder, less than one per stratum, goes to strata that still have pixels left
+    extra = budget - quota.sum()
+    quota[np.flatnonzero(counts > quota)[:extra]] += 1
+    return quota
+
+def stratified_sample(valid, slope, aspect, budget, slope_bins=(0, 5, 10, 20, 30, 90), aspect_bin_width=30, seed=0):
+    """
+    Choose up to budget pixels from valid, with equal allocation across slope x aspect strata.
+    Returns:
+    - idx (np.array): Flat indices of the selected pixels, sorted.
+    """
+    rng = np.random.RandomState(seed)
+    idx = np.flatnonzero(valid)
+    if idx.size <= budget:
+        return idx
+    s = np.digitize(slope.ravel()[idx], slope_bins[1:-1])
+    a = (np.mod(aspect.ravel()[idx], 360)//aspect_bin_width).astype(np.int64)
+    na = int(np.ceil(360./aspect_bin_width))
+    stratum = s*na + a
+    counts = np.bincount(stratum, minlength=(len(slope_bins)-1)*na)
+    quota = stratum_quota(counts, budget)
+    #Random order within each stratum, then keep the first quota[stratum] pixels
+    order = np.lexsort((rng.random_sample(idx.size), stratum))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(idx.size) - starts[stratum[order]]
+    return np.sort(idx[order[rank < quota[stratum[order]]]])
+
+def bilinear(a, rows, cols):
+    """Bilinear interpolation of masked array a at fractional (rows, cols), masked where any neighbor is invalid"""
+    m = np.ma.getmaskarray(a)
+    d = np.ma.getdata(a)
+    r0 = np.floor(rows).astype(np.int64)
+    c0 = np.floor(cols).astype(np.int64)
+    fr = rows - r0
+    fc = cols - c0
+    out = (r0 < 0) | (c0 < 0) | (r0 >= a.shape[0]-1) | (c0 >= a.shape[1]-1)
+    r0 = np.clip(r0, 0, a.shape[0]-2)
+    c0 = np.clip(c0, 0, a.shape[1]-2)
+    z = (d[r0,c0]*(1-fr)*(1-fc) + d[r0,c0+1]*(1-fr)*fc + d[r0+1,c0]*fr*(1-fc) + d[r0+1,c0+1]*fr*fc)
+    mask = out | m[r0,c0] | m[r0,c0+1] | m[r0+1,c0] | m[r0+1,c0+1]
+    return np.ma.array(z, mask=mask)
+
+class SampleSet(object):
+    """
+    Stratified sample of stable-terrain pixels on the reference grid.
+
+    Example:
+    samples = SampleSet(ref_ds, src_ds, static_mask, budget=2000000)
+    diff = samples.diff(dx_total, dy_total, dz_total)
+    """
+    def __init__(self, ref_ds, src_ds, static_mask=None, budget=2000000, slope_lim=(0.1, 40), seed=0):
+        """
+        Parameters:
+        - ref_ds, src_ds (gdal.Dataset): Reference and unshifted source DEM on the same grid.
+        - static_mask (np.array): True where pixels should not be used.
+        - budget (int): Maximum number of samples.
+        - slope_lim (tuple): Reference slope limits (degrees) for samples.
+        - seed (int): Random seed, so repeated runs use the same samples.
+        """
+        self.gt = src_ds.GetGeoTransform()
+        ref = iolib.ds_getma(ref_ds)
+        #Unshifted source is kept for interpolation at shifted positions
+        self.src = iolib.ds_getma(src_ds)
+        slope = geolib.gdaldem_mem_ds(ref_ds, processing='slope', returnma=True, computeEdges=False)
+        aspect = geolib.gdaldem_mem_ds(ref_ds, processing='aspect', returnma=True, computeEdges=False)
+        valid = ~(np.ma.getmaskarray(ref) | np.ma.getmaskarray(self.src) | np.ma.getmaskarray(slope) | \
+                np.ma.getmaskarray(aspect))
+        if static_mask is not None:
+            valid &= ~static_mask
+        valid &= (slope.filled(-1) >= slope_lim[0]) & (slope.filled(-1) <= slope_lim[1])
+        idx = stratified_sample(valid, slope.filled(0), aspect.filled(0), budget, seed=seed)
+        self.rows, self.cols = np.unravel_index(idx, ref.shape)
+        self.ref = np.ma.getdata(ref).ravel()[idx]
+        self.slope = np.ma.array(np.ma.getdata(slope).ravel()[idx])
+        self.aspect = np.ma.array(np.ma.getdata(aspect).ravel()[idx])
+        print("Sampled %i of %i valid pixels (budget %i, seed %i)" % (idx.size, valid.sum(), budget, seed))
+
+    def __len__(self):
+        return self.rows.size
+
+    def src_values(self, dx, dy, dz):
+        """Source elevations at sample positions after shifting the source by (dx, dy, dz)"""
+        #Shifted source at pixel (r, c) is the original source at (r - dy/gt[5], c - dx/gt[1])
+        rows = self.rows - dy/self.gt[5]
+        cols = self.cols - dx/self.gt[1]
+        return bilinear(self.src, rows, cols) + dz
+
+    def diff(self, dx, dy, dz):
+        """Elevation difference (src - ref) at the samples for the cumulative shift"""
+        return self.src_values(dx, dy, dz) - self.ref
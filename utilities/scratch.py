@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+class Scratch(object):
+    """
+    Allocate full-resolution intermediates in RAM, or as np.memmap files once they would exceed a memory ceiling.
+    Files are created in scratch_dir (a temporary directory by default) and removed by cleanup().
+
+    Example:
+    scratch = Scratch(mem_limit=8*1024**3)
+    diff = scratch.masked_subtract(src_dem, ref_dem, 'diff')
+    ...
+    scratch.cleanup()
+    """
+    def __init__(self, scratch_dir=None, mem_limit=None):
+        """
+        Parameters:
+        - scratch_dir (str): Directory for memmap files. If given without mem_limit, always use disk.
+        - mem_limit (float): Memory ceiling (bytes) for intermediates, above which arrays are disk-backed.
+        """
+        self.scratch_dir = scratch_dir
+        self.mem_limit = mem_limit
+        self.disk = False
+        self.fn_list = []
+        self._tmpdir = None
+
+    def plan(self, shape, n_float=6, n_bool=3, itemsize=4):
+        """Decide whether to use disk for n_float float and n_bool boolean arrays of shape"""
+        nbytes = int(np.prod(shape))*(n_float*itemsize + n_bool)
+        if self.mem_limit is not None:
+            self.disk = nbytes > self.mem_limit
+        else:
+            self.disk = self.scratch_dir is not None
+        if self.disk:
+            print("Intermediates %0.1f GB, using memory-mapped scratch arrays" % (nbytes/1024.**3))
+        return self.disk
+
+    def _fn(self, name):
+        if self.scratch_dir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='dem_align_scratch_')
+            self.scratch_dir = self._tmpdir
+        elif not os.path.exists(self.scratch_dir):
+            os.makedirs(self.scratch_dir)
+        fn = os.path.join(self.scratch_dir, '%s_%i_%i.dat' % (name, os.getpid(), len(self.fn_list)))
+        self.fn_list.append(fn)
+        return fn
+
+    def empty(self, shape, dtype=np.float32, name='scratch'):
+        if not self.disk:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._fn(name), dtype=dtype, mode='w+', shape=shape)
+
+    def masked_empty(self, shape, dtype=np.float32, name='scratch'):
+        """Masked array with data and mask both allocated by empty(), mask is all False"""
+        a = np.ma.array(self.empty(shape, dtype, name), mask=self.empty(shape, bool, name + '_mask'), copy=False)
+        a.mask[:] = False
+        return a
+
+    def masked_subtract(self, a, b, name='diff'):
+        """Return a - b as a scratch-backed masked array, without a temporary for the mask"""
+        out = self.masked_empty(a.shape, np.result_type(np.ma.getdata(a), np.ma.getdata(b)), name)
+        np.subtract(np.ma.getdata(a), np.ma.getdata(b), out=out.data)
+        np.logical_or(np.ma.getmaskarray(a), np.ma.getmaskarray(b), out=out.mask)
+        return out
+
+    def logical_or(self, a, b, name='mask'):
+        out = self.empty(np.shape(a), bool, name)
+        np.logical_or(a, b, out=out)
+        return out
+
+    def cleanup(self):
+        """Remove memmap files; arrays backed by them must not be used afterwards"""
+        for fn in self.fn_list:
+            try:
+                os.remove(fn)
+            except OSError:
+                #Still mapped on Windows, removed with the temporary directory below if possible
+                pass
+        self.fn_list = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+            self.scratch_dir = None
@@ -0,0 +1,151 @@
+"""
+Persistent slope, aspect and static mask rasters for a source DEM.
+Layers are computed once on the native grid of the unshifted DEM and stored as tiled, compressed
+GeoTIFFs tagged with the DEM checksum and layer parameters (e.g., mask_list), next to the DEM or in
+a shared directory. Each iteration warps them, with the cumulative horizontal shift applied to the
+geotransform, onto the current clipped grid, so GDAL only reads the windows it needs.
+
+Sidecars are the fallback for TerrainCache misses: the in-memory cache still serves repeated
+lookups within a run, the sidecar avoids recomputing (and rasterizing dem_mask layers) across runs.
+Slope and aspect are computed at the native DEM resolution, not the coregistration resolution.
+"""
+import os
+import json
+import hashlib
+
+from osgeo import gdal
+import numpy as np
+
+from pygeotools.lib import iolib
+from demcoreg import dem_mask
+from result_cache import file_sig
+from terrain_cache import TerrainCache
+import writelib
+
+#Sidecar rasters are intermediate products, always tiled and compressed
+sidecar_profile = 'deflate'
+#Resampling onto the clipped grid; aspect is circular, so it is not interpolated
+layer_resample = {'slope':'bilinear', 'aspect':'near', 'static_mask':'near'}
+
+class SidecarStore(object):
+    """
+    Slope, aspect and static mask rasters for one source DEM, reused across runs.
+
+    Example:
+    sidecar = SidecarStore(src_dem_fn)
+    sidecar.bind(src_dem_ds_align)
+    static_mask = sidecar.static_mask(src_dem_clip_ds, src_dem_ds_align, mask_list)
+    """
+    def __init__(self, dem_fn, sidecar_dir=None):
+        """
+        Parameters:
+        - dem_fn (str): Source DEM filename.
+        - sidecar_dir (str): Directory for the rasters, default is <dem>_sidecar next to the DEM.
+        """
+        self.dem_fn = dem_fn
+        self.prefix = os.path.splitext(os.path.split(dem_fn)[-1])[0]
+        if sidecar_dir is None:
+            sidecar_dir = os.path.splitext(dem_fn)[0] + '_sidecar'
+        self.sidecar_dir = sidecar_dir
+        if not os.path.exists(sidecar_dir):
+            os.makedirs(sidecar_dir)
+        self.checksum = self.dem_checksum()
+        self.origin0 = None
+        self.hits = 0
+        self.misses = 0
+
+    def dem_checksum(self):
+        """sha1 of the DEM content, rehashed only if size or modification time changed since the last run"""
+        sig_fn = os.path.join(self.sidecar_dir, self.prefix + '_checksum.json')
+        fast_sig = file_sig(self.dem_fn)[1:]
+        try:
+            with open(sig_fn) as f:
+                d = json.load(f)
+            if d['sig'] == fast_sig:
+                return d['sha1']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        print("Computing checksum: %s" % self.dem_fn)
+        sha1 = file_sig(self.dem_fn, hash_inputs=True)[1]
+        with open(sig_fn, 'w') as f:
+            json.dump({'sig':fast_sig, 'sha1':sha1}, f)
+        return sha1
+
+    def bind(self, src_ds):
+        """Record the origin of the working source dataset before any shift is applied"""
+        self.origin0 = TerrainCache.src_origin(src_ds)
+
+    def layer_fn(self, name, params):
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+        return os.path.join(self.sidecar_dir, '%s_%s_%s.tif' % (self.prefix, name, key))
+
+    def is_valid(self, fn):
+        if not os.path.exists(fn):
+            return False
+        ds = gdal.Open(fn)
+        return ds is not None and ds.GetMetadataItem('dem_checksum') == self.checksum
+
+    def layer(self, name, params, make):
+        """
+        Return filename of a native-grid layer, computing it with make(dem_ds, out_fn) if missing or stale.
+        Written to a temporary file and renamed, so concurrent runs never read a partial raster.
+        """
+        fn = self.layer_fn(name, params)
+        if self.is_valid(fn):
+            self.hits += 1
+            return fn
+        self.misses += 1
+        print("Computing %s sidecar: %s" % (name, fn))
+        tmp_fn = '%s_%i_tmp.tif' % (os.path.splitext(fn)[0], os.getpid())
+        dem_ds = gdal.Open(self.dem_fn)
+        make(dem_ds, tmp_fn)
+        dem_ds = None
+        ds = gdal.Open(tmp_fn, gdal.GA_Update)
+        ds.SetMetadata({'dem_checksum':self.checksum, 'layer':name, 'params':json.dumps(params)})
+        ds = None
+        os.replace(tmp_fn, fn)
+        return fn
+
+    def read(self, fn, clip_ds, src_ds, r='near'):
+        """Warp a native-grid layer, shifted with the source, onto the clip_ds grid"""
+        gt = clip_ds.GetGeoTransform()
+        nx, ny = clip_ds.RasterXSize, clip_ds.RasterYSize
+        ds = gdal.Open(fn)
+        dx, dy = TerrainCache.src_origin(src_ds) - self.origin0
+        vrt_ds = gdal.Translate('', ds, format='VRT')
+        vrt_ds.SetGeoTransform(tuple(writelib.shifted_gt(ds, dx, dy)))
+        bounds = (gt[0], gt[3] + ny*gt[5], gt[0] + nx*gt[1], gt[3])
+        opt = gdal.WarpOptions(format='MEM', outputBounds=bounds, width=nx, height=ny, \
+                dstSRS=clip_ds.GetProjection(), resampleAlg=r)
+        out_ds = gdal.Warp('', vrt_ds, options=opt)
+        a = iolib.ds_getma(out_ds)
+        out_ds = None
+        vrt_ds = None
+        return a
+
+    def slope(self, clip_ds, src_ds):
+        """Unfiltered slope (degrees) on the clip_ds grid"""
+        def make(dem_ds, out_fn):
+            gdal.DEMProcessing(out_fn, dem_ds, 'slope', format='GTiff', computeEdges=False, \
+                    creationOptions=writelib.creation_options(sidecar_profile))
+        return self.read(self.layer('slope', {}, make), clip_ds, src_ds, layer_resample['slope'])
+
+    def aspect(self, clip_ds, src_ds):
+        """Aspect (degrees) on the clip_ds grid"""
+        def make(dem_ds, out_fn):
+            gdal.DEMProcessing(out_fn, dem_ds, 'aspect', format='GTiff', computeEdges=False, \
+                    creationOptions=writelib.creation_options(sidecar_profile))
+        return self.read(self.layer('aspect', {}, make), clip_ds, src_ds, layer_resample['aspect'])
+
+    def static_mask(self, clip_ds, src_ds, mask_list):
+        """Static mask (True where excluded) on the clip_ds grid, pixels outside the DEM are excluded"""
+        def make(dem_ds, out_fn):
+            mask = dem_mask.get_mask(dem_ds, mask_list, self.dem_fn, writeout=False)
+            #Stored as 0/1 bytes, 255 is nodata
+            writelib.write_ma(np.asarray(mask, dtype=np.uint8), out_fn, dem_ds, ndv=255, profile=sidecar_profile)
+        a = self.read(self.layer('static_mask', {'mask_list':list(mask_list)}, make), clip_ds, src_ds, \
+                layer_resample['static_mask'])
+        return np.ma.filled(a, 1).astype(bool)
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'sidecar_dir':self.sidecar_dir}
@@ -5,10 +5,272 @@ import matplotlib.pyplot as plt
 import rasterio
 from matplotlib.colors import LightSource
 
-from pygeotools.lib import iolib,  geolib
+from pygeotools.lib import iolib,  geolib, warplib
 import logger
+import writelib
+from windowlib import iter_windows, read_window_ma
 
-def DoD_Stats(src_dem_fn, ref_dem_fn, outdir, res, extent, match = True, log_file = None, out_diff_fn = None):
+def diff_stats(diff, perc=(1, 5, 95, 99)):
+    """
+    Compute all reported elevation difference statistics in one pass over a single compressed buffer.
+    Only one additional buffer is allocated for absolute values (reused for NMAD), and each set of
+    percentiles is taken with a single partition call.
+    Parameters:
+    - diff (np.ma.MaskedArray or np.ndarray): Difference map (src - ref), masked or nan for invalid pixels.
+    - perc (tuple): Percentiles of the absolute difference to report.
+    Returns:
+    - stats (dict): Signed stats (count, min, max, ptp, mean, std, med, nmad, p16, p84, spread, pos/neg mean and count)
+      and absolute stats (abs_mean, abs_std, abs_min, abs_max, abs_med, abs_p<perc>). The malib.get_stats_dict
+      keys are all included, with median and mad as aliases of med and nmad (malib.mad is normalized) and mode.
+    """
+    d = np.ma.compressed(diff)
+    #Partitioning below reorders the buffer in place, so never work on a view of the input
+    if d.dtype != np.float64 or np.may_share_memory(d, np.ma.getdata(diff)):
+        d = d.astype(np.float64)
+    finite = np.isfinite(d)
+    if not finite.all():
+        d = d[finite]
+    finite = None
+    n = d.size
+    stats = {'count':int(n)}
+    if n == 0:
+        return stats
+    d_sum = d.sum()
+    mean = d_sum/n
+    mean_sq = np.dot(d, d)/n
+    stats['min'] = float(d.min())
+    stats['max'] = float(d.max())
+    stats['ptp'] = stats['max'] - stats['min']
+    stats['mean'] = float(mean)
+    stats['std'] = float(np.sqrt(max(mean_sq - mean**2, 0)))
+    stats['pos_count'] = int(np.count_nonzero(d > 0))
+    stats['neg_count'] = int(np.count_nonzero(d < 0))
+
+    a = np.abs(d)
+    abs_sum = a.sum()
+    abs_mean = abs_sum/n
+    #Positive and negative sums follow from the signed and absolute sums, no extra copies
+    stats['pos_mean'] = float((d_sum + abs_sum)/2./stats['pos_count']) if stats['pos_count'] else np.nan
+    stats['neg_mean'] = float((d_sum - abs_sum)/2./stats['neg_count']) if stats['neg_count'] else np.nan
+    stats['abs_mean'] = float(abs_mean)
+    stats['abs_std'] = float(np.sqrt(max(mean_sq - abs_mean**2, 0)))
+    stats['abs_min'] = float(a.min())
+    stats['abs_max'] = float(a.max())
+    abs_q = [50,] + list(perc)
+    abs_vals = np.percentile(a, abs_q, overwrite_input=True)
+    stats['abs_med'] = float(abs_vals[0])
+    for p, v in zip(perc, abs_vals[1:]):
+        stats['abs_p%g' % p] = float(v)
+
+    p16, med, p84 = np.percentile(d, (16, 50, 84), overwrite_input=True)
+    stats['med'] = float(med)
+    stats['p16'] = float(p16)
+    stats['p84'] = float(p84)
+    stats['spread'] = float((p84 - p16)/2.)
+    #NMAD: normalized median absolute deviation from the median, reusing the abs buffer
+    np.subtract(d, med, out=a)
+    np.abs(a, out=a)
+    stats['nmad'] = float(1.4826*np.median(a, overwrite_input=True))
+    a = None
+    #Keys of malib.get_stats_dict, read by consumers of _align_stats.json
+    stats['median'] = stats['med']
+    stats['mad'] = stats['nmad']
+    #Most frequent value, the smallest on ties as scipy.stats.mstats.mode
+    d.sort()
+    starts = np.flatnonzero(np.concatenate(([True], d[1:] != d[:-1])))
+    runs = np.diff(np.append(starts, n))
+    stats['mode'] = float(d[starts[np.argmax(runs)]])
+    return stats
+
+class DiffAccumulator(object):
+    """
+    One-pass, mergeable accumulator for elevation difference statistics.
+    Moments, extremes and positive/negative means are exact, percentiles of the absolute
+    difference come from a fixed-size histogram: nbins bins of bin_width (error <= bin_width),
+    plus one overflow bin up to abs_max, so blunders or unflagged nodata cannot grow it.
+    """
+    def __init__(self, bin_width=0.001, nbins=2**18):
+        self.bin_width = bin_width
+        self.nbins = nbins
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.sum_abs = 0.0
+        self.pos_sum = 0.0
+        self.pos_count = 0
+        self.neg_sum = 0.0
+        self.neg_count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.abs_min = np.inf
+        self.abs_max = -np.inf
+        self.abs_hist = np.zeros(nbins + 1, dtype=np.int64)
+
+    def update(self, d):
+        """Add valid difference values (1D array)"""
+        if d.size == 0:
+            return
+        d = d.astype(np.float64)
+        a = np.abs(d)
+        self.count += d.size
+        self.sum += d.sum()
+        self.sum_sq += np.dot(d, d)
+        self.sum_abs += a.sum()
+        pos = d[d > 0]
+        neg = d[d < 0]
+        self.pos_sum += pos.sum()
+        self.pos_count += pos.size
+        self.neg_sum += neg.sum()
+        self.neg_count += neg.size
+        self.min = min(self.min, d.min())
+        self.max = max(self.max, d.max())
+        self.abs_min = min(self.abs_min, a.min())
+        self.abs_max = max(self.abs_max, a.max())
+        idx = (a/self.bin_width).astype(np.int64)
+        #Last bin collects everything beyond the histogram range
+        np.clip(idx, 0, self.nbins, out=idx)
+        self.abs_hist += np.bincount(idx, minlength=self.nbins + 1)
+
+    def merge(self, other):
+        """Combine with another accumulator, e.g. from a different tile or process"""
+        if other.bin_width != self.bin_width or other.nbins != self.nbins:
+            raise ValueError("Cannot merge accumulators with different histogram bins")
+        for attr in ['count', 'sum', 'sum_sq', 'sum_abs', 'pos_sum', 'pos_count', 'neg_sum', 'neg_count']:
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.abs_min = min(self.abs_min, other.abs_min)
+        self.abs_max = max(self.abs_max, other.abs_max)
+        self.abs_hist += other.abs_hist
+        return self
+
+    def abs_percentile(self, q):
+        """Percentile(s) of the absolute difference from the histogram, using bin centers"""
+        cdf = np.cumsum(self.abs_hist)
+        target = np.atleast_1d(q)/100.*self.count
+        idx = np.minimum(np.searchsorted(cdf, target, side='left'), self.nbins)
+        out = (idx + 0.5)*self.bin_width
+        #Overflow bin spans from the histogram range to abs_max, interpolate by count
+        over = idx == self.nbins
+        if over.any():
+            lo = self.nbins*self.bin_width
+            n_over = self.abs_hist[self.nbins]
+            frac = (target[over] - (cdf[self.nbins] - n_over))/max(n_over, 1)
+            out[over] = lo + np.clip(frac, 0, 1)*(self.abs_max - lo)
+        out = np.clip(out, self.abs_min, self.abs_max)
+        return out if np.ndim(q) else out[0]
+
+    def stats(self, perc=(1, 5, 95, 99)):
+        """Return dictionary of statistics"""
+        stats = {'count':self.count}
+        if self.count == 0:
+            return stats
+        mean = self.sum/self.count
+        abs_mean = self.sum_abs/self.count
+        stats['mean'] = mean
+        stats['std'] = np.sqrt(max(self.sum_sq/self.count - mean**2, 0))
+        stats['min'] = self.min
+        stats['max'] = self.max
+        stats['pos_count'] = self.pos_count
+        stats['neg_count'] = self.neg_count
+        stats['pos_mean'] = self.pos_sum/self.pos_count if self.pos_count else np.nan
+        stats['neg_mean'] = self.neg_sum/self.neg_count if self.neg_count else np.nan
+        stats['abs_mean'] = abs_mean
+        stats['abs_std'] = np.sqrt(max(self.sum_sq/self.count - abs_mean**2, 0))
+        stats['abs_min'] = self.abs_min
+        stats['abs_max'] = self.abs_max
+        stats['abs_med'] = self.abs_percentile(50)
+        for p, v in zip(perc, self.abs_percentile(perc)):
+            stats['abs_p%g' % p] = v
+        return stats
+
+def diff_stats_windowed(src_dem_fn, ref_dem_fn, out_diff_fn=None, tile_size=2048, bin_width=0.001, out_profile=None):
+    """
+    Stream the difference (src - ref) of two DEMs on the same grid, window by window.
+    Peak memory is bounded by the tile size, not the raster size.
+    Parameters:
+    - src_dem_fn (str): Source DEM filename.
+    - ref_dem_fn (str): Reference DEM filename, same grid as the source.
+    - out_diff_fn (str): If specified, the difference map is written here window by window.
+    - tile_size (int): Target window size in pixels.
+    - bin_width (float): Histogram bin width (m) for percentiles.
+    - out_profile (str): GeoTIFF output profile for out_diff_fn, one of writelib.profile_choices.
+    Returns:
+    - acc (DiffAccumulator): Accumulated statistics.
+    """
+    src_ds = gdal.Open(src_dem_fn)
+    ref_ds = gdal.Open(ref_dem_fn)
+    if (src_ds.RasterXSize, src_ds.RasterYSize) != (ref_ds.RasterXSize, ref_ds.RasterYSize):
+        raise ValueError("Source and reference DEMs must be on the same grid for windowed stats")
+    src_b = src_ds.GetRasterBand(1)
+    ref_b = ref_ds.GetRasterBand(1)
+    ndv = -9999.0
+    acc = DiffAccumulator(bin_width=bin_width)
+    def blocks():
+        for win in iter_windows(ref_ds, tile_size):
+            diff = read_window_ma(src_b, win).astype(np.float64) - read_window_ma(ref_b, win)
+            acc.update(diff.compressed())
+            yield diff.filled(ndv).astype(np.float32), win[0], win[1]
+    if out_diff_fn is not None:
+        writelib.write_blocks(blocks(), out_diff_fn, src_ds.RasterXSize, src_ds.RasterYSize, gdal.GDT_Float32, \
+                ref_ds.GetGeoTransform(), ref_ds.GetProjection(), ndv, profile=out_profile)
+    else:
+        for block in blocks():
+            pass
+    src_ds = None
+    ref_ds = None
+    return acc
+
+def match_vrt(src_dem_fn, ref_dem_fn, outdir, res, extent, r='cubic'):
+    """
+    Match two DEMs to a common grid with warped VRTs, so pixels are only resampled when windows are read.
+    Parameters:
+    - src_dem_fn (str): Source DEM filename, defines the output projection.
+    - ref_dem_fn (str): Reference DEM filename.
+    - outdir (str): Directory for the VRT files.
+    - res, extent (str): Resolution and extent options, as for warplib.
+    Returns:
+    - src_vrt_fn, ref_vrt_fn (str): Matched VRT filenames.
+    """
+    src_dem_ds = gdal.Open(src_dem_fn)
+    ref_dem_ds = gdal.Open(ref_dem_fn)
+    t_srs = geolib.get_ds_srs(src_dem_ds)
+    ds_list = [src_dem_ds, ref_dem_ds]
+    res = warplib.parse_res(res, ds_list, t_srs)
+    extent = warplib.parse_extent(extent, ds_list, t_srs)
+    out_fn_list = []
+    #Suffix keeps a source and reference with the same basename apart
+    for fn, ds, suffix in zip([src_dem_fn, ref_dem_fn], ds_list, ['_src', '_ref']):
+        vrt_fn = os.path.join(outdir, os.path.splitext(os.path.split(fn)[-1])[0] + suffix + '_matched.vrt')
+        opt = gdal.WarpOptions(format='VRT', outputBounds=extent, xRes=res, yRes=res, targetAlignedPixels=False, \
+                dstSRS=t_srs.ExportToWkt(), resampleAlg=r, dstNodata=-9999, outputType=gdal.GDT_Float32)
+        gdal.Warp(vrt_fn, ds, options=opt)
+        out_fn_list.append(vrt_fn)
+    src_dem_ds = None
+    ref_dem_ds = None
+    return out_fn_list
+
+def DoD_Stats_windowed(src_dem_fn, ref_dem_fn, outdir, res, extent, match=True, log_file=None, out_diff_fn=None, \
+        tile_size=2048, out_profile=None):
+    """
+    Streaming version of DoD_Stats for rasters larger than memory.
+    Inputs are matched with warped VRTs, then read, differenced and written window by window.
+    Returns:
+    - stats (dict): DoD statistics.
+    """
+    if match:
+        src_out_fn, ref_out_fn = match_vrt(src_dem_fn, ref_dem_fn, outdir, res, extent)
+    else:
+        src_out_fn, ref_out_fn = src_dem_fn, ref_dem_fn
+    ref_res = geolib.get_res(gdal.Open(ref_out_fn), square=True)[0]
+    src_res = geolib.get_res(gdal.Open(src_out_fn), square=True)[0]
+    print("Computing windowed difference map and stats, tile size: %i" % tile_size)
+    stats = diff_stats_windowed(src_out_fn, ref_out_fn, out_diff_fn, tile_size=tile_size, out_profile=out_profile).stats()
+    log_DoD_Stats(stats, src_dem_fn, ref_dem_fn, out_diff_fn, outdir, src_res, ref_res, log_file)
+    return stats
+
+def DoD_Stats(src_dem_fn, ref_dem_fn, outdir, res, extent, match = True, log_file = None, out_diff_fn = None, \
+        tile_size = None, out_profile = None):
 
     if type(ref_dem_fn) is list:
         ref_dem_fn = ref_dem_fn[0]
@@ -20,9 +282,16 @@ def DoD_Stats(src_dem_fn, ref_dem_fn, outdir, res, extent, match = True, log_fil
         print("No log file specified, creating file") 
         log_file = outdir + os.path.basename(os.path.splitext(src_dem_fn)[0]) + '_stats.txt'
     print(f"Log file: {log_file}")
+    if tile_size is not None:
+        return DoD_Stats_windowed(src_dem_fn, ref_dem_fn, outdir, res, extent, match=match, log_file=log_file, \
+                out_diff_fn=out_diff_fn, tile_size=tile_size, out_profile=out_profile)
     if match:
+        #difflib imports this module, so import here
+        from difflib import match_dems
         ref_out_fn, src_out_fn = match_dems(ref_dem_fn, src_dem_fn, outdir, res, extent)
         print("Computing DoD statistics for common intersection")
+    else:
+        ref_out_fn, src_out_fn = ref_dem_fn, src_dem_fn
     ref_dem_clip_ds = gdal.Open(ref_out_fn)
     src_dem_clip_ds = gdal.Open(src_out_fn)
     #Get resolution of src and ref DEMs
@@ -38,42 +307,46 @@ def DoD_Stats(src_dem_fn, ref_dem_fn, outdir, res, extent, match = True, log_fil
     print("Computing difference map...")
     
     diff_match = src_dem_match - ref_dem_match
-    avg_diff = np.nanmean(diff_match.compressed())
-    pos_avg_diff = np.nanmean(diff_match.compressed()[diff_match.compressed() > 0]) #average of positive values
-    neg_avg_diff = np.nanmean(diff_match.compressed()[diff_match.compressed() < 0]) #average of negative values
-    abs_avg_diff = np.nanmean(np.abs(diff_match.compressed()))
-    abs_med = np.nanmedian(np.abs(diff_match.compressed()))
-    abs_std = np.nanstd(np.abs(diff_match.compressed()))
-    abs_min = np.nanmin(np.abs(diff_match.compressed()))
-    abs_max = np.nanmax(np.abs(diff_match.compressed()))
-    abs_1_percentile_diff = np.nanpercentile(np.abs(diff_match.compressed()), 1)
-    abs_5_percentile_diff = np.nanpercentile(np.abs(diff_match.compressed()), 5)
-    abs_95_percentile_diff = np.nanpercentile(np.abs(diff_match.compressed()), 95)
-    abs_99_percentile_diff = np.nanpercentile(np.abs(diff_match.compressed()), 99)
-    #NMAD is 
-    logger.log("Source DEM: %s" % os.path.basename(src_dem_fn), log_file)
-    logger.log("Reference DEM: %s" % os.path.basename(ref_dem_fn), log_file)
-    logger.log("DoD File (src-ref): %s" % os.path.basename(out_diff_fn), log_file)
-    logger.log("Output directory: %s" % outdir, log_file)
-    logger.log("Resolution of source, reference DEMs: %0.4f, %0.4f" % (src_res, ref_res), log_file)
-    logger.log("Average difference: %0.4f" % avg_diff, log_file)
-    logger.log(("Average of positive difference values: %0.4f" % pos_avg_diff), log_file)
-    logger.log(("Average of negative difference values: %0.4f" % neg_avg_diff), log_file)
-    logger.log(("Absolute average difference: %0.4f" % abs_avg_diff), log_file)
-    logger.log(("Absolute median difference: %0.4f" % abs_med), log_file)
-    logger.log(("Absolute standard deviation: %0.4f" % abs_std), log_file)
-    logger.log(("Absolute minimum difference: %0.4f" % abs_min), log_file)
-    logger.log(("Absolute maximum difference: %0.4f" % abs_max), log_file)
-    logger.log(("Absolute 1st percentile difference: %0.4f" % abs_1_percentile_diff), log_file)
-    logger.log(("Absolute 5th percentile difference: %0.4f" % abs_5_percentile_diff), log_file)
-    logger.log(("Absolute 95th percentile difference: %0.4f" % abs_95_percentile_diff), log_file)
-    logger.log(("Absolute 99th percentile difference: %0.4f" % abs_99_percentile_diff), log_file)
+    src_dem_match = None
+    ref_dem_match = None
+    stats = diff_stats(diff_match)
+    log_DoD_Stats(stats, src_dem_fn, ref_dem_fn, out_diff_fn, outdir, src_res, ref_res, log_file)
  
     print("Writing out difference map for common intersection")
-    iolib.writeGTiff(diff_match, out_diff_fn, ref_dem_clip_ds)
+    writelib.write_ma(diff_match, out_diff_fn, ref_dem_clip_ds, profile=out_profile)
     src_dem_clip_ds = None
     ref_dem_clip_ds = None
-  
+    return stats
+
+def log_DoD_Stats(stats, src_dem_fn, ref_dem_fn, out_diff_fn, outdir, src_res, ref_res, log_file):
+    """
+    Log DoD statistics as text and JSON-lines records.
+    log_file can be a filename, written in one locked append, or a logger.Logger that the caller flushes.
+    """
+    if isinstance(log_file, logger.Logger):
+        log = log_file
+    else:
+        log = logger.Logger(log_file, json_file=True)
+    log.log("Source DEM: %s" % os.path.basename(src_dem_fn), key='src_dem_fn', value=src_dem_fn)
+    log.log("Reference DEM: %s" % os.path.basename(ref_dem_fn), key='ref_dem_fn', value=ref_dem_fn)
+    log.log("DoD File (src-ref): %s" % os.path.basename(out_diff_fn), key='out_diff_fn', value=out_diff_fn)
+    log.log("Output directory: %s" % outdir, key='outdir', value=outdir)
+    log.log("Resolution of source, reference DEMs: %0.4f, %0.4f" % (src_res, ref_res), key='res', \
+            value=[src_res, ref_res])
+    stat_labels = [('mean', "Average difference"), ('pos_mean', "Average of positive difference values"), \
+            ('neg_mean', "Average of negative difference values"), ('abs_mean', "Absolute average difference"), \
+            ('abs_med', "Absolute median difference"), ('abs_std', "Absolute standard deviation"), \
+            ('abs_min', "Absolute minimum difference"), ('abs_max', "Absolute maximum difference"), \
+            ('abs_p1', "Absolute 1st percentile difference"), ('abs_p5', "Absolute 5th percentile difference"), \
+            ('abs_p95', "Absolute 95th percentile difference"), ('abs_p99', "Absolute 99th percentile difference")]
+    if 'nmad' in stats:
+        stat_labels += [('med', "Median difference"), ('nmad', "NMAD")]
+    for key, label in stat_labels:
+        log.log("%s: %0.4f" % (label, stats[key]), key=key, value=stats[key])
+    if log is not log_file:
+        log.flush()
+    return log
+
 def plot_DoD(dod_fn, dem_fn, stats_fn):
     print("Plotting DoD...")
     with rasterio.open(dod_fn) as dod:
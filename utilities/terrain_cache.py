@@ -0,0 +1,57 @@
+import numpy as np
+
+class TerrainCache(object):
+    """
+    Cache of terrain derivatives (slope, aspect, static mask) reused across coregistration iterations.
+    Entries are keyed on layer name, grid (shape, resolution, projection) and layer parameters.
+    Each entry records the source DEM origin it was computed for, and is invalidated once the
+    cumulative shift of the source since then exceeds max_shift_px pixels.
+    """
+    def __init__(self, max_shift_px=0.5):
+        self.max_shift_px = max_shift_px
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def grid_key(ds):
+        gt = ds.GetGeoTransform()
+        return (ds.RasterYSize, ds.RasterXSize, round(gt[1], 6), round(gt[5], 6), ds.GetProjection())
+
+    @staticmethod
+    def src_origin(src_ds):
+        gt = src_ds.GetGeoTransform()
+        return np.array([gt[0], gt[3]])
+
+    def get(self, name, clip_ds, src_ds, params=()):
+        """
+        Return cached layer for clip_ds grid, or None if missing or invalidated by the source shift.
+        Parameters:
+        - name (str): Layer name, e.g. 'slope', 'aspect', 'static_mask'.
+        - clip_ds (gdal.Dataset): Dataset defining the grid the layer was computed on.
+        - src_ds (gdal.Dataset): Source DEM dataset, whose geotransform carries the cumulative shift.
+        - params (tuple): Hashable parameters used to compute the layer (mask_list, slope_lim).
+        """
+        key = (name, self.grid_key(clip_ds), params)
+        entry = self.entries.get(key)
+        if entry is not None:
+            a, origin = entry
+            res = abs(clip_ds.GetGeoTransform()[1])
+            shift_px = np.sqrt(np.sum((self.src_origin(src_ds) - origin)**2))/res
+            if shift_px <= self.max_shift_px:
+                self.hits += 1
+                return a
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, name, clip_ds, src_ds, a, params=()):
+        key = (name, self.grid_key(clip_ds), params)
+        self.entries[key] = (a, self.src_origin(src_ds))
+
+    def clear(self):
+        """Drop all entries, e.g. after source elevations change (tilt correction)"""
+        self.entries = {}
+
+    def stats(self):
+        return {'hits':self.hits, 'misses':self.misses, 'max_shift_px':self.max_shift_px}
@@ -0,0 +1,195 @@
+"""
+Polynomial tilt correction for residual elevation differences.
+The polynomial is fit on a random subsample of the valid residuals and evaluated block by block,
+from row and column coordinate vectors combined by Horner's scheme, so memory depends on the
+block size, not the raster size or polynomial order.
+
+Coordinates are map coordinates of pixel centers, centered and scaled to about [-1, 1].
+With a track azimuth, terms are in along-track (s) and cross-track (t) coordinates, and
+along_order/cross_order add higher-order 1D terms for along-track and cross-track artifacts.
+"""
+import numpy as np
+
+from windowlib import iter_windows
+from outlierlib import row_blocks
+import writelib
+
+def horner(c, x):
+    """Evaluate sum_i c[i]*x**i by Horner's scheme, c may be scalars or arrays"""
+    out = c[-1]
+    for ci in c[-2::-1]:
+        out = out*x + ci
+    return out
+
+def poly_terms(order=1, along_order=0, cross_order=0):
+    """(i, j) exponents of s**i * t**j: all terms with i + j <= order, plus 1D terms up to along_order/cross_order"""
+    terms = [(i, j) for j in range(order+1) for i in range(order+1-j)]
+    terms += [(i, 0) for i in range(order+1, along_order+1)]
+    terms += [(0, j) for j in range(order+1, cross_order+1)]
+    return terms
+
+def pixel_centers(gt, xoff, yoff, nx, ny):
+    """Map coordinates of pixel centers for a window, as row/column vectors when the geotransform is north-up"""
+    cols = xoff + np.arange(nx) + 0.5
+    rows = (yoff + np.arange(ny) + 0.5)[:,np.newaxis]
+    if gt[2] == 0 and gt[4] == 0:
+        return gt[0] + cols*gt[1], gt[3] + rows*gt[5]
+    return gt[0] + cols*gt[1] + rows*gt[2], gt[3] + cols*gt[4] + rows*gt[5]
+
+def sample_valid(diff, max_samples, seed=0, block_px=2**20):
+    """
+    Flat indices (sorted) of up to max_samples valid pixels of diff, uniform without replacement.
+    Valid pixels are counted per strip of rows, each strip's share of the sample is drawn from a
+    hypergeometric distribution, then drawn within the strip, so memory depends on the strip size
+    and max_samples, not the number of valid pixels.
+    Returns:
+    - idx (np.array): Flat indices into diff.
+    - n_valid (int): Total number of valid pixels.
+    """
+    blocks = list(row_blocks(diff.shape, block_px))
+    counts = [int(np.count_nonzero(~np.ma.getmaskarray(diff[sl]))) for sl in blocks]
+    n_valid = sum(counts)
+    row_px = int(np.prod(diff.shape[1:]))
+    rs = np.random.RandomState(seed)
+    remaining = n_valid
+    todo = min(max_samples, n_valid)
+    out = []
+    for sl, n_b in zip(blocks, counts):
+        if todo == 0:
+            break
+        if n_b == 0:
+            continue
+        k = todo if remaining == n_b else int(rs.hypergeometric(n_b, remaining - n_b, todo))
+        remaining -= n_b
+        todo -= k
+        if k:
+            idx_b = np.flatnonzero(~np.ma.getmaskarray(diff[sl]))
+            if k < n_b:
+                idx_b = np.sort(rs.choice(idx_b, k, replace=False))
+            out.append(idx_b + sl.start*row_px)
+    idx = np.concatenate(out) if out else np.zeros(0, dtype=np.int64)
+    return idx, n_valid
+
+class TiltModel(object):
+    """
+    Fitted polynomial surface, evaluated on any grid in the same coordinate system.
+
+    Example:
+    tilt = fit_tilt(diff_filt, gt, order=2)
+    tilt.subtract_ma(diff, gt)
+    tilt.apply_ds(src_ds)
+    """
+    def __init__(self, terms, coeff, center, scale, azimuth=None):
+        """
+        Parameters:
+        - terms (list): (i, j) exponents, see poly_terms.
+        - coeff (np.array): Coefficient for each term.
+        - center (tuple): Coordinate origin (x, y).
+        - scale (float): Coordinate scale (m).
+        - azimuth (float): Along-track direction (degrees clockwise from north), None for x and y.
+        """
+        self.terms = [tuple(t) for t in terms]
+        self.coeff = np.asarray(coeff, dtype=np.float64)
+        self.center = center
+        self.scale = scale
+        self.azimuth = azimuth
+        #Dense coefficient matrix, C[i, j] for s**i * t**j
+        ni = max(i for i, j in self.terms) + 1
+        nj = max(j for i, j in self.terms) + 1
+        self.C = np.zeros((ni, nj))
+        for (i, j), c in zip(self.terms, self.coeff):
+            self.C[i, j] = c
+
+    def st(self, x, y):
+        """Scaled model coordinates for map coordinates x, y"""
+        u = (x - self.center[0])/self.scale
+        v = (y - self.center[1])/self.scale
+        if self.azimuth is None:
+            return u, v
+        a = np.deg2rad(self.azimuth)
+        return u*np.sin(a) + v*np.cos(a), u*np.cos(a) - v*np.sin(a)
+
+    def evaluate(self, gt, xoff, yoff, nx, ny):
+        """Correction for a window of a grid with geotransform gt, as float32 (ny, nx) array"""
+        s, t = self.st(*pixel_centers(gt, xoff, yoff, nx, ny))
+        #For north-up grids without azimuth, s is a row vector and t a column vector, so
+        #each p_j(s) is 1D and only the final Horner pass over t is block-sized
+        p = [horner(self.C[:,j], s) for j in range(self.C.shape[1])]
+        val = horner(p, t)
+        return np.broadcast_to(val, (ny, nx)).astype(np.float32)
+
+    def subtract_ma(self, a, gt, tile_size=2048):
+        """Subtract the correction from masked array a on grid gt in place, in strips of rows"""
+        d = np.ma.getdata(a)
+        for yoff in range(0, a.shape[0], tile_size):
+            ny = min(tile_size, a.shape[0] - yoff)
+            d[yoff:yoff+ny] -= self.evaluate(gt, 0, yoff, a.shape[1], ny)
+        return a
+
+    def apply_ds(self, ds, sign=-1, tile_size=2048):
+        """Add sign*correction to valid pixels of a single-band dataset (e.g., MEM) in place, window by window"""
+        b = ds.GetRasterBand(1)
+        gt = ds.GetGeoTransform()
+        ndv = b.GetNoDataValue()
+        for win in iter_windows(ds, tile_size):
+            a = b.ReadAsArray(*win)
+            valid = np.isfinite(a)
+            if ndv is not None:
+                valid &= (a != ndv)
+            a[valid] += sign*self.evaluate(gt, *win)[valid]
+            b.WriteArray(a, win[0], win[1])
+        b.FlushCache()
+        return ds
+
+    def preview(self, gt, nx, ny, max_size=1024):
+        """Correction on a decimated copy of the grid, for plots"""
+        stride = max(1, int(np.ceil(max(nx, ny)/float(max_size))))
+        pgt = [gt[0], gt[1]*stride, gt[2]*stride, gt[3], gt[4]*stride, gt[5]*stride]
+        return self.evaluate(pgt, 0, 0, int(np.ceil(nx/float(stride))), int(np.ceil(ny/float(stride))))
+
+    def to_dict(self):
+        return {'terms':[list(t) for t in self.terms], 'coeff':self.coeff.tolist(), 'center':list(self.center), \
+                'scale':self.scale, 'azimuth':self.azimuth}
+
+def fit_tilt(diff, gt, order=1, along_order=0, cross_order=0, azimuth=None, max_samples=1000000, seed=0):
+    """
+    Least squares polynomial fit to a random subsample of valid residuals.
+    Parameters:
+    - diff (np.ma.array): Residual elevation difference, masked where excluded.
+    - gt (tuple): Geotransform of diff.
+    - order (int): Total order of the 2D polynomial.
+    - along_order, cross_order (int): Order of additional along-track and cross-track 1D terms.
+    - azimuth (float): Along-track direction (degrees clockwise from north), None for x and y.
+    - max_samples (int): Maximum number of pixels used in the fit.
+    - seed (int): Random seed for the subsample.
+    Returns:
+    - tilt (TiltModel): Fitted model, zero if there are too few valid pixels.
+    """
+    terms = poly_terms(order, along_order, cross_order)
+    idx, n_valid = sample_valid(diff, max_samples, seed)
+    rows, cols = np.unravel_index(idx, diff.shape)
+    idx = None
+    z = np.ma.getdata(diff)[rows, cols].astype(np.float64)
+    x = gt[0] + (cols + 0.5)*gt[1] + (rows + 0.5)*gt[2]
+    y = gt[3] + (cols + 0.5)*gt[4] + (rows + 0.5)*gt[5]
+    if z.size < 10*len(terms):
+        print("Too few valid pixels for tilt correction (%i), skipping" % z.size)
+        return TiltModel(terms, np.zeros(len(terms)), (0.0, 0.0), 1.0, azimuth)
+    center = (float(x.mean()), float(y.mean()))
+    scale = float(max(np.abs(x - center[0]).max(), np.abs(y - center[1]).max(), 1.0))
+    tilt = TiltModel(terms, np.zeros(len(terms)), center, scale, azimuth)
+    s, t = tilt.st(x, y)
+    A = np.column_stack([s**i * t**j for i, j in terms])
+    coeff = np.linalg.lstsq(A, z, rcond=None)[0]
+    rms = np.sqrt(np.mean((z - A.dot(coeff))**2))
+    print("Tilt fit: %i terms, %i of %i valid pixels, residual RMS %0.3f m" % (len(terms), z.size, n_valid, rms))
+    return TiltModel(terms, coeff, center, scale, azimuth)
+
+def write_corrected(src_ds, dst_fn, dx, dy, dz, tilt, tile_size=2048, profile=None):
+    """
+    Write a DEM shifted by (dx, dy, dz) with the tilt correction removed, window by window.
+    The correction is evaluated on the shifted grid, so no full-size coordinate grids are created.
+    """
+    print("Writing shifted, tilt-corrected DEM: %s" % dst_fn)
+    return writelib.write_windowed(src_ds, dst_fn, gt=writelib.shifted_gt(src_ds, dx, dy), \
+            func=lambda a, win, gt: a + dz - tilt.evaluate(gt, *win), tile_size=tile_size, profile=profile)
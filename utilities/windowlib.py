@@ -0,0 +1,39 @@
+import numpy as np
+
+def iter_windows(ds, tile_size=2048, bnum=1):
+    """
+    Yield block-aligned windows covering a dataset.
+    Windows are whole multiples of the band's native block size, close to tile_size pixels on a side.
+    Parameters:
+    - ds (gdal.Dataset): Input dataset.
+    - tile_size (int): Target window size in pixels.
+    - bnum (int): Band number used for the native block size.
+    Yields:
+    - (xoff, yoff, nx, ny) (tuple): Window offset and size in pixels.
+    """
+    bx, by = ds.GetRasterBand(bnum).GetBlockSize()
+    #Strip-organized files have block width equal to raster width
+    wx = max(bx, (tile_size//bx)*bx)
+    wy = max(by, (tile_size//by)*by)
+    for yoff in range(0, ds.RasterYSize, wy):
+        ny = min(wy, ds.RasterYSize - yoff)
+        for xoff in range(0, ds.RasterXSize, wx):
+            nx = min(wx, ds.RasterXSize - xoff)
+            yield xoff, yoff, nx, ny
+
+def read_window_ma(b, win):
+    """
+    Read a window from a band as a masked array, masking nodata and nan.
+    Parameters:
+    - b (gdal.Band): Input band.
+    - win (tuple): (xoff, yoff, nx, ny) window.
+    Returns:
+    - a (np.ma.MaskedArray): Window array.
+    """
+    xoff, yoff, nx, ny = win
+    a = b.ReadAsArray(xoff, yoff, nx, ny)
+    ndv = b.GetNoDataValue()
+    mask = ~np.isfinite(a)
+    if ndv is not None:
+        mask |= (a == ndv)
+    return np.ma.array(a, mask=mask)
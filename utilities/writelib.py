@@ -0,0 +1,218 @@
+import os
+from osgeo import gdal, gdal_array
+import numpy as np
+
+from pygeotools.lib import iolib
+from windowlib import iter_windows, read_window_ma
+
+#Methods for writing a shifted DEM
+shift_choices = ['copy', 'vrt', 'window']
+
+#GeoTIFF output profiles
+#gtiff: pygeotools default creation options (iolib.gdal_opt)
+#deflate, zstd: internally tiled, compressed with a floating-point predictor
+#cog: deflate tiles with internal overviews stored ahead of the full-resolution data
+profile_choices = ['gtiff', 'deflate', 'zstd', 'cog']
+default_profile = 'deflate'
+#Internal tile size (pixels) for tiled profiles
+block_size = 512
+
+def has_compression(name):
+    """True if the GeoTIFF driver supports COMPRESS=name"""
+    return name in (iolib.gtif_drv.GetMetadataItem('DMD_CREATIONOPTIONLIST') or '')
+
+def creation_options(profile=None, dtype=gdal.GDT_Float32, num_threads=None):
+    """
+    GeoTIFF creation options for an output profile.
+    Parameters:
+    - profile (str): One of profile_choices, default is default_profile.
+    - dtype (int): Output GDAL data type, selects the predictor.
+    - num_threads (str or int): Compression threads, default is the GDAL_NUM_THREADS config option or ALL_CPUS.
+      batch_align sets GDAL_NUM_THREADS=1 in its workers, so the pool does not start a thread per core each.
+    Returns:
+    - options (list): Creation options.
+    """
+    if profile is None:
+        profile = default_profile
+    if profile not in profile_choices:
+        raise ValueError("Unknown output profile: %s, choices are %s" % (profile, profile_choices))
+    if profile == 'gtiff':
+        return list(iolib.gdal_opt)
+    compress = 'DEFLATE'
+    if profile == 'zstd':
+        if has_compression('ZSTD'):
+            compress = 'ZSTD'
+        else:
+            print("GDAL was built without ZSTD support, using DEFLATE")
+    #Floating-point predictor for float data, horizontal differencing otherwise
+    predictor = 3 if dtype in (gdal.GDT_Float32, gdal.GDT_Float64) else 2
+    if num_threads is None:
+        num_threads = gdal.GetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    return ['TILED=YES', 'BLOCKXSIZE=%i' % block_size, 'BLOCKYSIZE=%i' % block_size, 'COMPRESS=%s' % compress, \
+            'PREDICTOR=%i' % predictor, 'BIGTIFF=IF_SAFER', 'NUM_THREADS=%s' % num_threads]
+
+def overview_levels(nx, ny):
+    """Power of 2 overview factors until the overview fits in a single tile"""
+    levels = []
+    f = 2
+    while max(nx, ny)//f >= block_size:
+        levels.append(f)
+        f *= 2
+    return levels
+
+def write_blocks(blocks, dst_fn, nx, ny, dtype, gt, proj, ndv, profile=None):
+    """
+    Write a single-band GeoTIFF from an iterable of blocks, so the full raster is never held in memory.
+    Parameters:
+    - blocks (iterable): (a, xoff, yoff) tuples, a is an array or masked array.
+    - dst_fn (str): Output filename.
+    - nx, ny (int): Output size in pixels.
+    - dtype (int): Output GDAL data type.
+    - gt (tuple), proj (str): Output geotransform and projection.
+    - ndv (float): Nodata value, masked pixels are filled with this.
+    - profile (str): Output profile, one of profile_choices.
+    Returns:
+    - dst_fn (str): Output filename.
+    """
+    if profile is None:
+        profile = default_profile
+    out_fn = dst_fn
+    if profile == 'cog':
+        #Overviews need the full-resolution data first, then everything is copied to the final layout
+        out_fn = os.path.splitext(dst_fn)[0] + '_tmp.tif'
+    out_ds = iolib.gtif_drv.Create(out_fn, nx, ny, 1, dtype, options=creation_options(profile, dtype))
+    out_ds.SetGeoTransform(tuple(gt))
+    out_ds.SetProjection(proj)
+    out_b = out_ds.GetRasterBand(1)
+    out_b.SetNoDataValue(float(ndv))
+    for a, xoff, yoff in blocks:
+        out_b.WriteArray(np.ma.filled(a, ndv), xoff, yoff)
+    out_b.FlushCache()
+    out_b = None
+    if profile == 'cog':
+        levels = overview_levels(nx, ny)
+        if levels:
+            out_ds.BuildOverviews('AVERAGE', levels)
+        iolib.gtif_drv.CreateCopy(dst_fn, out_ds, options=creation_options(profile, dtype) + ['COPY_SRC_OVERVIEWS=YES'])
+        out_ds = None
+        iolib.gtif_drv.Delete(out_fn)
+    out_ds = None
+    return dst_fn
+
+def write_ma(a, dst_fn, src_ds=None, ndv=None, gt=None, proj=None, profile=None, tile_size=2048):
+    """
+    Write a masked array to a GeoTIFF with an output profile, replaces iolib.writeGTiff.
+    Rows are filled and written in strips, so no filled copy of the full array is made.
+    Parameters:
+    - a (np.ma.array): Array to write.
+    - dst_fn (str): Output filename.
+    - src_ds (gdal.Dataset): Dataset providing geotransform and projection, unless gt and proj are given.
+    - ndv (float): Nodata value, default is the fill value of a.
+    - profile (str): Output profile, one of profile_choices.
+    - tile_size (int): Number of rows written at a time, rounded to a multiple of block_size.
+    Returns:
+    - dst_fn (str): Output filename.
+    """
+    if gt is None:
+        gt = src_ds.GetGeoTransform()
+    if proj is None:
+        proj = src_ds.GetProjection()
+    if ndv is None:
+        ndv = np.ma.array(a, copy=False).fill_value
+    dtype = gdal_array.NumericTypeCodeToGDALTypeCode(a.dtype)
+    nrows = max(block_size, (tile_size//block_size)*block_size)
+    blocks = ((a[yoff:yoff+nrows], 0, yoff) for yoff in range(0, a.shape[0], nrows))
+    return write_blocks(blocks, dst_fn, a.shape[1], a.shape[0], dtype, gt, proj, ndv, profile=profile)
+
+def shifted_gt(ds, dx, dy):
+    """Return geotransform of ds with origin offset by (dx, dy)"""
+    gt = list(ds.GetGeoTransform())
+    gt[0] += dx
+    gt[3] += dy
+    return gt
+
+def shifted_vrt_opt(src_ds, dx, dy, dz):
+    """Translate options for a VRT of src_ds with shifted geotransform and a linear offset of dz"""
+    gt = shifted_gt(src_ds, dx, dy)
+    ulx, uly = gt[0], gt[3]
+    lrx = gt[0] + src_ds.RasterXSize*gt[1]
+    lry = gt[3] + src_ds.RasterYSize*gt[5]
+    ndv = iolib.get_ndv_ds(src_ds)
+    #scaleParams maps [0, 1] to [dz, 1+dz], i.e. value + dz
+    return gdal.TranslateOptions(format='VRT', outputBounds=[ulx, uly, lrx, lry], scaleParams=[[0, 1, dz, 1+dz]], \
+            outputType=gdal.GDT_Float32, noData=ndv)
+
+def shifted_vrt_ds(src_ds, dx, dy, dz):
+    """In-memory VRT of src_ds shifted by (dx, dy, dz), no pixels are copied"""
+    return gdal.Translate('', src_ds, options=shifted_vrt_opt(src_ds, dx, dy, dz))
+
+def write_shifted_vrt(src_ds, dst_fn, dx, dy, dz, profile=None):
+    """
+    Write a VRT referencing the source DEM, with shifted geotransform and a linear offset of dz.
+    No pixels are copied; the offset is applied on read, nodata pixels are left untouched.
+    If dst_fn is not a .vrt, the VRT is streamed into a GeoTIFF block by block.
+    """
+    if os.path.splitext(dst_fn)[1].lower() == '.vrt':
+        #Dataset handle is dropped right away, which writes the VRT
+        gdal.Translate(dst_fn, src_ds, options=shifted_vrt_opt(src_ds, dx, dy, dz))
+    else:
+        vrt_ds = shifted_vrt_ds(src_ds, dx, dy, dz)
+        write_windowed(vrt_ds, dst_fn, profile=profile)
+        vrt_ds = None
+    return dst_fn
+
+def write_windowed(src_ds, dst_fn, gt=None, func=None, tile_size=2048, dtype=None, profile=None):
+    """
+    Copy a single-band dataset to a GeoTIFF window by window, optionally modifying each block.
+    Parameters:
+    - src_ds (gdal.Dataset): Input dataset.
+    - dst_fn (str): Output GeoTIFF filename.
+    - gt (list): Output geotransform, default is the input geotransform.
+    - func (callable): func(block, win, gt) -> block, applied to each masked array block.
+    - tile_size (int): Target window size in pixels.
+    - dtype (int): Output GDAL data type, default is the input data type, or Float32 for integer input with func.
+    - profile (str): Output profile, one of profile_choices.
+    Returns:
+    - dst_fn (str): Output filename.
+    """
+    if gt is None:
+        gt = src_ds.GetGeoTransform()
+    src_b = src_ds.GetRasterBand(1)
+    if dtype is None:
+        dtype = src_b.DataType
+        #Modified blocks are float (e.g. a + dz), writing them as Int16/Int32 would truncate to whole metres
+        if func is not None and dtype not in (gdal.GDT_Float32, gdal.GDT_Float64):
+            dtype = gdal.GDT_Float32
+    ndv = src_b.GetNoDataValue()
+    if ndv is None:
+        ndv = -9999
+    def blocks():
+        for win in iter_windows(src_ds, tile_size):
+            a = read_window_ma(src_b, win)
+            if func is not None:
+                a = func(a, win, gt)
+            yield a, win[0], win[1]
+    return write_blocks(blocks(), dst_fn, src_ds.RasterXSize, src_ds.RasterYSize, dtype, gt, src_ds.GetProjection(), \
+            ndv, profile=profile)
+
+def write_shifted(src_ds, dst_fn, dx, dy, dz, method='window', tile_size=2048, profile=None):
+    """
+    Write a DEM shifted by (dx, dy, dz) without holding full-raster copies in memory.
+    Parameters:
+    - src_ds (gdal.Dataset): Source DEM.
+    - dst_fn (str): Output filename.
+    - dx, dy, dz (float): Shift, horizontal components only update the geotransform.
+    - method (str): 'vrt' for a VRT (or GDAL-streamed GeoTIFF) with adjusted geotransform and offset,
+      'window' for a chunked rewrite adding dz block by block.
+    - profile (str): Output profile for GeoTIFF output, one of profile_choices.
+    Returns:
+    - dst_fn (str): Output filename.
+    """
+    print("Writing shifted DEM (%s): %s" % (method, dst_fn))
+    if method == 'vrt':
+        return write_shifted_vrt(src_ds, dst_fn, dx, dy, dz, profile=profile)
+    elif method == 'window':
+        return write_windowed(src_ds, dst_fn, gt=shifted_gt(src_ds, dx, dy), func=lambda a, win, gt: a + dz, \
+                tile_size=tile_size, profile=profile)
+    else:
+        raise ValueError("Unknown shift method: %s" % method)